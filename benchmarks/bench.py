@@ -0,0 +1,388 @@
+"""
+Microbenchmarks for pywaggle's hot paths.
+
+All benchmarks run offline. The RabbitMQ path is measured against an in-process broker
+stand-in and media is generated on the fly. Results are written as JSON so they can be
+compared across releases.
+
+Usage:
+
+    PYTHONPATH=src python3 benchmarks/bench.py [-o results.json] [-k filter] [--quick]
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Lock
+from unittest import mock
+
+import wagglemsg
+from waggle.plugin import Plugin, PluginConfig, Uploader
+from waggle.plugin.plugin import FilesystemPublisher
+from waggle.plugin.timings import TimingHistogram
+
+BENCHMARKS = {}
+
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__[len("bench_") :]] = fn
+    return fn
+
+
+def latency_stats(hist: TimingHistogram) -> dict:
+    summary = hist.summary()
+    return {f"latency_{k}_ns": getattr(summary, k) for k in ["mean", "p50", "p99", "max"]}
+
+
+def rate(count, elapsed):
+    return count / elapsed if elapsed > 0 else 0.0
+
+
+class FakeBroker:
+    """
+    FakeBroker stands in for pika.BlockingConnection so the RabbitMQPublisher path can be
+    measured without a real broker.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.received = 0
+        self.received_bytes = 0
+
+    def __call__(self, params):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def channel(self):
+        return self
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        with self.lock:
+            self.received += 1
+            self.received_bytes += len(body)
+
+
+def get_config(transport="rabbitmq"):
+    return PluginConfig(
+        username="plugin",
+        password="plugin",
+        host="localhost",
+        port=5672,
+        app_id="",
+        transport=transport,
+    )
+
+
+def make_message(i):
+    return wagglemsg.Message(
+        name="env.temperature",
+        value=20.0 + i % 10,
+        timestamp=time.time_ns(),
+        meta={"sensor": "bme680", "zone": "core"},
+    )
+
+
+@benchmark
+def bench_wagglemsg(n):
+    msgs = [make_message(i) for i in range(n)]
+    start = time.perf_counter()
+    bodies = [wagglemsg.dump(msg) for msg in msgs]
+    dump_elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    for body in bodies:
+        wagglemsg.load(body)
+    load_elapsed = time.perf_counter() - start
+    return {
+        "dump_per_sec": rate(n, dump_elapsed),
+        "load_per_sec": rate(n, load_elapsed),
+        "mean_body_bytes": sum(map(len, bodies)) / n,
+    }
+
+
+@benchmark
+def bench_batch_encoding(n):
+    from waggle.plugin.encoding import BATCH_MAX_MESSAGES, decode_batch, encode_batch
+
+    msgs = [make_message(i) for i in range(BATCH_MAX_MESSAGES)]
+    rounds = max(n // BATCH_MAX_MESSAGES, 1)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        body = encode_batch(msgs)
+    encode_elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(rounds):
+        decode_batch(body)
+    decode_elapsed = time.perf_counter() - start
+    return {
+        "encode_per_sec": rate(rounds * len(msgs), encode_elapsed),
+        "decode_per_sec": rate(rounds * len(msgs), decode_elapsed),
+        "bytes_per_message": len(body) / len(msgs),
+        "json_bytes_per_message": sum(len(wagglemsg.dump(msg)) for msg in msgs) / len(msgs),
+    }
+
+
+def measure_publish(plugin, n):
+    hist = TimingHistogram()
+    start = time.perf_counter()
+    for i in range(n):
+        t0 = time.perf_counter_ns()
+        plugin.publish("env.temperature", 20.0 + i % 10, meta={"sensor": "bme680"})
+        hist.record(time.perf_counter_ns() - t0)
+    elapsed = time.perf_counter() - start
+    return {"publish_per_sec": rate(n, elapsed), **latency_stats(hist)}
+
+
+@benchmark
+def bench_publish(n):
+    plugin = Plugin(get_config())
+    return measure_publish(plugin, n)
+
+
+@benchmark
+def bench_publish_log_dir(n):
+    with TemporaryDirectory() as dir:
+        file_publisher = FilesystemPublisher(dir)
+        try:
+            plugin = Plugin(get_config(), file_publisher=file_publisher)
+            return measure_publish(plugin, n)
+        finally:
+            file_publisher.close()
+
+
+@benchmark
+def bench_publish_broker(n):
+    import pika
+
+    broker = FakeBroker()
+    with mock.patch.object(pika, "BlockingConnection", broker):
+        start = time.perf_counter()
+        with Plugin(get_config()) as plugin:
+            results = measure_publish(plugin, n)
+            while broker.received < n:
+                time.sleep(0.001)
+            elapsed = time.perf_counter() - start
+            results.update(
+                {
+                    "delivered_per_sec": rate(n, elapsed),
+                    "broker_latency_p99_ns": plugin.stats()["rabbitmq.publish.latency.p99"],
+                }
+            )
+    return results
+
+
+def measure_round_trip(config, n, ready=lambda: True):
+    hist = TimingHistogram()
+    with Plugin(config) as subscriber, Plugin(config) as publisher:
+        subscriber.subscribe("bench.ping")
+        while not ready():
+            time.sleep(0.001)
+        start = time.perf_counter()
+        for i in range(n):
+            t0 = time.perf_counter_ns()
+            publisher.publish("bench.ping", i)
+            subscriber.get(timeout=5)
+            hist.record(time.perf_counter_ns() - t0)
+        elapsed = time.perf_counter() - start
+    return {"round_trips_per_sec": rate(n, elapsed), **latency_stats(hist)}
+
+
+@benchmark
+def bench_transport_memory(n):
+    return measure_round_trip(get_config("memory"), n // 10)
+
+
+@benchmark
+def bench_transport_unix(n):
+    from waggle.plugin.transport import UnixSocketBroker
+
+    with TemporaryDirectory() as root:
+        path = Path(root, "plugin.sock")
+        with UnixSocketBroker(path) as broker:
+            return measure_round_trip(
+                get_config(f"unix://{path}"),
+                n // 10,
+                ready=lambda: broker.stats()["subscribers"] > 0,
+            )
+
+
+def measure_upload(root, size, count):
+    data = os.urandom(size)
+    uploader = Uploader(Path(root, "uploads"))
+    paths = []
+    for i in range(count):
+        path = Path(root, f"file-{i}.bin")
+        path.write_bytes(data)
+        paths.append(path)
+    start = time.perf_counter()
+    for path in paths:
+        uploader.upload_file(path)
+    elapsed = time.perf_counter() - start
+    return {
+        "files_per_sec": rate(count, elapsed),
+        "mb_per_sec": rate(size * count / 1e6, elapsed),
+    }
+
+
+@benchmark
+def bench_upload_small(n):
+    with TemporaryDirectory() as root:
+        return measure_upload(root, 4 * 1024, max(n // 50, 10))
+
+
+@benchmark
+def bench_upload_large(n):
+    with TemporaryDirectory() as root:
+        return measure_upload(root, 32 * 1024 * 1024, max(n // 5000, 2))
+
+
+@benchmark
+def bench_image_folder(n):
+    import cv2
+    import numpy as np
+    from waggle.data.vision import ImageFolder
+
+    count = max(n // 100, 10)
+    with TemporaryDirectory() as root:
+        for i in range(count):
+            img = np.random.randint(0, 255, (480, 640, 3), dtype=np.uint8)
+            cv2.imwrite(str(Path(root, f"{i:05d}.jpg")), img)
+        folder = ImageFolder(root)
+        start = time.perf_counter()
+        for i in range(len(folder)):
+            folder[i]
+        elapsed = time.perf_counter() - start
+    return {"images_per_sec": rate(count, elapsed)}
+
+
+@benchmark
+def bench_video_sample(n):
+    import cv2
+    import numpy as np
+    from waggle.data.vision import VideoSample
+
+    count = max(n // 20, 50)
+    with TemporaryDirectory() as root:
+        path = Path(root, "video.avi")
+        writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), 10, (640, 480))
+        for _ in range(count):
+            writer.write(np.random.randint(0, 255, (480, 640, 3), dtype=np.uint8))
+        writer.release()
+        start = time.perf_counter()
+        with VideoSample(path, time.time_ns()) as video:
+            frames = sum(1 for _ in video)
+        elapsed = time.perf_counter() - start
+    return {"frames_per_sec": rate(frames, elapsed)}
+
+
+def write_measurements(path, n):
+    base = time.time_ns()
+    with open(path, "w") as f:
+        for i in range(n):
+            seconds, nanos = divmod(base + i * 1_000_000, 10**9)
+            timestamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds))
+            record = {
+                "name": "env.temperature" if i % 2 == 0 else "env.humidity",
+                "value": 20.0 + i % 10,
+                "meta": {"node": "000048b02d15bc7c", "sensor": "bme680"},
+                "timestamp": f"{timestamp}.{nanos:09d}Z",
+            }
+            print(json.dumps(record), file=f)
+
+
+@benchmark
+def bench_measurements_parse(n):
+    from waggle.data.measurements import MeasurementsFile, MeasurementsReader
+
+    with TemporaryDirectory() as root:
+        path = Path(root, "data.ndjson")
+        write_measurements(path, n)
+        start = time.perf_counter()
+        MeasurementsFile(path)
+        file_elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        read = sum(1 for _ in MeasurementsReader(path))
+        reader_elapsed = time.perf_counter() - start
+    return {
+        "file_records_per_sec": rate(n, file_elapsed),
+        "reader_records_per_sec": rate(read, reader_elapsed),
+    }
+
+
+@benchmark
+def bench_measurements_replay(n):
+    from waggle.data.measurements import MeasurementsFile
+
+    with TemporaryDirectory() as root:
+        path = Path(root, "data.ndjson")
+        write_measurements(path, n)
+        measurements = MeasurementsFile(path)
+        plugin = Plugin(get_config())
+        start = time.perf_counter()
+        measurements.replay_into(plugin, nodelay=True)
+        elapsed = time.perf_counter() - start
+    return {"records_per_sec": rate(plugin.send.qsize(), elapsed)}
+
+
+@contextmanager
+def isolated_env():
+    # benchmarks must not pick up a log dir or uploader from the caller's environment
+    saved = {k: os.environ.pop(k) for k in ["PYWAGGLE_LOG_DIR", "PYWAGGLE_STATS_INTERVAL"] if k in os.environ}
+    try:
+        yield
+    finally:
+        os.environ.update(saved)
+
+
+def run(names, n):
+    results = {}
+    for name in names:
+        print(f"running {name}...", file=sys.stderr, flush=True)
+        try:
+            with isolated_env():
+                results[name] = BENCHMARKS[name](n)
+        except ImportError as exc:
+            # media benchmarks need the optional vision dependencies
+            results[name] = {"skipped": str(exc)}
+        print(f"  {results[name]}", file=sys.stderr, flush=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run pywaggle microbenchmarks.")
+    parser.add_argument("-o", "--output", help="write JSON results to file instead of stdout")
+    parser.add_argument("-k", "--filter", default="", help="only run benchmarks containing this string")
+    parser.add_argument("-n", "--iterations", type=int, default=100000, help="base iteration count")
+    parser.add_argument("--quick", action="store_true", help="run with 1/100th the iterations")
+    args = parser.parse_args()
+
+    n = args.iterations // 100 if args.quick else args.iterations
+    names = [name for name in BENCHMARKS if args.filter in name]
+
+    report = {
+        "timestamp": time.time_ns(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "iterations": n,
+        "results": run(names, n),
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == "__main__":
+    main()
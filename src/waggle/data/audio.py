@@ -1,24 +1,105 @@
 from os import PathLike
 from pathlib import Path
-import numpy
-import soundfile
-from typing import NamedTuple
+from typing import TYPE_CHECKING, NamedTuple
 import random
 from base64 import b64encode
 from io import BytesIO
+import logging
+import struct
+import threading
 from .timestamp import get_timestamp
 
+# NOTE numpy and soundfile are imported on first use to keep import time low.
+if TYPE_CHECKING:
+    import numpy
+
+logger = logging.getLogger(__name__)
+
+
+AUDIO_FEATURES = ("rms", "dbfs", "peak", "spectral_centroid", "band_energy")
+DEFAULT_FEATURES = AUDIO_FEATURES
+DEFAULT_BANDS = ((0, 250), (250, 1000), (1000, 4000), (4000, 24000))
+
+# floor used when converting silence to dBFS
+MIN_AMPLITUDE = 1e-10
+
+FEATURE_BATCH_FRAMES = 256
+
 
 class AudioSample(NamedTuple):
-    data: numpy.ndarray
+    data: "numpy.ndarray"
     samplerate: int
     timestamp: int
 
     def save(self, path: PathLike):
+        import soundfile
+
         path = Path(path)
         soundfile.write(str(path), self.data, self.samplerate)
 
+    def features(
+        self, frame_size, hop=None, kinds=DEFAULT_FEATURES, bands=DEFAULT_BANDS
+    ):
+        """
+        features computes per frame features of the sample, processing all frames together
+        using strided views and a batched rFFT instead of looping over frames in Python.
+
+        Frames are frame_size samples long and start every hop samples (default frame_size).
+        The result maps each kind to an array with one row per frame and one column per channel:
+
+        * rms - root mean square amplitude.
+        * dbfs - rms in decibels relative to full scale.
+        * peak - peak absolute amplitude.
+        * spectral_centroid - power weighted mean frequency in Hz of the Hann windowed frame.
+        * band_energy - mean square power of the windowed frame within each (low, high) Hz
+          band in bands. This has an extra last axis with one entry per band.
+
+        Integer sample data is scaled to [-1, 1) first. The result also includes a "timestamp"
+        array with the nanosecond timestamp of the start of each frame.
+        """
+        import numpy
+
+        hop = hop or frame_size
+        for kind in kinds:
+            if kind not in AUDIO_FEATURES:
+                raise ValueError(f"unknown audio feature {kind!r}")
+
+        data = normalize_audio_data(self.data)
+        numframes = max(0, 1 + (len(data) - frame_size) // hop)
+        channels = data.shape[1]
+        frames = numpy.lib.stride_tricks.as_strided(
+            data,
+            shape=(numframes, frame_size, channels),
+            strides=(hop * data.strides[0], data.strides[0], data.strides[1]),
+            writeable=False,
+        )
+
+        results = {}
+        results["timestamp"] = self.timestamp + (
+            numpy.arange(numframes, dtype=numpy.int64) * hop * 1_000_000_000
+        ) // self.samplerate
+
+        if "rms" in kinds or "dbfs" in kinds:
+            # einsum avoids materializing the squared frames
+            rms = numpy.sqrt(numpy.einsum("ijk,ijk->ik", frames, frames) / frame_size)
+            if "rms" in kinds:
+                results["rms"] = rms
+            if "dbfs" in kinds:
+                results["dbfs"] = 20 * numpy.log10(numpy.maximum(rms, MIN_AMPLITUDE))
+
+        if "peak" in kinds:
+            results["peak"] = numpy.maximum(frames.max(axis=1), -frames.min(axis=1))
+
+        if "spectral_centroid" in kinds or "band_energy" in kinds:
+            results.update(
+                spectral_features(frames, self.samplerate, kinds, bands)
+            )
+
+        return results
+
     def _repr_html_(self):
+        import soundfile
+
         with BytesIO() as buf:
             soundfile.write(
                 buf, self.data, self.samplerate, format="flac", closefd=False
@@ -26,21 +107,230 @@ class AudioSample(NamedTuple):
             b64data = b64encode(buf.getvalue()).decode()
         return f"""
 <audio controls="controls" autobuffer="autobuffer">
-<source src="data:audio/wav;base64,{b64data}" />
+<source src="data:audio/flac;base64,{b64data}" />
 </audio>
 """
 
 
+def normalize_audio_data(data):
+    import numpy
+
+    data = numpy.asarray(data)
+    if data.ndim == 1:
+        data = data[:, numpy.newaxis]
+    if data.dtype.kind == "i":
+        return data.astype(numpy.float32) / float(2 ** (8 * data.dtype.itemsize - 1))
+    if data.dtype.kind == "u":
+        scale = float(2 ** (8 * data.dtype.itemsize - 1))
+        return (data.astype(numpy.float32) - scale) / scale
+    return data
+
+
+def spectral_features(frames, samplerate, kinds, bands):
+    import numpy
+
+    numframes, frame_size, channels = frames.shape
+    window = numpy.hanning(frame_size).astype(frames.dtype)[:, numpy.newaxis]
+    freqs = numpy.fft.rfftfreq(frame_size, 1 / samplerate)
+    # one sided spectrum weights so that power sums to the mean square of the windowed frame
+    weights = numpy.full(len(freqs), 2.0 / frame_size**2)
+    weights[0] /= 2
+    if frame_size % 2 == 0:
+        weights[-1] /= 2
+    band_masks = [(freqs >= low) & (freqs < high) for low, high in bands]
+
+    centroid = numpy.zeros((numframes, channels))
+    band_energy = numpy.zeros((numframes, channels, len(bands)))
+
+    # frames are transformed in batches to bound the memory used by the spectrum
+    for start in range(0, numframes, FEATURE_BATCH_FRAMES):
+        stop = min(start + FEATURE_BATCH_FRAMES, numframes)
+        spectrum = numpy.fft.rfft(frames[start:stop] * window, axis=1)
+        power = (spectrum.real**2 + spectrum.imag**2) * weights[:, numpy.newaxis]
+        total = power.sum(axis=1)
+        weighted = numpy.einsum("ijk,j->ik", power, freqs)
+        centroid[start:stop] = numpy.divide(
+            weighted, total, out=numpy.zeros_like(weighted), where=total > 0
+        )
+        for i, mask in enumerate(band_masks):
+            band_energy[start:stop, :, i] = power[:, mask].sum(axis=1)
+
+    results = {}
+    if "spectral_centroid" in kinds:
+        results["spectral_centroid"] = centroid
+    if "band_energy" in kinds:
+        results["band_energy"] = band_energy
+    return results
+
+
+class AudioRingBuffer:
+    """
+    AudioRingBuffer holds the most recent frames of a continuous audio stream.
+
+    Frames are addressed by their absolute position in the stream, so readers can follow
+    the stream without gaps as long as they stay within capacity frames of the writer.
+    """
+
+    def __init__(self, capacity, channels, samplerate, dtype="float32"):
+        import numpy
+
+        self.data = numpy.zeros((capacity, channels), dtype=dtype)
+        self.capacity = capacity
+        self.samplerate = samplerate
+        # total number of frames written since the stream started
+        self.written = 0
+        # timestamp of frame 0 in nanoseconds
+        self.start_timestamp = None
+        self.closed = False
+        self.error = None
+        self.cond = threading.Condition()
+
+    def timestamp_for_frame(self, frame):
+        return self.start_timestamp + (frame * 1_000_000_000) // self.samplerate
+
+    def write(self, block, timestamp=None):
+        """
+        write appends a block of frames. timestamp is when the block finished being captured.
+        """
+        timestamp = timestamp or get_timestamp()
+        n = len(block)
+        with self.cond:
+            if self.start_timestamp is None:
+                self.start_timestamp = timestamp - (n * 1_000_000_000) // self.samplerate
+            # only the newest capacity frames of an oversized block can be kept
+            if n > self.capacity:
+                self.written += n - self.capacity
+                block = block[n - self.capacity :]
+                n = self.capacity
+            pos = self.written % self.capacity
+            first = min(n, self.capacity - pos)
+            self.data[pos : pos + first] = block[:first]
+            self.data[: n - first] = block[first:]
+            self.written += n
+            self.cond.notify_all()
+
+    def close(self, error=None):
+        with self.cond:
+            self.closed = True
+            self.error = error
+            self.cond.notify_all()
+
+    def wait_for(self, frame, timeout=None):
+        """
+        wait_for blocks until the stream has been written up to frame.
+        """
+        with self.cond:
+            ok = self.cond.wait_for(
+                lambda: self.written >= frame or self.closed, timeout=timeout
+            )
+            if self.written >= frame:
+                return
+            if not ok:
+                raise TimeoutError("timed out waiting for audio")
+            if self.error is not None:
+                raise RuntimeError(f"audio stream failed: {self.error}")
+            raise RuntimeError("audio stream closed")
+
+    def read(self, start, numframes, copy=True):
+        """
+        read returns frames [start, start+numframes) of the stream. A view into the buffer
+        is returned when copy is False and the frames are contiguous. Views are only valid
+        until the writer wraps around and overwrites them.
+        """
+        import numpy
+
+        with self.cond:
+            if start + numframes > self.written:
+                raise ValueError("frames have not been written yet")
+            if start < self.written - self.capacity:
+                raise ValueError("frames have already been overwritten")
+            pos = start % self.capacity
+            if pos + numframes <= self.capacity:
+                data = self.data[pos : pos + numframes]
+                return data.copy() if copy else data
+            return numpy.concatenate(
+                [self.data[pos:], self.data[: pos + numframes - self.capacity]]
+            )
+
+    def sample(self, start, numframes, copy=True):
+        data = self.read(start, numframes, copy=copy)
+        return AudioSample(data, self.samplerate, self.timestamp_for_frame(start))
+
+    def last(self, numframes, copy=False):
+        with self.cond:
+            numframes = min(numframes, self.written, self.capacity)
+            return self.sample(self.written - numframes, numframes, copy=copy)
+
+
 class Microphone:
-    def __init__(self, samplerate=48000, channels=1, name=None):
+    """
+    Microphone records audio from the default microphone.
+
+    record opens a new recording for each call. Using a Microphone as a context manager
+    keeps a single input stream running in a background thread which fills a ring buffer
+    holding the most recent buffer_duration seconds of audio. While running, record,
+    stream and last are served from that buffer without gaps between calls.
+    """
+
+    def __init__(self, samplerate=48000, channels=1, name=None, buffer_duration=10.0):
         import soundcard
 
         self.microphone = soundcard.default_microphone()
         self.samplerate = samplerate
         self.channels = channels
         self.name = name
+        self.buffer_duration = buffer_duration
+        self.buffer = None
+        self.thread = None
+        self.need_to_stop = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        if self.buffer is not None:
+            return
+        self.buffer = AudioRingBuffer(
+            int(self.buffer_duration * self.samplerate), self.channels, self.samplerate
+        )
+        self.need_to_stop.clear()
+        self.thread = threading.Thread(target=self._run, args=(self.buffer,), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.buffer is None:
+            return
+        self.need_to_stop.set()
+        self.thread.join()
+        self.thread = None
+        self.buffer = None
+
+    def _run(self, buffer):
+        blocksize = max(1, self.samplerate // STREAM_BLOCKS_PER_SECOND)
+        error = None
+        try:
+            with self.microphone.recorder(
+                samplerate=self.samplerate, channels=self.channels, blocksize=blocksize
+            ) as recorder:
+                while not self.need_to_stop.is_set():
+                    buffer.write(recorder.record(numframes=blocksize))
+        except Exception as exc:
+            logger.exception("microphone stream failed")
+            error = exc
+        finally:
+            buffer.close(error)
 
     def record(self, duration):
+        if self.buffer is not None:
+            numframes = int(duration * self.samplerate)
+            buffer = self.buffer
+            start = buffer.written
+            buffer.wait_for(start + numframes)
+            return buffer.sample(start, numframes)
         timestamp = get_timestamp()
         data = self.microphone.record(
             samplerate=self.samplerate,
@@ -49,9 +339,189 @@ class Microphone:
         )
         return AudioSample(data, self.samplerate, timestamp=timestamp)
 
+    def stream(self, chunk_duration):
+        """
+        stream yields consecutive chunk_duration second AudioSamples without gaps between them.
+        """
+        started = self.buffer is None
+        self.start()
+        buffer = self.buffer
+        numframes = int(chunk_duration * self.samplerate)
+        try:
+            start = buffer.written
+            while True:
+                buffer.wait_for(start + numframes)
+                if start < buffer.written - buffer.capacity:
+                    logger.warning(
+                        "audio stream consumer fell behind. dropping %d frames.",
+                        buffer.written - numframes - start,
+                    )
+                    start = buffer.written - numframes
+                try:
+                    sample = buffer.sample(start, numframes)
+                except ValueError:
+                    # writer overtook us between the checks above. try again.
+                    continue
+                start += numframes
+                yield sample
+        finally:
+            if started:
+                self.stop()
+
+    def last(self, seconds):
+        """
+        last returns the most recent seconds of audio. The data is a view into the ring
+        buffer when possible, so it must be copied if it's needed after the buffer wraps.
+        """
+        if self.buffer is None:
+            raise RuntimeError(
+                "microphone stream is not running. use the Python WITH statement to start it"
+            )
+        # make sure there is at least some audio to return
+        self.buffer.wait_for(1)
+        return self.buffer.last(int(seconds * self.samplerate))
+
+
+STREAM_BLOCKS_PER_SECOND = 50
+
+
+class AudioRecorder:
+    """
+    AudioRecorder writes audio to compressed files while it is being captured.
+
+    Audio is pulled from source.stream(chunk_duration), for example a Microphone, and each
+    chunk is encoded and written as soon as it arrives, so memory use stays bounded by the
+    chunk size regardless of the recording length. When segment_duration is set, a new file
+    is started every segment_duration seconds.
+
+    Each finished segment is passed to plugin.upload_file, if a plugin is provided, and to
+    on_segment(path, timestamp), if provided. Uploaded segments are kept in directory, so the
+    paths returned by record stay valid.
+
+    Examples
+    --------
+
+    ```python
+    with Plugin() as plugin, Microphone() as microphone:
+        # record an hour of audio, uploading a new file every 10 minutes
+        recorder = AudioRecorder(microphone, "recordings", segment_duration=600, plugin=plugin)
+        recorder.record(3600)
+    ```
+    """
+
+    def __init__(
+        self,
+        source,
+        directory=".",
+        format="flac",
+        segment_duration=None,
+        chunk_duration=1.0,
+        plugin=None,
+        meta={},
+        on_segment=None,
+    ):
+        self.source = source
+        self.directory = Path(directory)
+        self.format = format
+        self.segment_duration = segment_duration
+        self.chunk_duration = chunk_duration
+        self.plugin = plugin
+        self.meta = meta
+        self.on_segment = on_segment
+        self.need_to_stop = threading.Event()
+        self.file = None
+
+    def stop(self):
+        """
+        stop asks a running record call to finish its current segment and return.
+        """
+        self.need_to_stop.set()
+
+    def record(self, duration=None):
+        """
+        record captures duration seconds of audio, or until stop is called when duration is
+        None. It returns the paths of all finished segments.
+        """
+        self.need_to_stop.clear()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segments = []
+        remaining = None
+        stream = self.source.stream(self.chunk_duration)
+        try:
+            for sample in stream:
+                data = sample.data
+                if remaining is None and duration is not None:
+                    remaining = int(duration * sample.samplerate)
+                if remaining is not None:
+                    data = data[:remaining]
+                    remaining -= len(data)
+                self._write(data, sample.samplerate, sample.timestamp)
+                if remaining == 0 or self.need_to_stop.is_set():
+                    break
+        finally:
+            stream.close()
+            self._finish_segment()
+        return self.segments
+
+    def _write(self, data, samplerate, timestamp):
+        offset = 0
+        while offset < len(data):
+            if self.file is None:
+                self._start_segment(
+                    data.shape[1] if data.ndim == 2 else 1,
+                    samplerate,
+                    timestamp + (offset * 1_000_000_000) // samplerate,
+                )
+            n = len(data) - offset
+            if self.segment_frames is not None:
+                n = min(n, self.segment_frames - self.file.frames)
+            self.file.write(data[offset : offset + n])
+            offset += n
+            if self.segment_frames is not None and self.file.frames >= self.segment_frames:
+                self._finish_segment()
+
+    def _start_segment(self, channels, samplerate, timestamp):
+        import soundfile
+
+        path = Path(self.directory, f"{timestamp}.{self.format}")
+        self.file = soundfile.SoundFile(
+            str(path), mode="w", samplerate=samplerate, channels=channels
+        )
+        self.file_path = path
+        self.file_timestamp = timestamp
+        self.segment_frames = None
+        if self.segment_duration is not None:
+            self.segment_frames = int(self.segment_duration * samplerate)
+
+    def _finish_segment(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        path, timestamp = self.file_path, self.file_timestamp
+        self.segments.append(path)
+        if self.on_segment is not None:
+            self.on_segment(path, timestamp)
+        if self.plugin is not None:
+            self.plugin.upload_file(path, meta=self.meta, timestamp=timestamp, keep=True)
+
+
+class _AvailableFormats:
+    # descriptor which defers asking soundfile for its formats until they're first needed
+    formats = None
+
+    def __get__(self, obj, objtype=None):
+        if self.formats is None:
+            import soundfile
+
+            self.formats = {
+                "." + s.lower() for s in soundfile.available_formats().keys()
+            }
+        return self.formats
+
 
 class AudioFolder:
-    available_formats = {"." + s.lower() for s in soundfile.available_formats().keys()}
+    available_formats = _AvailableFormats()
 
     def __init__(self, root, shuffle=False):
         self.files = sorted(
@@ -66,9 +536,147 @@ class AudioFolder:
         return len(self.files)
 
     def __getitem__(self, i):
+        """
+        folder[i] reads the entire file i. folder[i, start:stop] reads only frames [start, stop) of file i.
+        """
+        import soundfile
+
+        if isinstance(i, tuple):
+            i, frames = i
+            if not isinstance(frames, slice):
+                raise TypeError(
+                    f"frames must be a slice such as folder[i, start:stop]: {frames!r}"
+                )
+            if frames.step not in (None, 1):
+                raise ValueError(f"frame slices don't support a step: {frames!r}")
+            return self.read(i, frames.start, frames.stop)
         data, samplerate = soundfile.read(str(self.files[i]), always_2d=True)
         timestamp = Path(self.files[i]).stat().st_mtime_ns
         return AudioSample(data, samplerate, timestamp=timestamp)
 
+    def read(self, i, start=None, stop=None, dtype="float64"):
+        """
+        read returns frames [start, stop) of file i without reading the rest of the file.
+        """
+        import soundfile
+
+        with soundfile.SoundFile(str(self.files[i])) as f:
+            start, stop, _ = slice(start, stop).indices(f.frames)
+            f.seek(start)
+            data = f.read(max(0, stop - start), dtype=dtype, always_2d=True)
+            timestamp = self._timestamp_for_frame(i, start, f.samplerate)
+            return AudioSample(data, f.samplerate, timestamp=timestamp)
+
+    def blocks(self, i, blocksize, overlap=0, dtype="float64"):
+        """
+        blocks yields AudioSamples of blocksize frames from file i, each overlapping the
+        previous one by overlap frames. Only one block is held in memory at a time.
+        """
+        import soundfile
+
+        with soundfile.SoundFile(str(self.files[i])) as f:
+            timestamp = self._timestamp_for_frame(i, 0, f.samplerate)
+            start = 0
+            for data in f.blocks(
+                blocksize=blocksize, overlap=overlap, dtype=dtype, always_2d=True
+            ):
+                yield AudioSample(
+                    data,
+                    f.samplerate,
+                    timestamp=timestamp + (start * 1_000_000_000) // f.samplerate,
+                )
+                start += blocksize - overlap
+
+    def memmap(self, i):
+        """
+        memmap returns file i as an AudioSample whose data is memory mapped from disk.
+
+        Only uncompressed 8, 16 and 32-bit PCM and 32 and 64-bit float WAV files are supported.
+        Unlike reading, sample values are left in the file's own dtype, for example int16.
+        """
+        import numpy
+
+        path = self.files[i]
+        layout = read_wav_layout(path)
+        data = numpy.memmap(
+            path,
+            dtype=layout.dtype,
+            mode="r",
+            offset=layout.offset,
+            shape=(layout.frames, layout.channels),
+        )
+        timestamp = self._timestamp_for_frame(i, 0, layout.samplerate)
+        return AudioSample(data, layout.samplerate, timestamp=timestamp)
+
+    def _timestamp_for_frame(self, i, frame, samplerate):
+        timestamp = Path(self.files[i]).stat().st_mtime_ns
+        return timestamp + (frame * 1_000_000_000) // samplerate
+
     def __repr__(self):
         return f"AudioFolder{self.files!r}"
+
+
+class WavLayout(NamedTuple):
+    offset: int
+    dtype: str
+    channels: int
+    frames: int
+    samplerate: int
+
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+wav_dtypes = {
+    (WAVE_FORMAT_PCM, 8): "u1",
+    (WAVE_FORMAT_PCM, 16): "<i2",
+    (WAVE_FORMAT_PCM, 32): "<i4",
+    (WAVE_FORMAT_IEEE_FLOAT, 32): "<f4",
+    (WAVE_FORMAT_IEEE_FLOAT, 64): "<f8",
+}
+
+
+def read_wav_layout(path) -> WavLayout:
+    """
+    read_wav_layout finds where the sample data of an uncompressed WAV file is stored.
+    """
+    size = Path(path).stat().st_size
+    fmt = None
+    with open(path, "rb") as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+            raise ValueError(f"not a wav file: {path}")
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                break
+            chunk_id = chunk[:4]
+            (chunk_size,) = struct.unpack("<I", chunk[4:])
+            if chunk_id == b"fmt ":
+                body = f.read(chunk_size)
+                tag, channels, samplerate, _, blockalign, bits = struct.unpack(
+                    "<HHIIHH", body[:16]
+                )
+                if tag == WAVE_FORMAT_EXTENSIBLE and len(body) >= 26:
+                    (tag,) = struct.unpack("<H", body[24:26])
+                fmt = (tag, channels, samplerate, blockalign, bits)
+            elif chunk_id == b"data":
+                if fmt is None:
+                    break
+                tag, channels, samplerate, blockalign, bits = fmt
+                dtype = wav_dtypes.get((tag, bits))
+                if dtype is None:
+                    raise ValueError(
+                        f"memory mapping is not supported for wav format {tag} with {bits} bits per sample"
+                    )
+                offset = f.tell()
+                # streamed wav files may not have a correct data chunk size
+                frames = min(chunk_size, size - offset) // blockalign
+                return WavLayout(offset, dtype, channels, frames, samplerate)
+            else:
+                f.seek(chunk_size, 1)
+            # chunks are padded to an even size
+            if chunk_size % 2 == 1:
+                f.seek(1, 1)
+    raise ValueError(f"wav file is missing fmt or data chunk: {path}")
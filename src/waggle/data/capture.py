@@ -0,0 +1,245 @@
+import logging
+import threading
+from collections import deque
+from .timestamp import get_timestamp
+from .. import tracing
+
+logger = logging.getLogger(__name__)
+
+
+class FrameBuffer:
+    """
+    FrameBuffer holds the newest frames produced by a capture thread.
+
+    When full, adding a frame drops the oldest one, so consumers always get recent frames.
+    A size of 1 makes it a latest-frame mailbox.
+    """
+
+    def __init__(self, size=1):
+        self.frames = deque(maxlen=size)
+        self.cond = threading.Condition()
+        self.closed = False
+        self.added = 0
+        self.dropped = 0
+
+    def put(self, item):
+        with self.cond:
+            if len(self.frames) == self.frames.maxlen:
+                self.dropped += 1
+            self.frames.append(item)
+            self.added += 1
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.frames or self.closed, timeout):
+                raise TimeoutError("get timed out")
+            if not self.frames:
+                raise RuntimeError("video stream ended")
+            return self.frames.popleft()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class CaptureSubscriber:
+    """
+    CaptureSubscriber receives raw BGR frames from a SharedCapture.
+
+    Continuous subscribers are offered every frame, limited to max_fps if set. Other
+    subscribers are only offered frames grabbed while they are waiting in get, so the
+    shared capture doesn't decode frames nobody asked for.
+    """
+
+    def __init__(self, shared, buffer=1, continuous=True, max_fps=None):
+        self.shared = shared
+        self.frames = FrameBuffer(buffer)
+        self.continuous = continuous
+        self.min_interval = int(1e9 / max_fps) if max_fps else 0
+        self.last_timestamp = None
+        self.waiting = 0
+
+    def wants(self, timestamp):
+        if not (self.continuous or self.waiting > 0):
+            return False
+        if self.last_timestamp is not None and self.min_interval > 0:
+            return timestamp - self.last_timestamp >= self.min_interval
+        return True
+
+    def deliver(self, timestamp, frame):
+        self.last_timestamp = timestamp
+        self.frames.put((timestamp, frame))
+
+    def get(self, timeout=None):
+        """
+        get returns the next (timestamp, frame) tuple.
+        """
+        if self.continuous:
+            return self.frames.get(timeout=timeout)
+        with self.shared.lock:
+            self.waiting += 1
+        try:
+            return self.frames.get(timeout=timeout)
+        finally:
+            with self.shared.lock:
+                self.waiting -= 1
+
+    def close(self):
+        release(self)
+
+
+class SharedCapture:
+    """
+    SharedCapture owns the single upstream video capture for a device and fans frames out
+    to its subscribers from one background thread.
+
+    Frames are only decoded when at least one subscriber wants them. When several
+    subscribers get the same frame, each one after the first receives a copy, so one
+    consumer modifying its frame in place can't affect the others.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.capture = None
+        # NOTE open_lock serializes opening this device without holding up other devices
+        self.open_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.need_to_stop = threading.Event()
+        self.done = threading.Event()
+        self.started = False
+        self.grabbed = 0
+        self.retrieved = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def open(self):
+        import cv2
+
+        capture = cv2.VideoCapture(self.device)
+        if not capture.isOpened():
+            capture.release()
+            raise RuntimeError(f"unable to open video capture for device {self.device!r}")
+        self.capture = capture
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while not self.need_to_stop.is_set():
+                with tracing.span("SharedCapture.grab", "capture"):
+                    ok = self.capture.grab()
+                if not ok:
+                    logger.debug("failed to grab a frame from %r", self.device)
+                    break
+                timestamp = get_timestamp()
+                self.grabbed += 1
+                with self.lock:
+                    subscribers = [s for s in self.subscribers if s.wants(timestamp)]
+                if not subscribers:
+                    continue
+                with tracing.span("SharedCapture.retrieve", "capture"):
+                    ok, frame = self.capture.retrieve()
+                if not ok:
+                    logger.debug("failed to retrieve a frame from %r", self.device)
+                    break
+                self.retrieved += 1
+                subscribers[0].deliver(timestamp, frame)
+                for s in subscribers[1:]:
+                    s.deliver(timestamp, frame.copy())
+        finally:
+            self.capture.release()
+            with _captures_lock:
+                if _captures.get(self.device) is self:
+                    del _captures[self.device]
+                with self.lock:
+                    subscribers = list(self.subscribers)
+            for s in subscribers:
+                s.frames.close()
+            self.done.set()
+
+    def stats(self):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        return {
+            "subscribers": len(subscribers),
+            "frames_grabbed": self.grabbed,
+            "frames_retrieved": self.retrieved,
+            "frames_dropped": sum(s.frames.dropped for s in subscribers),
+        }
+
+
+# process-wide registry of shared captures keyed by resolved device
+_captures = {}
+_captures_lock = threading.Lock()
+
+
+def subscribe(device, buffer=1, continuous=True, max_fps=None) -> CaptureSubscriber:
+    """
+    subscribe returns a new subscriber to the shared capture for device, opening the device
+    if this is its first subscriber.
+    """
+    while True:
+        with _captures_lock:
+            shared = _captures.get(device)
+            if shared is None:
+                shared = _captures[device] = SharedCapture(device)
+
+        # NOTE opening a device can block for seconds, for example on an unreachable RTSP
+        # stream, so it's done outside of the registry lock
+        with shared.open_lock:
+            if shared.capture is None:
+                try:
+                    shared.open()
+                except Exception:
+                    with _captures_lock:
+                        if _captures.get(device) is shared:
+                            del _captures[device]
+                    raise
+
+        subscriber = CaptureSubscriber(shared, buffer, continuous, max_fps)
+        with _captures_lock:
+            # the capture may have been released or reached the end of its stream meanwhile
+            if _captures.get(device) is not shared:
+                continue
+            with shared.lock:
+                shared.subscribers.append(subscriber)
+        # NOTE the capture thread starts with its first subscriber, so no frames are missed
+        shared.start()
+        return subscriber
+
+
+def release(subscriber: CaptureSubscriber, timeout=10.0):
+    """
+    release removes subscriber from its shared capture. The upstream capture is closed once
+    its last subscriber is released.
+    """
+    shared = subscriber.shared
+    with _captures_lock:
+        with shared.lock:
+            if subscriber not in shared.subscribers:
+                return
+            shared.subscribers.remove(subscriber)
+            last = len(shared.subscribers) == 0
+        if last and _captures.get(shared.device) is shared:
+            del _captures[shared.device]
+    subscriber.frames.close()
+    if last:
+        shared.need_to_stop.set()
+        if not shared.done.wait(timeout):
+            logger.warning("timed out waiting for capture %r to stop", shared.device)
+
+
+def capture_stats():
+    """
+    capture_stats returns the stats of all open shared captures keyed by device.
+    """
+    with _captures_lock:
+        captures = list(_captures.values())
+    return {shared.device: shared.stats() for shared in captures}
@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+import re
+import threading
+from pathlib import Path
+from typing import NamedTuple
+
+logger = logging.getLogger(__name__)
+
+WAGGLE_DATA_CONFIG_PATH = Path(
+    os.environ.get("WAGGLE_DATA_CONFIG_PATH", "/run/waggle/data-config.json")
+)
+
+
+class _ConfigState(NamedTuple):
+    key: tuple
+    sections: list
+    patterns: list
+    ids: dict
+    matches: dict
+
+
+def _load_state(path, key):
+    if key is None:
+        logger.debug(
+            "could not find data config file %s. using empty resource list.", path
+        )
+        sections = []
+    else:
+        sections = json.loads(Path(path).read_text())
+    patterns = [
+        {k: re.compile(v) for k, v in section["match"].items()}
+        for section in sections
+    ]
+    ids = {
+        section["match"]["id"]: section
+        for section in sections
+        if "id" in section["match"]
+    }
+    return _ConfigState(key, sections, patterns, ids, {})
+
+
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+class DataConfig:
+    """
+    DataConfig provides cached access to a data config file.
+
+    The file is only parsed again when its mtime, size or inode changes, so lookups
+    are cheap enough to do on every Camera or open_data_source call.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.state = None
+
+    def _get_state(self):
+        key = _stat_key(self.path)
+        state = self.state
+        if state is not None and state.key == key:
+            return state
+        with self.lock:
+            if self.state is None or self.state.key != key:
+                self.state = _load_state(self.path, key)
+            return self.state
+
+    def sections(self):
+        return self._get_state().sections
+
+    def get(self, id):
+        return self._get_state().ids.get(id)
+
+    def find_all_matches(self, query):
+        state = self._get_state()
+        try:
+            cache_key = frozenset(query.items())
+            return list(state.matches[cache_key])
+        except TypeError:
+            return _find_all_matches(state, query)
+        except KeyError:
+            pass
+        matches = _find_all_matches(state, query)
+        state.matches[cache_key] = tuple(matches)
+        return matches
+
+
+def _find_all_matches(state, query):
+    return [
+        section
+        for section, patterns in zip(state.sections, state.patterns)
+        if patterns_match(query, patterns)
+    ]
+
+
+def patterns_match(query, patterns):
+    return all(k in patterns and patterns[k].match(v) for k, v in query.items())
+
+
+_configs = {}
+_configs_lock = threading.Lock()
+
+
+def get_data_config(path=None):
+    """
+    get_data_config returns the shared DataConfig for path. It defaults to WAGGLE_DATA_CONFIG_PATH.
+    """
+    path = Path(path or WAGGLE_DATA_CONFIG_PATH)
+    with _configs_lock:
+        try:
+            return _configs[path]
+        except KeyError:
+            pass
+        config = _configs[path] = DataConfig(path)
+        return config
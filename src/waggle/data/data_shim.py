@@ -1,24 +1,13 @@
 import logging
-import numpy as np
-from urllib.request import urlopen
-from threading import Thread, Event
-from queue import Queue, Empty, Full
 import time
-import os
 import socket
-from pathlib import Path
-import json
-import random
-import re
+from .capture import FrameBuffer, subscribe
+from .config import WAGGLE_DATA_CONFIG_PATH, get_data_config
 
 logger = logging.getLogger(__name__)
 
-try:
-    import cv2
-except ImportError:
-    logger.warning(
-        "cv2 module not found. pywaggle requires this to capture image and video data."
-    )
+# NOTE numpy and cv2 are imported on first use, so importing waggle.data stays cheap for
+# plugins which never open a data source.
 
 
 # BUG This *must* be addressed with the behavior written up in the plugin spec.
@@ -34,59 +23,168 @@ except ImportError:
 
 def cvtColor(bgr_img, pixel_format="rgb"):
     if pixel_format == "rgb":
+        import cv2
+
         return cv2.cvtColor(bgr_img, cv2.COLOR_BGR2RGB)
     return bgr_img
 
 
+class HTTPClient:
+    """
+    HTTPClient repeatedly fetches a single url over a persistent keep-alive connection.
+
+    It remembers the ETag and Last-Modified validators of the last response and sends them
+    as conditional request headers, so an unchanged resource comes back as an empty 304.
+    """
+
+    def __init__(self, url):
+        from urllib.parse import urlsplit
+
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError(f"unsupported url scheme: {url!r}")
+        self.url = url
+        self.scheme = parts.scheme
+        self.hostname = parts.hostname
+        self.port = parts.port
+        self.path = parts.path or "/"
+        if parts.query:
+            self.path += "?" + parts.query
+        self.conn = None
+        self.etag = None
+        self.last_modified = None
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _connection(self, timeout):
+        if self.conn is None:
+            import http.client
+
+            if self.scheme == "https":
+                self.conn = http.client.HTTPSConnection(
+                    self.hostname, self.port, timeout=timeout
+                )
+            else:
+                self.conn = http.client.HTTPConnection(
+                    self.hostname, self.port, timeout=timeout
+                )
+            return self.conn, False
+        self.conn.timeout = timeout
+        if self.conn.sock is not None:
+            self.conn.sock.settimeout(timeout)
+        return self.conn, True
+
+    def get(self, timeout=None):
+        """
+        get returns the response status and body. A status of 304 means the resource has not
+        changed since the last 200 response.
+        """
+        import http.client
+
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+
+        while True:
+            conn, reused = self._connection(timeout)
+            try:
+                conn.request("GET", self.path, headers=headers)
+                resp = conn.getresponse()
+                body = resp.read()
+            except socket.timeout:
+                self.close()
+                raise
+            except (http.client.HTTPException, ConnectionError):
+                self.close()
+                # the server may have closed an idle keep-alive connection. retry once on a fresh one.
+                if reused:
+                    continue
+                raise
+            break
+
+        if resp.will_close:
+            self.close()
+        if resp.status == 200:
+            self.etag = resp.getheader("ETag")
+            self.last_modified = resp.getheader("Last-Modified")
+        elif resp.status != 304:
+            raise RuntimeError(f"failed to get {self.url!r}: http status {resp.status}")
+        return resp.status, body
+
+
 class ImageHandler:
-    def __init__(self, query, url, pixel_format="rgb"):
+    """
+    ImageHandler gets snapshots from an image url.
+
+    Snapshots are fetched over a persistent connection using conditional requests. When the
+    image has not changed since the last get, a copy of the previous image is returned with
+    its timestamp without decoding it again.
+
+    With prefetch enabled, the next snapshot is fetched and decoded in the background while
+    the caller processes the current one.
+    """
+
+    def __init__(self, query, url, pixel_format="rgb", prefetch=False):
         self.url = url
         self.pixel_format = pixel_format
+        self.client = HTTPClient(url)
+        self.last = None
+        self.prefetch = prefetch
+        self.executor = None
+        self.next = None
+        if prefetch:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self.executor = ThreadPoolExecutor(max_workers=1)
 
     def get(self, timeout=None):
+        if not self.prefetch:
+            return self.fetch(timeout)
+
+        from concurrent.futures import TimeoutError as FutureTimeoutError
+
+        if self.next is None:
+            self.next = self.executor.submit(self.fetch, timeout)
         try:
-            with urlopen(self.url, timeout=timeout) as f:
-                data = f.read()
-                ts = time_ns()
-                arr = np.frombuffer(data, np.uint8)
-                bgr_img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-                return ts, cvtColor(bgr_img, self.pixel_format)
+            result = self.next.result(timeout=timeout)
+        except FutureTimeoutError:
+            raise TimeoutError("get timed out")
+        finally:
+            if self.next.done():
+                self.next = None
+        # start fetching the next snapshot while the caller processes this one
+        self.next = self.executor.submit(self.fetch, timeout)
+        return result
+
+    def fetch(self, timeout=None):
+        import cv2
+        import numpy as np
+
+        try:
+            status, data = self.client.get(timeout=timeout)
         except socket.timeout:
             raise TimeoutError("get timed out")
+        ts = time_ns()
+        if status != 304 or self.last is None:
+            arr = np.frombuffer(data, np.uint8)
+            bgr_img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
+            self.last = (ts, cvtColor(bgr_img, self.pixel_format))
+        # NOTE the cached image is never handed out, so callers may modify the images they get
+        last_ts, last_img = self.last
+        return last_ts, last_img.copy()
 
     def __enter__(self):
         return self
 
     def __exit__(self, *exc):
-        pass
-
-
-def video_worker(handler):
-    try:
-        while not handler.quit.is_set():
-            ok, bgr_img = handler.cap.read()
-            if not ok:
-                break
-            img = cvtColor(bgr_img, handler.pixel_format)
-            item = (time_ns(), img)
-
-            # attempt to add an item to the queue
-            try:
-                handler.queue.put_nowait(item)
-                continue
-            except Full:
-                logger.debug("video frame queue full. evicting oldest frame...")
-            # evict an item from queue
-            try:
-                handler.queue.get_nowait()
-            except Empty:
-                pass
-            # queue should have space to add now. (assuming this
-            # is the only producer adding to this queue)
-            handler.queue.put_nowait(item)
-    finally:
-        handler.cap.release()
-        handler.released.set()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        self.client.close()
 
 
 # TODO We need to use a flexible model where the data returned is
@@ -95,54 +193,48 @@ def video_worker(handler):
 
 
 class VideoHandler:
-    def __init__(self, query, url, pixel_format="rgb"):
+    """
+    VideoHandler gets frames from a video stream.
+
+    Streams are opened through the shared capture registry, so all handlers and Cameras
+    using the same url in a process share one upstream connection and decode thread.
+
+    Only the newest buffer frames are kept, so get returns the most recent frame rather
+    than a backlog of stale ones. max_fps limits how often frames are offered to this
+    handler. Frames are stored as raw BGR and converted to pixel_format when returned by get.
+    """
+
+    def __init__(self, query, url, pixel_format="rgb", buffer=1, max_fps=None):
         self.pixel_format = pixel_format
-        self.cap = cv2.VideoCapture(url)
-        if not self.cap.isOpened():
+        try:
+            self.subscriber = subscribe(url, buffer=buffer, max_fps=max_fps)
+        except RuntimeError:
             raise RuntimeError(f'could not open camera at "{url}".')
-        self.queue = Queue(8)
-        self.quit = Event()
-        self.released = Event()
-        # NOTE(sean) no further mutation can be done on VideoHandler state. all
-        # interaction with cap *must* be done in the worker thread or via queue
-        # and quit primitives
-        worker = Thread(target=video_worker, args=(self,), daemon=True)
-        worker.start()
+        self.frames = self.subscriber.frames
+        self.converted = 0
 
     def get(self, timeout=None):
-        try:
-            return self.queue.get(timeout=timeout)
-        except Empty:
-            raise TimeoutError("get timed out")
+        ts, bgr_img = self.frames.get(timeout=timeout)
+        img = cvtColor(bgr_img, self.pixel_format)
+        self.converted += 1
+        return ts, img
+
+    def stats(self):
+        return {
+            "frames_read": self.frames.added,
+            "frames_dropped": self.frames.dropped,
+            "frames_converted": self.converted,
+        }
 
     def __enter__(self):
         return self
 
     def __exit__(self, *exc):
-        self.quit.set()
-        self.released.wait()  # <- wait for cleanup in worker thread
-
-
-WAGGLE_DATA_CONFIG_PATH = Path(
-    os.environ.get("WAGGLE_DATA_CONFIG_PATH", "/run/waggle/data-config.json")
-)
-
-try:
-    config = json.loads(WAGGLE_DATA_CONFIG_PATH.read_text())
-except FileNotFoundError:
-    logger.debug(
-        "could not find data config file %s. using empty resource list.",
-        WAGGLE_DATA_CONFIG_PATH,
-    )
-    config = []
-
-
-def dict_is_subset(a, b):
-    return all(k in b and re.match(b[k], a[k]) for k in a.keys())
+        self.subscriber.close()
 
 
 def find_all_matches(query):
-    return [c for c in config if dict_is_subset(query, c["match"])]
+    return get_data_config(WAGGLE_DATA_CONFIG_PATH).find_all_matches(query)
 
 
 def find_match(query):
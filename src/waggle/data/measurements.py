@@ -1,31 +1,552 @@
-from datetime import datetime
+from bisect import bisect_left
+from datetime import date, datetime, timedelta, timezone
+from operator import itemgetter
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, NamedTuple
+import heapq
 import json
+import logging
+import os
 import time
 
+# NOTE numpy is imported on first use to keep import time low.
+if TYPE_CHECKING:
+    import numpy
+
+logger = logging.getLogger(__name__)
+
 
 class MeasurementsFile:
     def __init__(self, filename):
-        self.records = []
+        self.filename = filename
+        self.source_key = get_source_key(filename)
+        items = []
 
         with open(filename, "r") as f:
             for r in map(json.loads, f):
                 # 2021-06-25T18:52:15.404690128Z
-                r["timestamp"] = datetime.strptime(
-                    r["timestamp"][:26], "%Y-%m-%dT%H:%M:%S.%f"
+                ns = parse_timestamp_ns(r["timestamp"])
+                r["timestamp"] = datetime_from_ns(ns)
+                items.append((ns, r))
+        items.sort(key=itemgetter(0))
+
+        self.records = [r for _, r in items]
+        # nanosecond timestamps of records. datetime only has microsecond precision.
+        self.timestamps = [ns for ns, _ in items]
+
+    def play(self, nodelay=False, speed=1.0):
+        """
+        play yields records with the same relative timing as their timestamps. speed scales
+        the playback rate, so speed=10.0 plays back 10x faster than real time.
+        """
+        return play_records(zip(self.timestamps, self.records), nodelay, speed)
+
+    def replay_into(self, plugin, speed=1.0, nodelay=False, batch_window=0.01):
+        """
+        replay_into publishes records through plugin with their original timestamps, keeping
+        their relative timing scaled by speed. See replay_records for details.
+        """
+        return replay_records(
+            zip(self.timestamps, self.records), plugin, speed, nodelay, batch_window
+        )
+
+    def to_columns(self, names=None, cache=False):
+        """
+        to_columns returns the records as NumPy arrays. See read_columns for details.
+        """
+        if cache:
+            columns = load_cached_columns(self.filename, self.source_key)
+            if columns is None:
+                columns = build_columns(zip(self.timestamps, self.records))
+                save_cached_columns(self.filename, self.source_key, columns)
+        else:
+            columns = build_columns(zip(self.timestamps, self.records))
+        return select_columns(columns, names)
+
+
+class MeasurementsReader:
+    """
+    MeasurementsReader streams records from one or more measurements files without loading
+    them into memory. Unlike MeasurementsFile, record timestamps are integer nanoseconds.
+
+    Each file is expected to already be sorted by timestamp. When multiple files are given,
+    their records are merged into a single timestamp ordered stream.
+
+    Records can be filtered by names, by meta (a dict of required meta values) and to the
+    time range [start, end). start and end may be nanosecond timestamps or timestamp
+    strings. When start is given, a sparse time index of each file is used to seek close to
+    start instead of reading through the preceding records.
+
+    Examples
+    --------
+
+    ```python
+    reader = MeasurementsReader(
+        "node1.ndjson",
+        "node2.ndjson",
+        names=["env.temperature"],
+        meta={"sensor": "bme680"},
+        start="2021-06-25T00:00:00Z",
+    )
+
+    for r in reader:
+        print(r["timestamp"], r["value"])
+    ```
+    """
+
+    def __init__(
+        self,
+        *filenames,
+        names=None,
+        meta=None,
+        start=None,
+        end=None,
+        index_stride=1024 * 1024,
+    ):
+        self.filenames = filenames
+        self.names = set(names) if names is not None else None
+        self.meta = meta
+        self.start = to_timestamp_ns(start)
+        self.end = to_timestamp_ns(end)
+        self.index_stride = index_stride
+        self.indexes = {}
+
+    def __iter__(self):
+        streams = [self.read_file(filename) for filename in self.filenames]
+        if len(streams) == 1:
+            return streams[0]
+        return heapq.merge(*streams, key=itemgetter("timestamp"))
+
+    def play(self, nodelay=False, speed=1.0):
+        """
+        play yields records with the same relative timing as their timestamps. speed scales
+        the playback rate, so speed=10.0 plays back 10x faster than real time.
+        """
+        return play_records(((r["timestamp"], r) for r in self), nodelay, speed)
+
+    def replay_into(self, plugin, speed=1.0, nodelay=False, batch_window=0.01):
+        """
+        replay_into publishes records through plugin with their original timestamps, keeping
+        their relative timing scaled by speed. See replay_records for details.
+        """
+        return replay_records(
+            ((r["timestamp"], r) for r in self), plugin, speed, nodelay, batch_window
+        )
+
+    def index(self, filename):
+        try:
+            return self.indexes[filename]
+        except KeyError:
+            pass
+        index = self.indexes[filename] = SparseTimeIndex(filename, self.index_stride)
+        return index
+
+    def read_file(self, filename):
+        names = self.names
+        meta = self.meta
+        start = self.start
+        end = self.end
+        name_patterns = get_name_patterns(names)
+
+        with open(filename, "rb") as f:
+            if start is not None:
+                f.seek(self.index(filename).offset_for(start))
+
+            for line in f:
+                # skip lines which can't contain any of the names before parsing them
+                if name_patterns is not None and not any(
+                    p in line for p in name_patterns
+                ):
+                    continue
+                if line.isspace():
+                    continue
+                r = json.loads(line)
+                if names is not None and r["name"] not in names:
+                    continue
+                if meta is not None and not meta_matches(r.get("meta", {}), meta):
+                    continue
+                ts = parse_timestamp_ns(r["timestamp"])
+                if start is not None and ts < start:
+                    continue
+                if end is not None and ts >= end:
+                    break
+                r["timestamp"] = ts
+                yield r
+
+
+class SparseTimeIndex:
+    """
+    SparseTimeIndex maps timestamps to byte offsets in a timestamp sorted measurements file.
+
+    It is built by probing one record every stride bytes, so building it only reads a small
+    part of the file.
+    """
+
+    def __init__(self, filename, stride=1024 * 1024):
+        self.offsets = []
+        self.timestamps = []
+        size = Path(filename).stat().st_size
+
+        with open(filename, "rb") as f:
+            for pos in range(0, size, stride):
+                f.seek(pos)
+                # skip the partial line we landed in
+                if pos > 0:
+                    f.readline()
+                offset = f.tell()
+                line = f.readline()
+                while line.isspace():
+                    offset = f.tell()
+                    line = f.readline()
+                if not line:
+                    break
+                if self.offsets and self.offsets[-1] == offset:
+                    continue
+                self.offsets.append(offset)
+                self.timestamps.append(
+                    parse_timestamp_ns(json.loads(line)["timestamp"])
                 )
-                self.records.append(r)
-        self.records.sort(key=lambda r: r["timestamp"])
-
-    def play(self, nodelay=False):
-        if len(self.records) == 0:
-            return
-        last_record = self.records[0]
-        for r in self.records:
-            delta = r["timestamp"] - last_record["timestamp"]
-            if not nodelay:
-                time.sleep(delta.total_seconds())
-            yield r
-            last_record = r
+
+    def offset_for(self, timestamp):
+        """
+        offset_for returns an offset of a record before the first record at or after timestamp.
+        """
+        i = bisect_left(self.timestamps, timestamp) - 1
+        if i < 0:
+            return 0
+        return self.offsets[i]
+
+
+class EncodedColumn(NamedTuple):
+    """
+    EncodedColumn is a dictionary encoded column. Entry i has value categories[codes[i]]
+    or is missing when codes[i] is -1.
+    """
+
+    codes: "numpy.ndarray"
+    categories: list
+
+    def decode(self):
+        return [self.categories[c] if c >= 0 else None for c in self.codes.tolist()]
+
+
+class MeasurementColumns(NamedTuple):
+    # nanosecond timestamps as int64
+    timestamp: "numpy.ndarray"
+    # int64 or float64 for numeric measurements and str otherwise
+    value: "numpy.ndarray"
+    meta: Dict[str, EncodedColumn]
+
+
+def read_columns(filename, names=None, cache=False):
+    """
+    read_columns returns the records of a measurements file as NumPy arrays, keyed by name.
+
+    Each name maps to a MeasurementColumns with timestamp ordered int64 nanosecond
+    timestamps, values and dictionary encoded meta columns. This uses a few bytes per record
+    instead of a dict with datetime objects.
+
+    When cache is True, the columns are saved next to the file as filename.columns.npz and
+    reused until the source file's mtime or size changes, so repeated analysis of the same
+    file skips parsing it entirely. If the cache can't be written, for example because the
+    directory is read only, the columns are still returned.
+    """
+    source_key = get_source_key(filename)
+    columns = None
+    if cache:
+        columns = load_cached_columns(filename, source_key)
+    if columns is None:
+        columns = build_columns(
+            (r["timestamp"], r) for r in MeasurementsReader(filename)
+        )
+        if cache:
+            save_cached_columns(filename, source_key, columns)
+    return select_columns(columns, names)
+
+
+def select_columns(columns, names):
+    if names is None:
+        return columns
+    return {name: columns[name] for name in names if name in columns}
+
+
+def build_columns(items):
+    import numpy
+
+    groups = {}
+    for ts, r in items:
+        try:
+            group = groups[r["name"]]
+        except KeyError:
+            group = groups[r["name"]] = ([], [], [])
+        group[0].append(ts)
+        group[1].append(r["value"])
+        group[2].append(r.get("meta", {}))
+
+    columns = {}
+    for name, (timestamps, values, metas) in groups.items():
+        timestamp = numpy.array(timestamps, dtype=numpy.int64)
+        value = values_to_array(values)
+        meta = {key: encode_column(metas, key) for key in sorted(set().union(*metas))}
+        # records are usually already sorted, so only pay for sorting when needed
+        if len(timestamp) > 1 and numpy.any(timestamp[1:] < timestamp[:-1]):
+            order = numpy.argsort(timestamp, kind="stable")
+            timestamp = timestamp[order]
+            value = value[order]
+            meta = {
+                key: EncodedColumn(col.codes[order], col.categories)
+                for key, col in meta.items()
+            }
+        columns[name] = MeasurementColumns(timestamp, value, meta)
+    return columns
+
+
+def values_to_array(values):
+    import numpy
+
+    if all(isinstance(v, int) for v in values):
+        try:
+            return numpy.array(values, dtype=numpy.int64)
+        except OverflowError:
+            pass
+    if all(isinstance(v, (int, float)) for v in values):
+        return numpy.array(values, dtype=numpy.float64)
+    return numpy.array([str(v) for v in values], dtype=str)
+
+
+def encode_column(metas, key):
+    import numpy
+
+    codes = numpy.empty(len(metas), dtype=numpy.int32)
+    lookup = {}
+    for i, meta in enumerate(metas):
+        v = meta.get(key)
+        if v is None:
+            codes[i] = -1
+            continue
+        try:
+            codes[i] = lookup[v]
+        except KeyError:
+            codes[i] = lookup[v] = len(lookup)
+    return EncodedColumn(codes, list(lookup))
+
+
+def get_source_key(filename):
+    st = os.stat(filename)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def get_columns_cache_path(filename):
+    return Path(str(filename) + ".columns.npz")
+
+
+def save_cached_columns(filename, source_key, columns):
+    import numpy
+
+    arrays = {
+        "source": numpy.array(source_key, dtype=numpy.int64),
+        "names": numpy.array(list(columns), dtype=str),
+    }
+    for i, col in enumerate(columns.values()):
+        arrays[f"{i}.timestamp"] = col.timestamp
+        arrays[f"{i}.value"] = col.value
+        arrays[f"{i}.meta"] = numpy.array(list(col.meta), dtype=str)
+        for j, enc in enumerate(col.meta.values()):
+            arrays[f"{i}.meta.{j}.codes"] = enc.codes
+            arrays[f"{i}.meta.{j}.categories"] = numpy.array(enc.categories, dtype=str)
+
+    path = get_columns_cache_path(filename)
+    tmp = path.with_name(path.name + ".tmp")
+    try:
+        with open(tmp, "wb") as f:
+            numpy.savez(f, **arrays)
+        os.replace(tmp, path)
+    except OSError as exc:
+        # NOTE the cache is only an optimization, so failing to write it isn't an error
+        logger.warning("failed to save cached columns to %s: %s", path, exc)
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+def load_cached_columns(filename, source_key):
+    import numpy
+
+    path = get_columns_cache_path(filename)
+    try:
+        data = numpy.load(path, allow_pickle=False)
+    except (FileNotFoundError, ValueError, OSError):
+        return None
+    with data:
+        if tuple(data["source"].tolist()) != tuple(source_key):
+            return None
+        columns = {}
+        for i, name in enumerate(data["names"].tolist()):
+            meta = {}
+            for j, key in enumerate(data[f"{i}.meta"].tolist()):
+                meta[key] = EncodedColumn(
+                    data[f"{i}.meta.{j}.codes"],
+                    data[f"{i}.meta.{j}.categories"].tolist(),
+                )
+            columns[name] = MeasurementColumns(
+                data[f"{i}.timestamp"], data[f"{i}.value"], meta
+            )
+        return columns
+
+
+class ReplayClock:
+    """
+    ReplayClock maps record timestamps to deadlines on the monotonic clock.
+
+    Every deadline is computed from the same anchor, so sleep overshoot does not accumulate
+    over a long replay the way sleeping for each inter-record delta does.
+    """
+
+    def __init__(self, start_timestamp, speed=1.0):
+        if speed <= 0:
+            raise ValueError("speed must be positive")
+        self.start_timestamp = start_timestamp
+        self.speed = speed
+        self.anchor = time.monotonic()
+
+    def deadline(self, timestamp):
+        return self.anchor + (timestamp - self.start_timestamp) / 1e9 / self.speed
+
+    def wait_until(self, timestamp):
+        delay = self.deadline(timestamp) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def play_records(items, nodelay=False, speed=1.0):
+    """
+    play_records yields records from timestamp ordered (timestamp, record) items, waiting
+    until each one is due when replayed at speed.
+    """
+    clock = None
+    for ts, r in items:
+        if not nodelay:
+            if clock is None:
+                clock = ReplayClock(ts, speed)
+            clock.wait_until(ts)
+        yield r
+
+
+def replay_records(items, plugin, speed=1.0, nodelay=False, batch_window=0.01):
+    """
+    replay_records publishes records from timestamp ordered (timestamp, record) items
+    through plugin.
+
+    Records due within batch_window seconds of replay time of each other are published
+    together as one batch when the first of them is due, which keeps high rate replays from
+    waking up for every record. Records using the reserved upload name are skipped.
+
+    It returns the number of records published.
+    """
+    clock = None
+    batch = []
+    batch_deadline = None
+    published = 0
+
+    for ts, r in items:
+        if clock is None:
+            clock = ReplayClock(ts, speed)
+        if batch and (nodelay or clock.deadline(ts) - batch_deadline > batch_window):
+            published += publish_batch(plugin, clock, batch, nodelay)
+            batch = []
+        if not batch:
+            batch_deadline = clock.deadline(ts)
+        batch.append((ts, r))
+
+    if batch:
+        published += publish_batch(plugin, clock, batch, nodelay)
+    return published
+
+
+def publish_batch(plugin, clock, batch, nodelay):
+    if not nodelay:
+        clock.wait_until(batch[0][0])
+    published = 0
+    for ts, r in batch:
+        if r["name"] == "upload":
+            logger.debug("skipping replay of upload record %s", r)
+            continue
+        plugin.publish(r["name"], r["value"], meta=r.get("meta", {}), timestamp=ts)
+        published += 1
+    return published
+
+
+def get_name_patterns(names):
+    if names is None:
+        return None
+    # NOTE non-ascii names may be written either as raw utf-8 or as \u escapes in either
+    # case, so we can't prefilter lines for them and parse every line instead
+    try:
+        for name in names:
+            name.encode("ascii")
+    except UnicodeEncodeError:
+        return None
+    return [json.dumps(name).encode() for name in names]
+
+
+def meta_matches(meta, query):
+    return all(meta.get(k) == v for k, v in query.items())
+
+
+def to_timestamp_ns(ts):
+    if ts is None or isinstance(ts, int):
+        return ts
+    if isinstance(ts, datetime):
+        # naive datetimes are treated as UTC, like the ones in MeasurementsFile records
+        if ts.tzinfo is not None:
+            ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+        return (ts - EPOCH) // timedelta(microseconds=1) * 1000
+    return parse_timestamp_ns(ts)
+
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+EPOCH = datetime(1970, 1, 1)
+
+
+def parse_timestamp_ns(s: str) -> int:
+    """
+    parse_timestamp_ns parses an RFC3339 timestamp like 2021-06-25T18:52:15.404690128Z to
+    nanoseconds since epoch without losing precision. Timestamps without an offset are UTC.
+    """
+    try:
+        if s[4] != "-" or s[7] != "-" or s[13] != ":" or s[16] != ":":
+            raise ValueError
+        days = date(int(s[0:4]), int(s[5:7]), int(s[8:10])).toordinal() - EPOCH_ORDINAL
+        seconds = (
+            days * 86400 + int(s[11:13]) * 3600 + int(s[14:16]) * 60 + int(s[17:19])
+        )
+        nanos = 0
+        i = 19
+        n = len(s)
+        if i < n and s[i] == ".":
+            # fast path for the common 2021-06-25T18:52:15.404690128Z form
+            if s[-1] == "Z":
+                j = n - 1
+            else:
+                j = i + 1
+                while j < n and s[j].isdigit():
+                    j += 1
+            digits = s[i + 1 : j]
+            nanos = int(digits[:9].ljust(9, "0"))
+            i = j
+        if i < n and s[i] in "+-":
+            offset = int(s[i + 1 : i + 3]) * 3600 + int(s[i + 4 : i + 6]) * 60
+            seconds += -offset if s[i] == "+" else offset
+        elif i < n and s[i] not in "Zz":
+            raise ValueError
+    except (ValueError, IndexError):
+        raise ValueError(f"invalid timestamp: {s!r}")
+    return seconds * 1_000_000_000 + nanos
+
+
+def datetime_from_ns(ns: int) -> datetime:
+    return EPOCH + timedelta(microseconds=ns // 1000)
 
 
 # MessagePlayer can take a SDR format file and replay the contents
@@ -1,20 +1,24 @@
-import cv2
 from pathlib import Path
-import numpy
-from typing import Union
+from typing import TYPE_CHECKING, NamedTuple, Union
 import os
 from os import PathLike
 import random
-import json
+from concurrent.futures import Future, ThreadPoolExecutor
 import re
 import threading
-import time
 from base64 import b64encode
 from .timestamp import get_timestamp
+from .. import tracing
+from .capture import subscribe
+from .config import WAGGLE_DATA_CONFIG_PATH, get_data_config
 from shutil import which
-import ffmpeg
 import logging
 
+# NOTE cv2, ffmpeg and numpy are imported on first use. they add hundreds of milliseconds
+# to import time which short lived plugins that never touch a camera shouldn't pay for.
+if TYPE_CHECKING:
+    import numpy
+
 logger = logging.getLogger(__name__)
 
 
@@ -31,52 +35,141 @@ class BGR:
 class RGB:
     @classmethod
     def cv2_to_format(cls, data):
+        import cv2
+
         return cv2.cvtColor(data, cv2.COLOR_BGR2RGB)
 
     @classmethod
     def format_to_cv2(cls, data):
-        return cv2.cvtColor(data, cv2.COLOR_RGB2BGR)
-
-
-WAGGLE_DATA_CONFIG_PATH = Path(
-    os.environ.get("WAGGLE_DATA_CONFIG_PATH", "/run/waggle/data-config.json")
-)
-
+        import cv2
 
-def read_device_config(path):
-    config = json.loads(Path(path).read_text())
-    return {
-        section["match"]["id"]: section
-        for section in config
-        if "id" in section["match"]
-    }
+        return cv2.cvtColor(data, cv2.COLOR_RGB2BGR)
 
 
 # TODO use format spec like rgb vs bgr in config file
 class ImageSample:
-    data: numpy.ndarray
+    data: "numpy.ndarray"
     timestamp: int
     format: Union[BGR, RGB]
 
     def __init__(self, data, timestamp, format):
         self.format = format
-        self.data = self.format.cv2_to_format(data)
+        with tracing.span("ImageSample.convert", "vision"):
+            self.data = self.format.cv2_to_format(data)
         self.timestamp = timestamp
 
     def save(self, path: PathLike):
+        import cv2
+
         path = Path(path)
         data = self.format.format_to_cv2(self.data)
         cv2.imwrite(str(path), data)
 
-    def _repr_html_(self):
+    def encode(self, ext=".jpg", jpeg_quality=None, png_compression=None) -> bytes:
+        """
+        encode returns the image encoded in the format given by ext (for example, ".jpg" or ".png").
+        """
+        import cv2
+
         data = self.format.format_to_cv2(self.data)
-        ok, buf = cv2.imencode(".png", data)
+        params = get_encode_params(ext, jpeg_quality, png_compression)
+        ok, buf = cv2.imencode(ext, data, params)
         if not ok:
             raise RuntimeError("could not encode image")
-        b64data = b64encode(buf.ravel()).decode()
+        return buf.tobytes()
+
+    def _repr_html_(self):
+        b64data = b64encode(self.encode(".png")).decode()
         return f'<img src="data:image/png;base64,{b64data}" />'
 
 
+def get_encode_params(ext, jpeg_quality=None, png_compression=None):
+    import cv2
+
+    ext = ext.lower()
+    if ext in (".jpg", ".jpeg") and jpeg_quality is not None:
+        return [cv2.IMWRITE_JPEG_QUALITY, int(jpeg_quality)]
+    if ext == ".png" and png_compression is not None:
+        return [cv2.IMWRITE_PNG_COMPRESSION, int(png_compression)]
+    return []
+
+
+class ImageWriter:
+    """
+    ImageWriter encodes and writes ImageSamples using a bounded pool of background threads.
+
+    save and encode return a Future right away. Once max_pending images are queued or in
+    progress, they block until a slot frees up, so a fast capture loop cannot build up an
+    unbounded backlog of frames in memory.
+
+    Samples must not be modified after being passed to the writer.
+
+    Examples
+    --------
+
+    ```python
+    with Camera() as camera, ImageWriter(workers=2, jpeg_quality=90) as writer:
+        for i, sample in enumerate(camera.stream()):
+            writer.save(sample, f"frames/{i:06d}.jpg")
+    ```
+    """
+
+    def __init__(
+        self, workers=2, max_pending=None, jpeg_quality=None, png_compression=None
+    ):
+        self.jpeg_quality = jpeg_quality
+        self.png_compression = png_compression
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = threading.BoundedSemaphore(max_pending or 2 * workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def save(self, sample: ImageSample, path: PathLike) -> Future:
+        """
+        save queues sample to be encoded and written to path. The image format is chosen from the path suffix.
+        """
+        return self._submit(self._save, sample, Path(path))
+
+    def encode(self, sample: ImageSample, ext=".jpg") -> Future:
+        """
+        encode queues sample to be encoded in memory. The returned Future resolves to the encoded bytes.
+        """
+        return self._submit(self._encode, sample, ext)
+
+    def _submit(self, fn, *args):
+        # block the caller when the pool is saturated
+        self.pending.acquire()
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self.pending.release()
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future):
+        self.pending.release()
+
+    def _encode(self, sample, ext):
+        return sample.encode(ext, self.jpeg_quality, self.png_compression)
+
+    def _save(self, sample, path):
+        data = self._encode(sample, path.suffix)
+        with open(path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+            f.write(data)
+        return path
+
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
 class VideoSample:
     path: str
     timestamp: int
@@ -88,6 +181,8 @@ class VideoSample:
         self.capture = None
 
     def __enter__(self):
+        import cv2
+
         self.capture = cv2.VideoCapture(self.path)
         if not self.capture.isOpened():
             raise RuntimeError(
@@ -145,8 +240,7 @@ def resolve_device_from_path(path):
 
 
 def resolve_device_from_data_config(device):
-    config = read_device_config(WAGGLE_DATA_CONFIG_PATH)
-    section = config.get(device)
+    section = get_data_config(WAGGLE_DATA_CONFIG_PATH).get(device)
     if section is None:
         raise KeyError(f"no device found {device!r}")
     try:
@@ -160,8 +254,7 @@ class Camera:
 
     def __init__(self, device=0, format=RGB):
         self.capture = _Capture(resolve_device(device), format)
-        match = re.match(r"([A-Za-z0-9]+)://(.*)$", device)
-        if match is not None and match.group(1) == "file":
+        if is_file_device(device):
             self.input_type = self.INPUT_TYPE_FILE
         else:
             self.input_type = self.INPUT_TYPE_OTHER
@@ -182,91 +275,205 @@ class Camera:
         with self.capture:
             return self.capture.snapshot()
 
-    def stream(self):
+    def stream(self, governor=None):
+        """
+        stream yields samples from the camera. If governor is set, the stream is throttled to
+        the rate allowed by the governor, including the time spent processing each sample.
+        """
         with self.capture:
-            yield from self.capture.stream()
+            for sample in self.capture.stream():
+                yield sample
+                if governor is not None:
+                    governor.throttle()
 
     def record(self, duration, file_path="./sample.mp4", skip_second=1):
         return self.capture.record(duration, file_path, skip_second)
 
 
+def is_file_device(device):
+    if isinstance(device, Path):
+        return True
+    if not isinstance(device, str):
+        return False
+    match = re.match(r"([A-Za-z0-9]+)://(.*)$", device)
+    return match is not None and match.group(1) == "file"
+
+
+class CameraGroupSample(NamedTuple):
+    samples: tuple
+    # timestamp of the earliest grab in the group
+    timestamp: int
+    # per camera grab time offset from timestamp in nanoseconds
+    skew: tuple
+
+    @property
+    def max_skew(self):
+        return max(self.skew)
+
+
+class CameraGroup:
+    """
+    CameraGroup captures time aligned frames from several cameras.
+
+    Each camera is driven by its own thread. On every snapshot, all threads are released
+    at once to grab a frame and then decode it in parallel, so the frames are taken as close
+    together as possible and the total latency is roughly that of the slowest camera.
+
+    Examples
+    --------
+
+    ```python
+    with CameraGroup(["left_camera", "right_camera"]) as cameras:
+        for group in cameras.stream():
+            left, right = group.samples
+            print("frames were grabbed within", group.max_skew, "ns")
+    ```
+    """
+
+    def __init__(self, devices, format=RGB, timeout=10.0):
+        self.captures = [_Capture(resolve_device(device), format) for device in devices]
+        self.timeout = timeout
+        self.threads = []
+
+    def __len__(self):
+        return len(self.captures)
+
+    def __enter__(self):
+        opened = []
+        try:
+            for capture in self.captures:
+                capture.enable_daemon = False
+                capture.__enter__()
+                opened.append(capture)
+        except Exception:
+            for capture in opened:
+                capture.__exit__(None, None, None)
+            raise
+        self.trigger = threading.Barrier(len(self.captures) + 1)
+        self.done = threading.Barrier(len(self.captures) + 1)
+        self.results = [None] * len(self.captures)
+        self.need_to_stop = False
+        self.threads = [
+            threading.Thread(target=self._run, args=(i,), daemon=True)
+            for i in range(len(self.captures))
+        ]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.need_to_stop = True
+        # release any workers waiting on the next trigger
+        self.trigger.abort()
+        for thread in self.threads:
+            thread.join(timeout=self.timeout)
+        self.threads = []
+        for capture in self.captures:
+            capture.__exit__(exc_type, exc_val, exc_tb)
+
+    def _run(self, i):
+        capture = self.captures[i]
+        try:
+            while True:
+                self.trigger.wait()
+                if self.need_to_stop:
+                    return
+                try:
+                    timestamp = capture.grab()
+                    self.results[i] = capture.retrieve(timestamp)
+                except Exception as exc:
+                    self.results[i] = exc
+                self.done.wait()
+        except threading.BrokenBarrierError:
+            pass
+
+    def snapshot(self) -> CameraGroupSample:
+        if not self.threads:
+            with self:
+                return self.snapshot()
+        try:
+            self.trigger.wait(timeout=self.timeout)
+            self.done.wait(timeout=self.timeout)
+        except threading.BrokenBarrierError:
+            raise RuntimeError("failed to grab frames from camera group: timed out")
+        for capture, result in zip(self.captures, self.results):
+            if isinstance(result, Exception):
+                raise RuntimeError(
+                    f"failed to grab a frame from device {capture.device!r}: {result}"
+                )
+        samples = tuple(self.results)
+        timestamp = min(sample.timestamp for sample in samples)
+        skew = tuple(sample.timestamp - timestamp for sample in samples)
+        return CameraGroupSample(samples, timestamp, skew)
+
+    def stream(self):
+        with self:
+            while True:
+                try:
+                    group = self.snapshot()
+                except RuntimeError:
+                    return
+                yield group
+
+
 class _Capture:
     def __init__(self, device, format):
         self.device = device
         self.format = format
         self.context_depth = 0
         self.enable_daemon = False
-        self.daemon_need_to_stop = threading.Event()
-        self._ready_for_next_frame = threading.Event()
-        self.daemon = threading.Thread(target=self._run, daemon=True)
-        self.lock = threading.Lock()
+        self.subscriber = None
 
     def __enter__(self):
         if self.context_depth == 0:
-            self.capture = cv2.VideoCapture(self.device)
-            if not self.capture.isOpened():
-                raise RuntimeError(
-                    f"unable to open video capture for device {self.device!r}"
-                )
-            # spin up a thread to keep up with the camera frame rate
+            # keep up with the camera frame rate using the shared capture for the device. this
+            # also lets other Cameras and data sources in this process reuse the same stream.
             if self.enable_daemon:
-                self.daemon_need_to_stop.clear()
-                self.daemon.start()
+                self.subscriber = subscribe(self.device, continuous=False)
+            else:
+                import cv2
+
+                self.capture = cv2.VideoCapture(self.device)
+                if not self.capture.isOpened():
+                    raise RuntimeError(
+                        f"unable to open video capture for device {self.device!r}"
+                    )
         self.context_depth += 1
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.context_depth -= 1
         if self.context_depth == 0:
-            if self.enable_daemon:
-                self.daemon_need_to_stop.set()
-            self.capture.release()
-    
-    def _run(self):
-        # we sleep slighly shorter than FPS to drain the buffer efficiently
-        # NOTE: OpenCV's FPS get function is inaccurate as a USB webcam gives 1 FPS while
-        #       a RTSP stream returns 180000. none of them are correct. therefore, we cannot
-        #       decide the sleep time based on obtained FPS
-        # fps = self.capture.get(cv2.CAP_PROP_FPS)
-        sleep = 0.01
-        # if fps > 0 and fps < 100:
-        #    sleep = 1 / (fps + 1)
-        # logging.debug(f'camera FPS is {fps}. the background thread sleeps {sleep} seconds in between grab()')
-        while not self.daemon_need_to_stop.is_set():
-            try:
-                self.lock.acquire()
-                ok = self.capture.grab()
-                if not ok:
-                    raise RuntimeError("failed to grab a frame")
-                self.timestamp = get_timestamp()
-            finally:
-                self.lock.release()
-            self._ready_for_next_frame.set()
-            time.sleep(sleep)
+            if self.subscriber is not None:
+                self.subscriber.close()
+                self.subscriber = None
+            else:
+                self.capture.release()
+
+    def grab(self):
+        with tracing.span("Camera.grab", "vision"):
+            ok = self.capture.grab()
+        if not ok:
+            raise RuntimeError("failed to take a snapshot")
+        return get_timestamp()
+
+    def retrieve(self, timestamp):
+        with tracing.span("Camera.retrieve", "vision"):
+            ok, data = self.capture.retrieve()
+        if not ok:
+            raise RuntimeError("failed to retrieve the taken snapshot")
+        return ImageSample(data=data, timestamp=timestamp, format=self.format)
 
     def grab_frame(self):
-        if self.daemon.is_alive():
-            if not self._ready_for_next_frame.wait(timeout=10.):
-                raise RuntimeError("failed to grab a frame from the background thread: timed out")
-            self._ready_for_next_frame.clear()
+        if self.subscriber is not None:
             try:
-                self.lock.acquire(timeout=1)
-                timestamp = self.timestamp
-                ok, data = self.capture.retrieve()
-                if not ok:
-                    raise RuntimeError("failed to retrieve the taken snapshot")
-            finally:
-                self.lock.release()
+                with tracing.span("Camera.wait", "vision"):
+                    timestamp, data = self.subscriber.get(timeout=10.0)
+            except TimeoutError:
+                raise RuntimeError("failed to grab a frame from the background thread: timed out")
             return ImageSample(data=data, timestamp=timestamp, format=self.format)
         else:
-            ok = self.capture.grab()
-            if not ok:
-                raise RuntimeError("failed to take a snapshot")
-            timestamp = get_timestamp()
-            ok, data = self.capture.retrieve()
-            if not ok:
-                raise RuntimeError("failed to retrieve the taken snapshot")
-            return ImageSample(data=data, timestamp=timestamp, format=self.format)
+            return self.retrieve(self.grab())
 
     def snapshot(self):
         return self.grab_frame()
@@ -279,6 +486,8 @@ class _Capture:
             pass
 
     def record(self, duration, file_path="./sample.mp4", skip_second=1):
+        import ffmpeg
+
         if which("ffmpeg") == None:
             raise RuntimeError("ffmpeg does not exist to record video. please install ffmpeg")
         if self.context_depth > 0:
@@ -314,6 +523,8 @@ class ImageFolder:
         return len(self.files)
 
     def __getitem__(self, i):
+        import cv2
+
         data = cv2.imread(str(self.files[i]))
         timestamp = Path(self.files[i]).stat().st_mtime_ns
         return ImageSample(data=data, timestamp=timestamp, format=self.format)
@@ -2,3 +2,4 @@ from .config import PluginConfig
 from .plugin import Plugin
 from .uploader import Uploader
 from .time import get_timestamp
+from .shared import open_shared
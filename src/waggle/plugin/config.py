@@ -4,11 +4,20 @@ from typing import NamedTuple
 class PluginConfig(NamedTuple):
     """
     PluginConfig represents the config required to setup and run a Plugin.
+
+    The transport selects how messages are moved and may be "rabbitmq", "memory" or
+    "unix:///path/to/sock". The encoding may be "json", which sends each message on its own,
+    or "batch", which packs messages into compact binary batches. The remaining fields are
+    only used by the rabbitmq transport, which compresses bodies of at least
+    compression_threshold bytes when compression is set to "zlib", "lzma" or "zstd".
     """
 
-    # TODO generalize to support different backends
     username: str
     password: str
     host: str
     port: int
     app_id: str
+    transport: str = "rabbitmq"
+    encoding: str = "json"
+    compression: str = ""
+    compression_threshold: int = 4096
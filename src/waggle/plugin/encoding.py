@@ -0,0 +1,400 @@
+import struct
+
+import wagglemsg
+
+# NOTE batches use a compact binary envelope instead of one JSON body per message. the
+# envelope is msgpack encoded and stores each distinct name, meta key and meta value once
+# per batch in a string table which messages refer to by index. timestamps are stored
+# relative to the first message in the batch.
+#
+# [version, strings, base_timestamp, [[name_index, timestamp_delta, value, [key_index, value_index, ...]], ...]]
+BATCH_CONTENT_TYPE = "application/vnd.waggle.batch+msgpack"
+BATCH_VERSION = 1
+
+# max number of messages and time in seconds the publisher waits to fill a batch
+BATCH_MAX_MESSAGES = 1000
+BATCH_LINGER = 0.5
+
+# default min body size in bytes before compression is attempted. smaller bodies rarely
+# compress well enough to make up for the cost.
+DEFAULT_COMPRESSION_THRESHOLD = 4096
+
+COMPRESSION_ALGORITHMS = ["zlib", "lzma", "zstd"]
+
+_float64 = struct.Struct(">d")
+_float32 = struct.Struct(">f")
+
+
+def packb(obj) -> bytes:
+    """
+    packb encodes obj as msgpack. Only None, bool, int, float, str, bytes, lists, tuples and
+    dicts are supported.
+    """
+    out = bytearray()
+    _pack(obj, out)
+    return bytes(out)
+
+
+def _pack(obj, out: bytearray):
+    if obj is None:
+        out.append(0xC0)
+    elif obj is True:
+        out.append(0xC3)
+    elif obj is False:
+        out.append(0xC2)
+    elif isinstance(obj, int):
+        _pack_int(obj, out)
+    elif isinstance(obj, float):
+        out.append(0xCB)
+        out += _float64.pack(obj)
+    elif isinstance(obj, str):
+        data = obj.encode()
+        n = len(data)
+        if n < 32:
+            out.append(0xA0 | n)
+        elif n < 0x100:
+            out += struct.pack(">BB", 0xD9, n)
+        elif n < 0x10000:
+            out += struct.pack(">BH", 0xDA, n)
+        else:
+            out += struct.pack(">BI", 0xDB, n)
+        out += data
+    elif isinstance(obj, (bytes, bytearray)):
+        n = len(obj)
+        if n < 0x100:
+            out += struct.pack(">BB", 0xC4, n)
+        elif n < 0x10000:
+            out += struct.pack(">BH", 0xC5, n)
+        else:
+            out += struct.pack(">BI", 0xC6, n)
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        n = len(obj)
+        if n < 16:
+            out.append(0x90 | n)
+        elif n < 0x10000:
+            out += struct.pack(">BH", 0xDC, n)
+        else:
+            out += struct.pack(">BI", 0xDD, n)
+        for item in obj:
+            _pack(item, out)
+    elif isinstance(obj, dict):
+        n = len(obj)
+        if n < 16:
+            out.append(0x80 | n)
+        elif n < 0x10000:
+            out += struct.pack(">BH", 0xDE, n)
+        else:
+            out += struct.pack(">BI", 0xDF, n)
+        for k, v in obj.items():
+            _pack(k, out)
+            _pack(v, out)
+    else:
+        raise TypeError(f"unsupported type for packb: {type(obj)!r}")
+
+
+def _pack_int(n: int, out: bytearray):
+    if 0 <= n < 0x80:
+        out.append(n)
+    elif -32 <= n < 0:
+        out.append(n & 0xFF)
+    elif n >= 0:
+        if n < 0x100:
+            out += struct.pack(">BB", 0xCC, n)
+        elif n < 0x10000:
+            out += struct.pack(">BH", 0xCD, n)
+        elif n < 0x100000000:
+            out += struct.pack(">BI", 0xCE, n)
+        elif n < 0x10000000000000000:
+            out += struct.pack(">BQ", 0xCF, n)
+        else:
+            raise OverflowError(f"int too large to pack: {n}")
+    else:
+        if n >= -0x80:
+            out += struct.pack(">Bb", 0xD0, n)
+        elif n >= -0x8000:
+            out += struct.pack(">Bh", 0xD1, n)
+        elif n >= -0x80000000:
+            out += struct.pack(">Bi", 0xD2, n)
+        elif n >= -0x8000000000000000:
+            out += struct.pack(">Bq", 0xD3, n)
+        else:
+            raise OverflowError(f"int too small to pack: {n}")
+
+
+# fixed size formats by type byte
+_fixed_formats = {
+    0xCC: struct.Struct(">B"),
+    0xCD: struct.Struct(">H"),
+    0xCE: struct.Struct(">I"),
+    0xCF: struct.Struct(">Q"),
+    0xD0: struct.Struct(">b"),
+    0xD1: struct.Struct(">h"),
+    0xD2: struct.Struct(">i"),
+    0xD3: struct.Struct(">q"),
+    0xCA: _float32,
+    0xCB: _float64,
+}
+
+# length prefix formats by type byte for str, bin, array and map types
+_length_formats = {
+    0xD9: (struct.Struct(">B"), "str"),
+    0xDA: (struct.Struct(">H"), "str"),
+    0xDB: (struct.Struct(">I"), "str"),
+    0xC4: (struct.Struct(">B"), "bin"),
+    0xC5: (struct.Struct(">H"), "bin"),
+    0xC6: (struct.Struct(">I"), "bin"),
+    0xDC: (struct.Struct(">H"), "array"),
+    0xDD: (struct.Struct(">I"), "array"),
+    0xDE: (struct.Struct(">H"), "map"),
+    0xDF: (struct.Struct(">I"), "map"),
+}
+
+
+def unpackb(data: bytes):
+    """
+    unpackb decodes a msgpack encoded object produced by packb. It raises ValueError if data
+    is truncated, has trailing bytes or uses an unsupported type.
+    """
+    try:
+        obj, offset = _unpack(memoryview(data), 0)
+    except (IndexError, struct.error):
+        raise ValueError("truncated msgpack data")
+    if offset != len(data):
+        raise ValueError("trailing bytes after msgpack data")
+    return obj
+
+
+def _unpack(data, offset):
+    b = data[offset]
+    offset += 1
+    if b < 0x80:
+        return b, offset
+    if b >= 0xE0:
+        return b - 0x100, offset
+    if 0x80 <= b <= 0x8F:
+        return _unpack_map(data, offset, b & 0x0F)
+    if 0x90 <= b <= 0x9F:
+        return _unpack_array(data, offset, b & 0x0F)
+    if 0xA0 <= b <= 0xBF:
+        return _unpack_str(data, offset, b & 0x1F)
+    if b == 0xC0:
+        return None, offset
+    if b == 0xC2:
+        return False, offset
+    if b == 0xC3:
+        return True, offset
+    if b in _fixed_formats:
+        fmt = _fixed_formats[b]
+        (value,) = fmt.unpack_from(data, offset)
+        return value, offset + fmt.size
+    if b in _length_formats:
+        fmt, kind = _length_formats[b]
+        (n,) = fmt.unpack_from(data, offset)
+        offset += fmt.size
+        if kind == "str":
+            return _unpack_str(data, offset, n)
+        if kind == "bin":
+            return _unpack_bin(data, offset, n)
+        if kind == "array":
+            return _unpack_array(data, offset, n)
+        return _unpack_map(data, offset, n)
+    raise ValueError(f"unsupported msgpack type byte: {b:#x}")
+
+
+def _unpack_str(data, offset, n):
+    end = offset + n
+    if end > len(data):
+        raise ValueError("truncated msgpack data")
+    return bytes(data[offset:end]).decode(), end
+
+
+def _unpack_bin(data, offset, n):
+    end = offset + n
+    if end > len(data):
+        raise ValueError("truncated msgpack data")
+    return bytes(data[offset:end]), end
+
+
+def _unpack_array(data, offset, n):
+    items = []
+    for _ in range(n):
+        item, offset = _unpack(data, offset)
+        items.append(item)
+    return items, offset
+
+
+def _unpack_map(data, offset, n):
+    obj = {}
+    for _ in range(n):
+        k, offset = _unpack(data, offset)
+        v, offset = _unpack(data, offset)
+        obj[k] = v
+    return obj, offset
+
+
+def can_batch(msg) -> bool:
+    """
+    can_batch returns whether msg can be encoded in a batch. Ints outside of msgpack's 64 bit
+    range can't be and must be sent as json instead.
+    """
+    value = msg.value
+    return not isinstance(value, int) or -(2**63) <= value < 2**64
+
+
+def encode_batch(messages) -> bytes:
+    """
+    encode_batch packs a list of wagglemsg.Message into a single batch body.
+    """
+    if len(messages) == 0:
+        raise ValueError("batch must contain at least one message")
+
+    strings = []
+    index = {}
+
+    def intern(s):
+        try:
+            return index[s]
+        except KeyError:
+            i = index[s] = len(strings)
+            strings.append(s)
+            return i
+
+    base = messages[0].timestamp
+    items = []
+    for msg in messages:
+        meta = []
+        for k, v in msg.meta.items():
+            meta.append(intern(k))
+            meta.append(intern(v))
+        items.append([intern(msg.name), msg.timestamp - base, msg.value, meta])
+    return packb([BATCH_VERSION, strings, base, items])
+
+
+def decode_batch(body: bytes) -> list:
+    """
+    decode_batch unpacks and validates a batch body into a list of wagglemsg.Message. It
+    raises ValueError if the batch is malformed.
+    """
+    batch = unpackb(body)
+    if not isinstance(batch, list) or len(batch) != 4:
+        raise ValueError("batch must be an array of 4 items")
+    version, strings, base, items = batch
+    if version != BATCH_VERSION:
+        raise ValueError(f"unsupported batch version: {version!r}")
+    if not isinstance(strings, list) or not all(isinstance(s, str) for s in strings):
+        raise ValueError("batch string table must be an array of strings")
+    if not isinstance(base, int) or not isinstance(items, list):
+        raise ValueError("batch must have an int base timestamp and an array of messages")
+
+    def lookup(i):
+        if not isinstance(i, int) or not 0 <= i < len(strings):
+            raise ValueError(f"batch string index out of range: {i!r}")
+        return strings[i]
+
+    messages = []
+    for item in items:
+        if not isinstance(item, list) or len(item) != 4:
+            raise ValueError("batch message must be an array of 4 items")
+        name, delta, value, meta = item
+        if not isinstance(delta, int):
+            raise ValueError("batch message timestamp must be an int")
+        # NOTE bools are accepted, as Plugin.publish allows them and json encoding keeps them
+        if not isinstance(value, (int, float, str)):
+            raise ValueError("batch message value must be a bool, int, float or str")
+        if not isinstance(meta, list) or len(meta) % 2 != 0:
+            raise ValueError("batch message meta must be an array of key, value indices")
+        messages.append(
+            wagglemsg.Message(
+                name=lookup(name),
+                value=value,
+                timestamp=base + delta,
+                meta={lookup(meta[i]): lookup(meta[i + 1]) for i in range(0, len(meta), 2)},
+            )
+        )
+    return messages
+
+
+def get_compressor(algorithm: str):
+    """
+    get_compressor returns the compress function for algorithm, which is also used as the
+    message's content_encoding. zstd requires the optional zstandard module.
+    """
+    if algorithm == "zlib":
+        import zlib
+
+        return zlib.compress
+    if algorithm == "lzma":
+        import lzma
+
+        return lzma.compress
+    if algorithm == "zstd":
+        import zstandard
+
+        return zstandard.ZstdCompressor().compress
+    raise ValueError(f"unsupported compression algorithm: {algorithm!r}")
+
+
+def decompress_body(body: bytes, content_encoding: str) -> bytes:
+    """
+    decompress_body decompresses a message body compressed by Compressor according to its
+    content_encoding. Bodies with other content encodings are returned unchanged. It raises
+    ValueError if the body is corrupt.
+    """
+    try:
+        if content_encoding == "zlib":
+            import zlib
+
+            return zlib.decompress(body)
+        if content_encoding == "lzma":
+            import lzma
+
+            return lzma.decompress(body)
+        if content_encoding == "zstd":
+            import zstandard
+
+            return zstandard.ZstdDecompressor().decompress(body)
+    except ValueError:
+        raise
+    except Exception as exc:
+        raise ValueError(f"failed to decompress {content_encoding} body: {exc}")
+    return body
+
+
+class Compressor:
+    """
+    Compressor compresses message bodies of at least threshold bytes using algorithm. Bodies
+    which don't get smaller are sent as is.
+    """
+
+    def __init__(self, algorithm: str, threshold=DEFAULT_COMPRESSION_THRESHOLD):
+        self.algorithm = algorithm
+        self.threshold = threshold
+        self.compress = get_compressor(algorithm)
+        self.compressed = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+
+    def __call__(self, body):
+        """
+        __call__ returns the body to send and its content_encoding, or None if the body
+        was left uncompressed.
+        """
+        if len(body) < self.threshold:
+            return body, None
+        if isinstance(body, str):
+            body = body.encode()
+        compressed = self.compress(body)
+        if len(compressed) >= len(body):
+            return body, None
+        self.compressed += 1
+        self.input_bytes += len(body)
+        self.output_bytes += len(compressed)
+        return compressed, self.algorithm
+
+    def stats(self, prefix: str) -> dict:
+        return {
+            f"{prefix}.compressed": self.compressed,
+            f"{prefix}.compressed_input_bytes": self.input_bytes,
+            f"{prefix}.compressed_output_bytes": self.output_bytes,
+        }
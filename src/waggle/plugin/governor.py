@@ -0,0 +1,275 @@
+import logging
+import os
+from pathlib import Path
+from threading import Event, Lock, local
+from time import monotonic, process_time
+
+from .stats import SYSTEM_METRICS_PREFIX
+from .time import get_timestamp
+
+logger = logging.getLogger(__name__)
+
+# default time in seconds between governor measurements and adjustments
+DEFAULT_GOVERNOR_INTERVAL = 1.0
+
+# lowest fraction of the full rate the governor will throttle down to
+DEFAULT_MIN_SCALE = 0.05
+
+# NOTE each adjustment may at most halve or increase the scale by 25%, so the governor backs
+# off quickly when over budget but ramps up gently. adjustments smaller than the deadband are
+# ignored to avoid changing the rate on every measurement.
+MAX_DECREASE = 0.5
+MAX_INCREASE = 1.25
+DEADBAND = 0.1
+
+
+def read_system_cpu_times(path="/proc/stat"):
+    """
+    read_system_cpu_times returns the busy and total CPU time in clock ticks summed over all
+    cores, or None if unavailable.
+    """
+    try:
+        with open(path) as f:
+            fields = f.readline().split()
+    except OSError:
+        return None
+    if not fields or fields[0] != "cpu":
+        return None
+    # user nice system idle iowait irq softirq steal ...
+    ticks = [int(x) for x in fields[1:9]]
+    idle = sum(ticks[3:5])
+    total = sum(ticks)
+    return total - idle, total
+
+
+def read_process_cpu_seconds(pid="self", root="/proc"):
+    """
+    read_process_cpu_seconds returns the user and system CPU time in seconds used by all threads
+    of process pid, or None if unavailable.
+    """
+    try:
+        data = Path(root, str(pid), "stat").read_text()
+    except OSError:
+        return None
+    # NOTE the command name may contain spaces and parens, so we parse after the last paren
+    fields = data.rsplit(")", 1)[-1].split()
+    # utime and stime are the 14th and 15th fields
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def read_temperature(root="/sys/class/thermal"):
+    """
+    read_temperature returns the highest temperature in degrees C over all thermal zones, or
+    None if unavailable.
+    """
+    temps = []
+    for path in Path(root).glob("thermal_zone*/temp"):
+        try:
+            temps.append(int(path.read_text()) / 1000)
+        except (OSError, ValueError):
+            continue
+    return max(temps, default=None)
+
+
+class Governor:
+    """
+    Governor adapts the rate of capture, inference and sampling loops to keep a plugin within a
+    CPU budget and below a max temperature.
+
+    cpu_budget is the fraction of the node's total CPU (over all cores) the plugin, including its
+    worker processes, should use. Every interval seconds, the governor measures the plugin's
+    usage from /proc, the node's temperature from /sys/class/thermal and, if max_system_cpu is
+    set, the node's total CPU load. It then adjusts scale, the fraction of the full rate loops
+    should run at. Loops apply the scale by calling throttle, admit or interval.
+
+    Examples
+    --------
+
+    ```python
+    with Plugin() as plugin, Camera() as camera:
+        governor = plugin.govern(cpu_budget=0.25, max_temperature=75)
+        for sample in camera.stream(governor=governor):
+            detect(sample)
+    ```
+    """
+
+    def __init__(
+        self,
+        cpu_budget: float,
+        max_temperature=None,
+        max_system_cpu=None,
+        interval=DEFAULT_GOVERNOR_INTERVAL,
+        min_scale=DEFAULT_MIN_SCALE,
+        publish=None,
+        stop: Event = None,
+    ):
+        if not 0 < cpu_budget <= 1:
+            raise ValueError("cpu_budget must be in (0, 1]")
+        if max_system_cpu is not None and not 0 < max_system_cpu <= 1:
+            raise ValueError("max_system_cpu must be in (0, 1]")
+        if not 0 < min_scale <= 1:
+            raise ValueError("min_scale must be in (0, 1]")
+        self.cpu_budget = cpu_budget
+        self.max_temperature = max_temperature
+        self.max_system_cpu = max_system_cpu
+        self.interval_seconds = interval
+        self.min_scale = min_scale
+        self.publish = publish
+        self.stop = stop or Event()
+        self.cpu_count = os.cpu_count() or 1
+        self.lock = Lock()
+        self.local = local()
+        self.scale = 1.0
+        self.reason = "start"
+        self.cpu = 0.0
+        self.system_cpu = None
+        self.temperature = None
+        self.adjustments = 0
+        self.throttled_seconds = 0.0
+        self.skipped = 0
+        self.credits = {}
+        self.last_update = monotonic()
+        self.last_system_times = read_system_cpu_times()
+        self.last_process_times = self.__read_process_times()
+
+    def poll(self) -> float:
+        """
+        poll updates the scale if interval seconds have passed since the last update and
+        returns it.
+        """
+        if monotonic() - self.last_update >= self.interval_seconds:
+            self.update()
+        return self.scale
+
+    def update(self):
+        """
+        update measures CPU usage and temperature since the last update and adjusts the scale.
+        """
+        with self.lock:
+            now = monotonic()
+            elapsed = now - self.last_update
+            # NOTE another thread may have just updated, so short measurements are skipped
+            if elapsed <= 0 or elapsed < self.interval_seconds:
+                return
+            self.last_update = now
+            self.__measure(elapsed)
+            target, reason = self.__target()
+            target = min(max(target, self.scale * MAX_DECREASE), self.scale * MAX_INCREASE)
+            target = min(max(target, self.min_scale), 1.0)
+            if target == self.scale:
+                return
+            # always allow reaching the limits, even by small steps
+            small = abs(target - self.scale) <= DEADBAND * self.scale
+            if small and target not in (1.0, self.min_scale):
+                return
+            logger.debug("governor scale %.3f -> %.3f (%s)", self.scale, target, reason)
+            self.scale = target
+            self.reason = reason
+            self.adjustments += 1
+
+        if self.publish is not None:
+            self.publish(
+                f"{SYSTEM_METRICS_PREFIX}.governor.scale",
+                target,
+                {"reason": reason},
+                get_timestamp(),
+            )
+
+    def throttle(self):
+        """
+        throttle duty cycles a loop by sleeping after each iteration, so the loop only runs for
+        a scale fraction of the time. It should be called once per iteration.
+        """
+        now = monotonic()
+        last = getattr(self.local, "last_throttle", None)
+        scale = self.poll()
+        if last is not None and scale < 1.0:
+            delay = (now - last) * (1 / scale - 1)
+            self.stop.wait(delay)
+            with self.lock:
+                self.throttled_seconds += delay
+        self.local.last_throttle = monotonic()
+
+    def admit(self, key=None) -> bool:
+        """
+        admit returns whether a periodic call identified by key should run, so that only a
+        scale fraction of calls run. Skipped calls are counted.
+        """
+        scale = self.poll()
+        with self.lock:
+            credit = self.credits.get(key, 1.0)
+            admitted = credit >= 1.0 - 1e-9
+            if admitted:
+                credit -= 1.0
+            else:
+                self.skipped += 1
+            self.credits[key] = credit + scale
+        return admitted
+
+    def interval(self, base: float) -> float:
+        """
+        interval returns base stretched by the current scale, for loops which sleep between
+        samples.
+        """
+        return base / self.poll()
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = {
+                "governor.scale": self.scale,
+                "governor.cpu": self.cpu,
+                "governor.adjustments": self.adjustments,
+                "governor.throttled_seconds": self.throttled_seconds,
+                "governor.skipped": self.skipped,
+            }
+            if self.system_cpu is not None:
+                stats["governor.system_cpu"] = self.system_cpu
+            if self.temperature is not None:
+                stats["governor.temperature"] = self.temperature
+            return stats
+
+    def __target(self):
+        # NOTE thermal and system limits take priority, since exceeding them hurts every plugin
+        # on the node, not just this one
+        if self.max_temperature is not None and self.temperature is not None:
+            if self.temperature >= self.max_temperature:
+                return self.scale * MAX_DECREASE, "thermal"
+        if self.max_system_cpu is not None and self.system_cpu is not None:
+            if self.system_cpu >= self.max_system_cpu:
+                return self.scale * MAX_DECREASE, "system"
+        if self.cpu <= 0:
+            return 1.0, "headroom"
+        target = self.scale * self.cpu_budget / self.cpu
+        return target, "cpu" if target < self.scale else "headroom"
+
+    def __measure(self, elapsed):
+        process_times = self.__read_process_times()
+        used = 0.0
+        for pid, seconds in process_times.items():
+            used += max(seconds - self.last_process_times.get(pid, 0.0), 0.0)
+        self.last_process_times = process_times
+        self.cpu = used / (elapsed * self.cpu_count)
+
+        system_times = read_system_cpu_times()
+        if system_times is not None and self.last_system_times is not None:
+            busy = system_times[0] - self.last_system_times[0]
+            total = system_times[1] - self.last_system_times[1]
+            if total > 0:
+                self.system_cpu = busy / total
+        self.last_system_times = system_times
+
+        self.temperature = read_temperature()
+
+    def __read_process_times(self) -> dict:
+        import multiprocessing
+
+        times = {}
+        seconds = read_process_cpu_seconds()
+        # fallback for platforms without /proc
+        times["self"] = process_time() if seconds is None else seconds
+        # include worker processes, such as those used by Plugin.map
+        for child in multiprocessing.active_children():
+            seconds = read_process_cpu_seconds(child.pid)
+            if seconds is not None:
+                times[child.pid] = seconds
+        return times
@@ -4,15 +4,21 @@ import wagglemsg
 
 from contextlib import contextmanager
 from datetime import datetime
-from os import getenv
+from os import cpu_count, getenv
 from pathlib import Path
 from queue import Queue, Empty
-from threading import Event
+from threading import Event, Lock, local
 from typing import NamedTuple
 
+from .. import tracing
 from .config import PluginConfig
-from .rabbitmq import RabbitMQPublisher, RabbitMQConsumer
+from .encoding import COMPRESSION_ALGORITHMS, DEFAULT_COMPRESSION_THRESHOLD
 from .time import get_timestamp, timeit_perf_counter, timeit_perf_counter_duration
+from .scheduler import Scheduler
+from .shared import DEFAULT_SHARED_TTL
+from .stats import SYSTEM_METRICS_PREFIX, StatsReporter, get_capture_stats
+from .timings import SUMMARY_FIELDS, Timings
+from .transport import get_transport
 from .uploader import Uploader
 
 
@@ -22,6 +28,12 @@ logger = logging.getLogger(__name__)
 class PublishData(NamedTuple):
     scope: str
     body: bytes
+    # trace clock time the message was queued, if tracing is enabled
+    enqueued: int = 0
+    # message to be encoded by the publisher when batch encoding is used. body is None.
+    message: wagglemsg.Message = None
+    # message name, for transports which route by name without decoding the body
+    name: str = ""
 
 
 # Nanoseconds since epoch for 2000-01-01T00:00:00Z
@@ -95,17 +107,56 @@ class Plugin:
     with Plugin() as plugin:
         plugin.publish("test_value", 99)
     ```
+
+    Setting stats_interval (or the PYWAGGLE_STATS_INTERVAL env var) to a number of seconds
+    periodically publishes the plugin's runtime stats from stats() under sys.plugin.*.
+
+    Timing a hot loop with aggregate=True records durations in memory and only publishes
+    summary stats every timings_interval seconds:
+
+    ```python
+    with Plugin(timings_interval=30.0) as plugin:
+        for sample in camera.stream():
+            with plugin.timeit("detect.duration", aggregate=True):
+                detect(sample)
+    ```
     """
 
     def __init__(
-        self, config=None, uploader=None, file_publisher: FilesystemPublisher = None
+        self,
+        config=None,
+        uploader=None,
+        file_publisher: FilesystemPublisher = None,
+        timings_interval=60.0,
+        stats_interval=None,
     ):
         self.config = config or get_default_plugin_config()
+        self.transport = get_transport(self.config.transport)
+        if self.config.encoding not in ("json", "batch"):
+            raise ValueError(f"unsupported plugin encoding: {self.config.encoding!r}")
+        self.batch_encoding = self.config.encoding == "batch"
+        if self.config.compression not in ("", *COMPRESSION_ALGORITHMS):
+            raise ValueError(f"unsupported plugin compression: {self.config.compression!r}")
         self.uploader = uploader or get_default_plugin_uploader()
         self.send = Queue()
         self.recv = Queue()
         self.stop = Event()
         self.tasks = []
+        self.aggregated_timings = Timings(timings_interval)
+        self.publisher = None
+        self.consumers = []
+        self.stats_lock = Lock()
+        self.published = 0
+        self.published_bytes = 0
+        self.shared_pool = None
+        self.governor = None
+        self.scheduler = Scheduler()
+        # per thread state of the scheduler tick being run, if any
+        self.tick = local()
+
+        if stats_interval is None and getenv("PYWAGGLE_STATS_INTERVAL") is not None:
+            stats_interval = float(getenv("PYWAGGLE_STATS_INTERVAL"))
+        self.stats_interval = stats_interval
 
         # TODO(sean) can we use ExitStack to clean up???
 
@@ -115,12 +166,27 @@ class Plugin:
             self.file_publisher = FilesystemPublisher(getenv("PYWAGGLE_LOG_DIR"))
 
     def __enter__(self):
-        self.tasks.append(RabbitMQPublisher(self.config, self.send, self.stop))
+        self.publisher = self.transport.publisher(self.config, self.send, self.stop)
+        self.tasks.append(self.publisher)
+
+        if self.stats_interval:
+            self.tasks.append(
+                StatsReporter(self.stats, self.__publish, self.stats_interval, self.stop)
+            )
         return self
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
+        # publish any aggregated timings from the last partial window before shutting down
+        self.publish_timings()
+
         self.stop.set()
 
+        if self.shared_pool is not None:
+            self.shared_pool.close()
+
+        if tracing.enabled:
+            tracing.dump()
+
         if self.file_publisher is not None:
             self.file_publisher.close()
 
@@ -128,7 +194,9 @@ class Plugin:
             task.done.wait()
 
     def subscribe(self, *topics):
-        self.tasks.append(RabbitMQConsumer(topics, self.config, self.recv, self.stop))
+        consumer = self.transport.consumer(topics, self.config, self.recv, self.stop)
+        self.consumers.append(consumer)
+        self.tasks.append(consumer)
         # TODO(sean) add mock or integration testing against rabbitmq to actually test this
 
     def get(self, timeout=None):
@@ -141,8 +209,9 @@ class Plugin:
     def publish(self, name, value, meta={}, timestamp=None, scope="all", timeout=None):
         # get timestamp before doing other work
         timestamp = timestamp or get_timestamp()
-        raise_for_invalid_publish_name(name)
-        self.__publish(name, value, meta, timestamp, scope, timeout)
+        with tracing.span("Plugin.publish", "plugin"):
+            raise_for_invalid_publish_name(name)
+            self.__publish(name, value, meta, timestamp, scope, timeout)
 
     # NOTE __publish is used internally by publish and upload_file to do an unchecked
     # message publish. the main reason this exists is to guard against reserved names
@@ -167,7 +236,81 @@ class Plugin:
             self.file_publisher.publish(msg)
 
         logger.debug("adding message to outgoing queue: %s", msg)
-        self.send.put(PublishData(scope, wagglemsg.dump(msg)), timeout=timeout)
+        enqueued = tracing.now() if tracing.enabled else 0
+        if self.batch_encoding:
+            # NOTE the publisher encodes queued messages together, so we skip the json here
+            item = PublishData(scope, None, enqueued, msg, name)
+            body = None
+        else:
+            body = wagglemsg.dump(msg)
+            item = PublishData(scope, body, enqueued, name=name)
+
+        # messages published by scheduled tasks are queued together at the end of the tick
+        tick_messages = getattr(self.tick, "messages", None)
+        if tick_messages is not None:
+            tick_messages.append(item)
+        else:
+            self.send.put(item, timeout=timeout)
+        with self.stats_lock:
+            self.published += 1
+            if body is not None:
+                self.published_bytes += len(body)
+
+    def stats(self) -> dict:
+        """
+        stats returns a snapshot of the plugin's runtime stats. This includes the send and
+        recv queue depths, messages published, transport publish latency and connection
+        health, uploads and stats for any shared cameras open in this process.
+
+        Latencies are in nanoseconds and counters are totals since the plugin was created.
+        """
+        with self.stats_lock:
+            stats = {
+                "send.queue_depth": self.send.qsize(),
+                "recv.queue_depth": self.recv.qsize(),
+                "publish.count": self.published,
+                "publish.bytes": self.published_bytes,
+            }
+        if self.publisher is not None:
+            stats.update(self.publisher.stats())
+        for consumer in self.consumers:
+            for key, value in consumer.stats().items():
+                stats[key] = stats.get(key, 0) + value
+        # NOTE custom uploaders may not provide stats
+        uploader_stats = getattr(self.uploader, "stats", None)
+        if uploader_stats is not None:
+            stats.update(uploader_stats())
+        if self.shared_pool is not None:
+            stats.update(self.shared_pool.stats())
+        if self.governor is not None:
+            stats.update(self.governor.stats())
+        stats.update(self.scheduler.stats())
+        stats["captures"] = get_capture_stats()
+        return stats
+
+    def publish_shared(
+        self, name, data, meta={}, timestamp=None, scope="node", ttl=DEFAULT_SHARED_TTL
+    ):
+        """
+        publish_shared publishes a large binary payload, such as a frame or tensor, to plugins
+        on the same node. The payload is copied into a shared memory segment and only a small
+        descriptor is published under name. Consumers read it using waggle.plugin.open_shared.
+        The descriptor is only meaningful on this node, so it's published with node scope.
+
+        data may be bytes or a numpy array. The payload can be opened for ttl seconds, or until
+        the plugin exits, after which it is released. Shared payloads require Python 3.8 or
+        later.
+        """
+        # get timestamp before doing other work
+        timestamp = timestamp or get_timestamp()
+        raise_for_invalid_publish_name(name)
+        from .shared import SharedMemoryPool, dump_shared_descriptor
+
+        if self.shared_pool is None:
+            self.shared_pool = SharedMemoryPool()
+        with tracing.span("Plugin.publish_shared", "plugin"):
+            descriptor = self.shared_pool.create(data, ttl=ttl)
+        self.__publish(name, dump_shared_descriptor(descriptor), meta, timestamp, scope)
 
     def upload_file(self, path, meta={}, timestamp=None, keep=False):
         # get timestamp before doing other work
@@ -184,8 +327,210 @@ class Plugin:
             )
             self.__publish("upload", upload_path.name, meta, timestamp)
 
+    def map(
+        self,
+        fn,
+        source,
+        workers=None,
+        mode="thread",
+        ordered=True,
+        max_in_flight=None,
+        governor=None,
+    ):
+        """
+        map runs fn on each sample from source using a pool of workers and publishes the results
+        through this plugin. It returns the number of results published once source is exhausted.
+
+        source may be any iterable, such as an ImageFolder or AudioFolder, or an object with a
+        stream method, such as a Camera. fn may return None, a (name, value) or
+        (name, value, meta) tuple or a list of these. Results are published with the sample's
+        timestamp, if it has one.
+
+        mode selects a "thread" or "process" pool. Process pools sidestep the GIL for CPU bound
+        work but require fn and samples to be picklable. At most max_in_flight samples (by default,
+        twice the number of workers) are pulled from source before their results are published.
+        If ordered is False, results are published as soon as they complete. If governor is set,
+        samples are pulled from source at the rate allowed by the governor.
+
+        Examples
+        --------
+
+        ```python
+        def count_cars(sample):
+            return "cars.total", len(detect_cars(sample.data))
+
+        with Plugin() as plugin, Camera() as camera:
+            plugin.map(count_cars, camera, workers=4, mode="process")
+        ```
+        """
+        from concurrent.futures import (
+            FIRST_COMPLETED,
+            ProcessPoolExecutor,
+            ThreadPoolExecutor,
+            wait,
+        )
+
+        if workers is None:
+            workers = cpu_count() or 1
+        if max_in_flight is None:
+            max_in_flight = 2 * workers
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+
+        if mode == "thread":
+            executor = ThreadPoolExecutor(max_workers=workers)
+        elif mode == "process":
+            executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            raise ValueError(f"map mode must be \"thread\" or \"process\": {mode!r}")
+
+        if hasattr(source, "stream") and not hasattr(source, "__iter__"):
+            source = source.stream()
+
+        # NOTE pending maps futures to their samples in submission order
+        pending = {}
+        published = 0
+
+        def publish_next():
+            nonlocal published
+            if ordered:
+                done = [next(iter(pending))]
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                sample = pending.pop(future)
+                published += self.__publish_map_results(sample, future.result())
+
+        with executor:
+            try:
+                for sample in source:
+                    pending[executor.submit(fn, sample)] = sample
+                    while len(pending) >= max_in_flight:
+                        publish_next()
+                    if governor is not None:
+                        governor.throttle()
+                while pending:
+                    publish_next()
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+        return published
+
+    def __publish_map_results(self, sample, results) -> int:
+        if results is None:
+            return 0
+        if isinstance(results, tuple):
+            results = [results]
+        timestamp = getattr(sample, "timestamp", None)
+        if not isinstance(timestamp, int):
+            timestamp = None
+        for result in results:
+            if not isinstance(result, tuple) or len(result) not in (2, 3):
+                raise TypeError(
+                    f"map results must be (name, value) or (name, value, meta) tuples: {result!r}"
+                )
+            name, value, *meta = result
+            self.publish(name, value, meta=meta[0] if meta else {}, timestamp=timestamp)
+        return len(results)
+
+    def every(self, interval, fn, align=True, governor=None):
+        """
+        every schedules fn to be called every interval seconds by run and returns the task,
+        which may be cancelled using task.cancel().
+
+        If align is True, calls happen on wall clock boundaries which are multiples of the
+        interval. For example, every(60, fn) calls fn at the top of each minute. Otherwise,
+        the first call happens as soon as run starts. Calls never drift, and if fn overruns
+        one or more intervals, the missed calls are skipped and counted as overruns.
+
+        If governor is set, calls are skipped as needed to run at the rate allowed by the
+        governor, which keeps the remaining calls aligned.
+        """
+        return self.scheduler.every(interval, fn, align=align, governor=governor)
+
+    def run(self, duration=None):
+        """
+        run calls the functions scheduled by every from the current thread until the plugin
+        exits, duration seconds have passed or all tasks are cancelled. Messages published by
+        tasks which run at the same time are queued together once they have all finished.
+
+        Examples
+        --------
+
+        ```python
+        with Plugin() as plugin:
+            plugin.every(30, lambda: plugin.publish("env.temperature", read_temperature()))
+            plugin.every(300, lambda: plugin.publish("sys.disk_free", read_disk_free()))
+            plugin.run()
+        ```
+        """
+        self.scheduler.run(self.stop, duration=duration, run_tick=self.__run_tick)
+
+    def govern(self, cpu_budget, max_temperature=None, max_system_cpu=None, **kwargs):
+        """
+        govern creates the plugin's Governor, which adapts the rate of loops it is passed to,
+        such as Camera.stream, map and every, to keep the plugin within cpu_budget, a fraction
+        of the node's total CPU, and below max_temperature in degrees C. If max_system_cpu is
+        set, the plugin also backs off while the node's total CPU load exceeds it.
+
+        The governor's rate changes are published as sys.plugin.governor.scale, with the
+        reason in its meta, and its measurements are included in stats().
+
+        Examples
+        --------
+
+        ```python
+        with Plugin() as plugin, Camera() as camera:
+            governor = plugin.govern(cpu_budget=0.25, max_temperature=75)
+            plugin.map(detect, camera.stream(governor=governor), workers=2)
+        ```
+        """
+        from .governor import Governor
+
+        if self.governor is not None:
+            raise RuntimeError("plugin already has a governor")
+        self.governor = Governor(
+            cpu_budget,
+            max_temperature=max_temperature,
+            max_system_cpu=max_system_cpu,
+            publish=self.__publish,
+            stop=self.stop,
+            **kwargs,
+        )
+        return self.governor
+
+    def __run_tick(self, tasks):
+        self.tick.messages = []
+        try:
+            with tracing.span("Plugin.tick", "plugin"):
+                for task in tasks:
+                    task.fn()
+        finally:
+            messages = self.tick.messages
+            self.tick.messages = None
+            for item in messages:
+                self.send.put(item)
+
     @contextmanager
-    def timeit(self, name):
+    def timeit(self, name, aggregate=False):
+        if aggregate:
+            # NOTE the aggregated path skips debug logging and only publishes when the
+            # reporting window is due, so it is cheap enough to leave on in hot loops
+            if name not in self.aggregated_timings.window:
+                # NOTE summaries are published under suffixed names, so we check those up
+                # front rather than failing when the window is flushed
+                raise_for_invalid_publish_name(name)
+                for field in SUMMARY_FIELDS:
+                    raise_for_invalid_publish_name(f"{name}.{field}")
+            start = timeit_perf_counter()
+            yield
+            finish = timeit_perf_counter()
+            duration = timeit_perf_counter_duration(start, finish)
+            if self.aggregated_timings.record(name, duration):
+                self.publish_timings()
+            return
+
         logger.debug("starting timeit block %s", name)
         start = timeit_perf_counter()
         yield
@@ -194,6 +539,23 @@ class Plugin:
         self.publish(name, duration)
         logger.debug("finished timeit block %s", name)
 
+    def publish_timings(self, timestamp=None):
+        """
+        publish_timings publishes the summary stats of durations aggregated by timeit since
+        the last call as name.count, name.mean, name.p50, name.p95, name.p99 and name.max.
+        """
+        timestamp = timestamp or get_timestamp()
+        for name, summary in self.aggregated_timings.flush().items():
+            for field in SUMMARY_FIELDS:
+                self.publish(f"{name}.{field}", getattr(summary, field), timestamp=timestamp)
+
+    def timings(self):
+        """
+        timings returns the summary stats of all durations aggregated by timeit over the
+        lifetime of the plugin, keyed by name.
+        """
+        return self.aggregated_timings.summaries()
+
 
 def get_default_plugin_config() -> PluginConfig:
     return PluginConfig(
@@ -202,6 +564,12 @@ def get_default_plugin_config() -> PluginConfig:
         host=getenv("WAGGLE_PLUGIN_HOST", "rabbitmq"),
         port=int(getenv("WAGGLE_PLUGIN_PORT", 5672)),
         app_id=getenv("WAGGLE_APP_ID", ""),
+        transport=getenv("WAGGLE_PLUGIN_TRANSPORT", "rabbitmq"),
+        encoding=getenv("WAGGLE_PLUGIN_ENCODING", "json"),
+        compression=getenv("WAGGLE_PLUGIN_COMPRESSION", ""),
+        compression_threshold=int(
+            getenv("WAGGLE_PLUGIN_COMPRESSION_THRESHOLD", DEFAULT_COMPRESSION_THRESHOLD)
+        ),
     )
 
 
@@ -228,6 +596,10 @@ def raise_for_invalid_publish_name(s: str):
         raise ValueError(f"publish must be at most 128 characters: {s!r}")
     if s == "upload":
         raise ValueError(f"name {s!r} is reserved for system use only")
+    if s == SYSTEM_METRICS_PREFIX or s.startswith(SYSTEM_METRICS_PREFIX + "."):
+        raise ValueError(
+            f"names under {SYSTEM_METRICS_PREFIX!r} are reserved for system use only: {s!r}"
+        )
     parts = s.split(".")
     for p in parts:
         if not publish_name_part_pattern.match(p):
@@ -5,7 +5,21 @@ import time
 import pika
 import pika.exceptions
 import wagglemsg
+from .. import tracing
 from .config import PluginConfig
+from .encoding import (
+    BATCH_CONTENT_TYPE,
+    BATCH_LINGER,
+    BATCH_MAX_MESSAGES,
+    Compressor,
+    can_batch,
+    decode_batch,
+    decompress_body,
+    encode_batch,
+)
+from .stats import ConnectionStats, add_latency_stats
+from .time import timeit_perf_counter, timeit_perf_counter_duration
+from .timings import TimingHistogram
 
 
 logger = logging.getLogger(__name__)
@@ -26,8 +40,24 @@ class RabbitMQPublisher:
         self.messages = messages
         self.stop = stop
         self.done = Event()
+        self.connection_stats = ConnectionStats()
+        self.publish_latency = TimingHistogram()
+        self.requeued = 0
+        self.published_bytes = 0
+        self.compressor = None
+        if config.compression:
+            self.compressor = Compressor(config.compression, config.compression_threshold)
         Thread(target=self.__main).start()
 
+    def stats(self) -> dict:
+        stats = self.connection_stats.stats("rabbitmq")
+        add_latency_stats(stats, "rabbitmq.publish", self.publish_latency)
+        stats["rabbitmq.publish.bytes"] = self.published_bytes
+        stats["rabbitmq.requeued"] = self.requeued
+        if self.compressor is not None:
+            stats.update(self.compressor.stats("rabbitmq.publish"))
+        return stats
+
     def __main(self):
         logger.debug("publisher started.")
         try:
@@ -37,6 +67,7 @@ class RabbitMQPublisher:
                 except Exception:
                     if logger.isEnabledFor(logging.DEBUG):
                         logger.exception("__connect_and_flush_messages exception")
+                    self.connection_stats.disconnected()
                     time.sleep(1)
         finally:
             self.done.set()
@@ -45,6 +76,7 @@ class RabbitMQPublisher:
     def __connect_and_flush_messages(self):
         logger.debug("publisher connecting to rabbitmq...")
         with pika.BlockingConnection(self.params) as conn, conn.channel() as ch:
+            self.connection_stats.connected()
             while not self.stop.is_set():
                 self.__flush_messages(ch)
             logger.debug("publisher stopping...")
@@ -59,38 +91,111 @@ class RabbitMQPublisher:
             except Empty:
                 return
 
-            properties = pika.BasicProperties(
-                delivery_mode=2, user_id=self.params.credentials.username
-            )
+            if item.enqueued:
+                tracing.record("PublishData.queued", item.enqueued, tracing.now(), "queue")
 
-            # NOTE app_id is used by data service to validate and tag additional metadata provided by k3s scheduler.
-            if self.config.app_id != "":
-                properties.app_id = self.config.app_id
+            # NOTE messages without a body were queued by a plugin using batch encoding
+            if item.body is None:
+                self.__publish_batches(ch, item)
+                continue
 
             if logger.isEnabledFor(logging.DEBUG):
                 logger.debug(
                     "publishing message to rabbitmq: %s", wagglemsg.load(item.body)
                 )
 
+            self.__publish_body(ch, item.scope, item.body, [item])
+
+    def __publish_batches(self, ch, item):
+        items = [item]
+        deadline = time.monotonic() + BATCH_LINGER
+        while len(items) < BATCH_MAX_MESSAGES:
+            timeout = deadline - time.monotonic()
             try:
-                ch.basic_publish(
-                    exchange="to-validator",
-                    routing_key=item.scope,
-                    properties=properties,
-                    body=item.body,
-                )
+                # stop lingering once we're shutting down, but still take what's queued
+                if timeout <= 0 or self.stop.is_set():
+                    item = self.messages.get_nowait()
+                else:
+                    item = self.messages.get(timeout=timeout)
+            except Empty:
+                break
+            if item.enqueued:
+                tracing.record("PublishData.queued", item.enqueued, tracing.now(), "queue")
+            items.append(item)
+
+        # each send is a scope, body, items and content type
+        sends = []
+        batches = {}
+        for item in items:
+            if item.body is not None:
+                sends.append((item.scope, item.body, [item], None))
+            elif can_batch(item.message):
+                batches.setdefault(item.scope, []).append(item)
+            else:
+                sends.append((item.scope, wagglemsg.dump(item.message), [item], None))
+        for scope, batch in batches.items():
+            body = encode_batch([item.message for item in batch])
+            sends.append((scope, body, batch, BATCH_CONTENT_TYPE))
+
+        for i, (scope, body, batch, content_type) in enumerate(sends):
+            logger.debug("publishing %d messages to rabbitmq", len(batch))
+            try:
+                self.__publish_body(ch, scope, body, batch, content_type=content_type)
             except Exception:
-                if logger.isEnabledFor(logging.DEBUG):
-                    logger.exception(
-                        "basic_publish to rabbitmq failed. will requeue message..."
-                    )
-                # requeue message so we can again later
-                # NOTE(sean) this will reorder messages. if we realized we *must* preserve message
-                # order, we must to change this to avoid subtle bugs!
-                self.messages.put(item)
-                # propagate error up to trigger reconnect
+                # NOTE __publish_body requeued its own messages, so we requeue everything
+                # after it which wasn't sent
+                for _, _, rest, _ in sends[i + 1 :]:
+                    for item in rest:
+                        self.messages.put(item)
+                    self.requeued += len(rest)
                 raise
 
+    def __publish_body(self, ch, scope, body, items, content_type=None):
+        properties = pika.BasicProperties(
+            delivery_mode=2, user_id=self.params.credentials.username
+        )
+
+        # NOTE app_id is used by data service to validate and tag additional metadata provided by k3s scheduler.
+        if self.config.app_id != "":
+            properties.app_id = self.config.app_id
+
+        if content_type is not None:
+            properties.content_type = content_type
+
+        if self.compressor is not None:
+            body, content_encoding = self.compressor(body)
+            if content_encoding is not None:
+                properties.content_encoding = content_encoding
+
+        try:
+            # NOTE the trace clock may differ from the timing counter on older pythons
+            trace_start = tracing.now()
+            start = timeit_perf_counter()
+            ch.basic_publish(
+                exchange="to-validator",
+                routing_key=scope,
+                properties=properties,
+                body=body,
+            )
+            finish = timeit_perf_counter()
+            trace_finish = tracing.now()
+            self.publish_latency.record(timeit_perf_counter_duration(start, finish))
+            self.published_bytes += len(body)
+            tracing.record("basic_publish", trace_start, trace_finish, "rabbitmq")
+        except Exception:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.exception(
+                    "basic_publish to rabbitmq failed. will requeue message..."
+                )
+            # requeue message so we can again later
+            # NOTE(sean) this will reorder messages. if we realized we *must* preserve message
+            # order, we must to change this to avoid subtle bugs!
+            for item in items:
+                self.messages.put(item)
+            self.requeued += len(items)
+            # propagate error up to trigger reconnect
+            raise
+
 
 class RabbitMQConsumer:
     """
@@ -106,8 +211,15 @@ class RabbitMQConsumer:
         self.messages = messages
         self.stop = stop
         self.done = Event()
+        self.connection_stats = ConnectionStats()
+        self.received = 0
         Thread(target=self.__main).start()
 
+    def stats(self) -> dict:
+        stats = self.connection_stats.stats("rabbitmq.consumer")
+        stats["rabbitmq.consumer.received"] = self.received
+        return stats
+
     def __main(self):
         logger.debug("consumer started.")
         try:
@@ -117,6 +229,7 @@ class RabbitMQConsumer:
                 except Exception:
                     if logger.isEnabledFor(logging.DEBUG):
                         logger.exception("__connect_and_consume_messages exception")
+                    self.connection_stats.disconnected()
                     time.sleep(1)
         finally:
             self.done.set()
@@ -125,6 +238,7 @@ class RabbitMQConsumer:
     def __connect_and_consume_messages(self):
         logger.debug("consumer connecting to rabbitmq...")
         with pika.BlockingConnection(self.params) as conn, conn.channel() as ch:
+            self.connection_stats.connected()
             # setup subscriber queue and bind to topics
             queue = ch.queue_declare("", exclusive=True).method.queue
             ch.basic_consume(queue, self.__process_message, auto_ack=True)
@@ -145,6 +259,22 @@ class RabbitMQConsumer:
             ch.start_consuming()
 
     def __process_message(self, ch, method, properties, body):
+        if properties.content_encoding:
+            try:
+                body = decompress_body(body, properties.content_encoding)
+            except ValueError:
+                logger.debug("unable to decompress message: %s %s", properties, body)
+                return
+        if properties.content_type == BATCH_CONTENT_TYPE:
+            try:
+                msgs = decode_batch(body)
+            except ValueError:
+                logger.debug("invalid message batch: %s %s", properties, body)
+                return
+            self.received += len(msgs)
+            for msg in msgs:
+                self.messages.put(msg)
+            return
         try:
             logger.debug("consumer processing message %s...", body)
             msg = wagglemsg.load(body)
@@ -152,6 +282,7 @@ class RabbitMQConsumer:
             logger.debug("unsupported message type: %s %s", properties, body)
             return
         logger.debug("consumer putting message in waiting queue")
+        self.received += 1
         self.messages.put(msg)
 
 
@@ -0,0 +1,151 @@
+import heapq
+import itertools
+from threading import Event
+from time import monotonic, time
+
+# tasks due within this many seconds of each other run in the same tick
+TICK_TOLERANCE = 0.001
+
+
+def seconds_until_aligned(interval: float, wall: float) -> float:
+    """
+    seconds_until_aligned returns the time from wall until the next wall clock time which is
+    a multiple of interval. For example, with a 60s interval this is the top of the next minute.
+    """
+    return -wall % interval
+
+
+class PeriodicTask:
+    """
+    PeriodicTask calls fn every interval seconds.
+
+    Deadlines are computed from the task's start time rather than from when the last call
+    finished, so calls don't drift. If a call overruns one or more deadlines, the missed
+    calls are skipped and counted in overruns.
+
+    If governor is set, only the fraction of calls admitted by the governor are run.
+    """
+
+    def __init__(self, interval: float, fn, align=True, governor=None):
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        self.interval = interval
+        self.fn = fn
+        self.align = align
+        self.governor = governor
+        self.ticks = 0
+        self.reset()
+        self.runs = 0
+        self.overruns = 0
+        self.cancelled = False
+
+    @property
+    def deadline(self) -> float:
+        return self.start + self.ticks * self.interval
+
+    def reset(self):
+        """
+        reset restarts the task's deadlines from now, or from the next aligned time if align
+        is set.
+        """
+        self.start = monotonic()
+        if self.align:
+            self.start += seconds_until_aligned(self.interval, time())
+        self.ticks = 0
+
+    def cancel(self):
+        self.cancelled = True
+
+    def advance(self, now: float):
+        """
+        advance moves the task to its next deadline after now, counting any skipped deadlines.
+        """
+        self.ticks += 1
+        if self.deadline <= now:
+            missed = int((now - self.deadline) // self.interval) + 1
+            self.ticks += missed
+            self.overruns += missed
+
+
+class Scheduler:
+    """
+    Scheduler runs periodic tasks from a single thread using a heap of monotonic deadlines.
+    """
+
+    def __init__(self):
+        self.tasks = []
+        self.heap = []
+        self.counter = itertools.count()
+
+    def every(self, interval: float, fn, align=True, governor=None) -> PeriodicTask:
+        task = PeriodicTask(interval, fn, align, governor)
+        self.tasks.append(task)
+        self.__push(task)
+        return task
+
+    def stats(self) -> dict:
+        return {
+            "scheduler.tasks": sum(1 for task in self.tasks if not task.cancelled),
+            "scheduler.runs": sum(task.runs for task in self.tasks),
+            "scheduler.overruns": sum(task.overruns for task in self.tasks),
+        }
+
+    def run(self, stop: Event, duration=None, run_tick=None):
+        """
+        run calls tasks as they become due until stop is set, duration seconds have passed
+        or all tasks have been cancelled. Tasks due at the same time are passed together to
+        run_tick, which by default calls each of them in turn.
+        """
+        if run_tick is None:
+            run_tick = run_tasks
+        end = None if duration is None else monotonic() + duration
+
+        # NOTE tasks may be registered long before run is called, so deadlines of tasks which
+        # haven't ticked yet are computed from now to avoid counting spurious overruns
+        for task in self.tasks:
+            if task.ticks == 0 and not task.cancelled:
+                task.reset()
+        self.heap = []
+        for task in self.tasks:
+            if not task.cancelled:
+                self.__push(task)
+
+        while self.heap and not stop.is_set():
+            deadline = self.heap[0][0]
+            if end is not None and deadline > end:
+                stop.wait(max(end - monotonic(), 0))
+                return
+            timeout = deadline - monotonic()
+            if timeout > 0 and stop.wait(timeout):
+                return
+
+            now = monotonic()
+            due = []
+            while self.heap and self.heap[0][0] <= now + TICK_TOLERANCE:
+                _, _, task = heapq.heappop(self.heap)
+                if not task.cancelled:
+                    due.append(task)
+            if not due:
+                continue
+
+            admitted = [
+                task for task in due if task.governor is None or task.governor.admit(task)
+            ]
+            if admitted:
+                run_tick(admitted)
+
+            now = monotonic()
+            for task in admitted:
+                task.runs += 1
+            for task in due:
+                if not task.cancelled:
+                    task.advance(now)
+                    self.__push(task)
+
+    def __push(self, task):
+        heapq.heappush(self.heap, (task.deadline, next(self.counter), task))
+
+
+def run_tasks(tasks):
+    for task in tasks:
+        task.fn()
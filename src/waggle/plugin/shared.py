@@ -0,0 +1,274 @@
+import heapq
+import json
+import os
+import secrets
+from threading import Lock
+from time import monotonic
+
+from .time import get_timestamp
+
+# default time in seconds a published payload stays available to consumers
+DEFAULT_SHARED_TTL = 60.0
+
+# default max total size of a plugin's published payloads. once exceeded, the payloads
+# closest to expiring are released early.
+DEFAULT_SHARED_MAX_BYTES = 256 * 1024 * 1024
+
+SHARED_DESCRIPTOR_KEY = "shm"
+
+# names of segments created by this process. see attach_shared_memory.
+_owned_segments = set()
+
+
+def new_segment_name():
+    # NOTE some platforms limit shared memory names to 31 characters
+    return "wg" + secrets.token_hex(8)
+
+
+class SharedPayload:
+    """
+    SharedPayload provides read access to a payload published by Plugin.publish_shared.
+
+    The payload is mapped directly from shared memory, so no copies are made until data is
+    read out using tobytes or array. It must be closed once no longer used.
+
+    An open payload stays valid after its ttl passes and the producer releases it. Releasing
+    only removes the segment's name, and names are never reused, so the mapping is never
+    recycled for another payload. The memory is freed once every consumer closes it.
+    """
+
+    def __init__(self, descriptor: dict):
+        self.name = descriptor[SHARED_DESCRIPTOR_KEY]
+        self.size = descriptor["size"]
+        self.dtype = descriptor.get("dtype")
+        self.shape = descriptor.get("shape")
+        self.shm = attach_shared_memory(self.name)
+        self.buffer = self.shm.buf[: self.size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.shm is None:
+            return
+        self.buffer.release()
+        self.shm.close()
+        self.shm = None
+
+    def tobytes(self) -> bytes:
+        return self.buffer.tobytes()
+
+    def array(self, copy=True):
+        """
+        array returns the payload as a numpy array with the published dtype and shape. If
+        copy is False, the array is a view of shared memory and is only valid until close.
+        """
+        import numpy
+
+        arr = numpy.frombuffer(self.buffer, dtype=self.dtype or "uint8")
+        if self.shape is not None:
+            arr = arr.reshape(self.shape)
+        return arr.copy() if copy else arr
+
+
+def import_shared_memory():
+    # NOTE multiprocessing.shared_memory was added in python 3.8
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise RuntimeError("shared payloads require python 3.8 or later")
+    return shared_memory
+
+
+def attach_shared_memory(name):
+    shared_memory = import_shared_memory()
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 doesn't support track=False
+        pass
+
+    shm = shared_memory.SharedMemory(name=name)
+
+    # NOTE before python 3.13, attaching registers the segment with this process's
+    # resource_tracker, which would unlink it when we exit even though the producer owns it.
+    # we undo the registration unless we're also the producer, which relies on it for cleanup.
+    if os.name == "posix" and name not in _owned_segments:
+        from multiprocessing import resource_tracker
+
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def dump_shared_descriptor(descriptor: dict) -> str:
+    return json.dumps(descriptor, separators=(",", ":"))
+
+
+def parse_shared_descriptor(value) -> dict:
+    try:
+        descriptor = json.loads(value)
+    except (TypeError, ValueError):
+        descriptor = None
+    if not isinstance(descriptor, dict) or SHARED_DESCRIPTOR_KEY not in descriptor:
+        raise ValueError(f"message value is not a shared payload descriptor: {value!r}")
+    return descriptor
+
+
+def open_shared(msg) -> SharedPayload:
+    """
+    open_shared opens the payload referenced by a message published by Plugin.publish_shared.
+
+    Examples
+    --------
+
+    ```python
+    with Plugin() as plugin:
+        plugin.subscribe("camera.frame")
+        msg = plugin.get()
+        with open_shared(msg) as payload:
+            frame = payload.array()
+    ```
+    """
+    descriptor = parse_shared_descriptor(msg.value)
+    if descriptor["expires"] < get_timestamp():
+        raise RuntimeError(f"shared payload {descriptor[SHARED_DESCRIPTOR_KEY]!r} has expired")
+    try:
+        return SharedPayload(descriptor)
+    except FileNotFoundError:
+        raise RuntimeError(
+            f"shared payload {descriptor[SHARED_DESCRIPTOR_KEY]!r} is no longer available"
+        )
+
+
+def get_payload_view(data):
+    """
+    get_payload_view returns a flat byte view of data along with its numpy dtype and shape,
+    if data is an array.
+    """
+    dtype = None
+    shape = None
+    if hasattr(data, "dtype") and hasattr(data, "shape"):
+        import numpy
+
+        data = numpy.ascontiguousarray(data)
+        dtype = data.dtype.str
+        shape = list(data.shape)
+    return memoryview(data).cast("B"), dtype, shape
+
+
+class SharedMemoryPool:
+    """
+    SharedMemoryPool owns the shared memory segments published by a plugin and unlinks them
+    once their ttl has passed, when the pool exceeds max_bytes or when it is closed.
+
+    Consumers which opened a payload keep a valid mapping after it is unlinked, so the ttl
+    only limits how long a payload may be opened for.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_SHARED_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.segments = []
+        self.total_bytes = 0
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def create(self, data, ttl=DEFAULT_SHARED_TTL) -> dict:
+        """
+        create copies data into a new segment and returns its descriptor.
+        """
+        shared_memory = import_shared_memory()
+
+        view, dtype, shape = get_payload_view(data)
+        size = view.nbytes
+        if size > self.max_bytes:
+            raise ValueError(
+                f"payload of {size} bytes exceeds shared memory limit of {self.max_bytes} bytes"
+            )
+
+        self.reap()
+
+        with self.lock:
+            evict = self.__pop_over_budget(size)
+        for shm in evict:
+            self.__release(shm)
+        self.evicted += len(evict)
+
+        # NOTE zero sized segments aren't allowed, so empty payloads still take one byte
+        shm = shared_memory.SharedMemory(name=new_segment_name(), create=True, size=max(size, 1))
+        _owned_segments.add(shm.name)
+        try:
+            shm.buf[:size] = view
+        except Exception:
+            self.__release(shm)
+            raise
+
+        expires = monotonic() + ttl
+        with self.lock:
+            heapq.heappush(self.segments, (expires, shm.name, shm, size))
+            self.total_bytes += size
+            self.created += 1
+
+        descriptor = {
+            SHARED_DESCRIPTOR_KEY: shm.name,
+            "size": size,
+            "expires": get_timestamp() + int(ttl * 1e9),
+        }
+        if dtype is not None:
+            descriptor["dtype"] = dtype
+            descriptor["shape"] = shape
+        return descriptor
+
+    def reap(self):
+        """
+        reap unlinks all segments whose ttl has passed.
+        """
+        now = monotonic()
+        expired = []
+        with self.lock:
+            while self.segments and self.segments[0][0] <= now:
+                _, _, shm, size = heapq.heappop(self.segments)
+                self.total_bytes -= size
+                expired.append(shm)
+        for shm in expired:
+            self.__release(shm)
+        self.expired += len(expired)
+
+    def close(self):
+        with self.lock:
+            segments = self.segments
+            self.segments = []
+            self.total_bytes = 0
+        for _, _, shm, _ in segments:
+            self.__release(shm)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "shared.segments": len(self.segments),
+                "shared.bytes": self.total_bytes,
+                "shared.created": self.created,
+                "shared.expired": self.expired,
+                "shared.evicted": self.evicted,
+            }
+
+    def __pop_over_budget(self, size):
+        evict = []
+        while self.segments and self.total_bytes + size > self.max_bytes:
+            _, _, shm, evicted_size = heapq.heappop(self.segments)
+            self.total_bytes -= evicted_size
+            evict.append(shm)
+        return evict
+
+    def __release(self, shm):
+        shm.close()
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+        _owned_segments.discard(shm.name)
@@ -0,0 +1,139 @@
+import logging
+import sys
+from threading import Event, Thread
+from time import monotonic
+
+from .time import get_timestamp
+from .timings import TimingHistogram
+
+logger = logging.getLogger(__name__)
+
+# NOTE names under this prefix are reserved for the plugin's own runtime metrics and are
+# rejected by Plugin.publish.
+SYSTEM_METRICS_PREFIX = "sys.plugin"
+
+LATENCY_FIELDS = ["mean", "p50", "p95", "p99", "max"]
+
+
+def add_latency_stats(stats: dict, prefix: str, hist: TimingHistogram):
+    summary = hist.summary()
+    stats[f"{prefix}.count"] = summary.count
+    for field in LATENCY_FIELDS:
+        stats[f"{prefix}.latency.{field}"] = getattr(summary, field)
+
+
+def get_capture_stats():
+    # NOTE capture stats are only available if waggle.data.capture has already been
+    # imported, so reporting stats never pulls in the data module and its dependencies.
+    capture = sys.modules.get("waggle.data.capture")
+    if capture is None:
+        return {}
+    return capture.capture_stats()
+
+
+class ConnectionStats:
+    """
+    ConnectionStats tracks the number of reconnects and the total time spent disconnected
+    for a connection managed by a background thread. The connection starts out disconnected.
+    """
+
+    def __init__(self):
+        self.reconnects = 0
+        self.disconnected_total = 0.0
+        self.disconnected_since = monotonic()
+        self.ever_connected = False
+
+    def connected(self):
+        if self.disconnected_since is not None:
+            self.disconnected_total += monotonic() - self.disconnected_since
+            self.disconnected_since = None
+        if self.ever_connected:
+            self.reconnects += 1
+        self.ever_connected = True
+
+    def disconnected(self):
+        if self.disconnected_since is None:
+            self.disconnected_since = monotonic()
+
+    def stats(self, prefix: str) -> dict:
+        disconnected_since = self.disconnected_since
+        disconnected_total = self.disconnected_total
+        if disconnected_since is not None:
+            disconnected_total += monotonic() - disconnected_since
+        return {
+            f"{prefix}.connected": int(disconnected_since is None),
+            f"{prefix}.reconnects": self.reconnects,
+            f"{prefix}.disconnected_seconds": disconnected_total,
+        }
+
+
+class StatsReporter:
+    """
+    StatsReporter periodically publishes a plugin's runtime stats under the sys.plugin namespace.
+
+    This is done in a background thread which must be stopped by setting the provided stop Event.
+    Counters are published as is and the publish rate is computed over each interval.
+    """
+
+    def __init__(self, get_stats, publish, interval: float, stop: Event):
+        self.get_stats = get_stats
+        self.publish = publish
+        self.interval = interval
+        self.stop = stop
+        self.done = Event()
+        Thread(target=self.__main, daemon=True).start()
+
+    def __main(self):
+        logger.debug("stats reporter started.")
+        try:
+            last_time = monotonic()
+            stats = self.__get_stats()
+            last_count = None if stats is None else stats["publish.count"]
+            while not self.stop.wait(self.interval):
+                now = monotonic()
+                stats = self.__get_stats()
+                if stats is None:
+                    continue
+                if last_count is None:
+                    # no baseline to compute the publish rate from yet
+                    last_time = now
+                    last_count = stats["publish.count"]
+                    continue
+                rate = (stats["publish.count"] - last_count) / (now - last_time)
+                last_time = now
+                try:
+                    reported = self.report(stats, rate)
+                except Exception:
+                    logger.exception("failed to report plugin stats")
+                    reported = 0
+                # exclude our own reports from the next interval's publish rate
+                last_count = stats["publish.count"] + reported
+        finally:
+            self.done.set()
+            logger.debug("stats reporter stopped.")
+
+    def __get_stats(self):
+        # NOTE stats come from user supplied components like uploaders, so failures must not
+        # stop the reporter thread
+        try:
+            return self.get_stats()
+        except Exception:
+            logger.exception("failed to get plugin stats")
+            return None
+
+    def report(self, stats: dict, rate: float) -> int:
+        """
+        report publishes a stats snapshot and returns the number of messages published.
+        """
+        timestamp = get_timestamp()
+        captures = stats.pop("captures", {})
+        messages = [(f"{SYSTEM_METRICS_PREFIX}.publish.rate", rate, {})]
+        for key, value in stats.items():
+            messages.append((f"{SYSTEM_METRICS_PREFIX}.{key}", value, {}))
+        for device, capture in captures.items():
+            meta = {"device": str(device)}
+            for key, value in capture.items():
+                messages.append((f"{SYSTEM_METRICS_PREFIX}.capture.{key}", value, meta))
+        for name, value, meta in messages:
+            self.publish(name, value, meta, timestamp)
+        return len(messages)
@@ -0,0 +1,157 @@
+import threading
+from time import monotonic
+from typing import NamedTuple
+
+# NOTE durations are bucketed by their top SUB_BUCKET_BITS significant bits, giving a
+# fixed number of buckets covering the full range of nanosecond durations with a
+# relative error of at most 1/SUB_BUCKET_COUNT.
+SUB_BUCKET_BITS = 4
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+BUCKET_COUNT = (64 - SUB_BUCKET_BITS) * SUB_BUCKET_COUNT + 2 * SUB_BUCKET_COUNT
+
+SUMMARY_FIELDS = ["count", "mean", "p50", "p95", "p99", "max"]
+
+
+def bucket_index(duration: int) -> int:
+    if duration < SUB_BUCKET_COUNT:
+        return max(duration, 0)
+    shift = duration.bit_length() - SUB_BUCKET_BITS - 1
+    return shift * SUB_BUCKET_COUNT + (duration >> shift)
+
+
+def bucket_value(index: int) -> int:
+    """
+    bucket_value returns the midpoint of the range of durations stored in a bucket.
+    """
+    if index < SUB_BUCKET_COUNT:
+        return index
+    shift = index // SUB_BUCKET_COUNT - 1
+    mantissa = index - shift * SUB_BUCKET_COUNT
+    lower = mantissa << shift
+    upper = ((mantissa + 1) << shift) - 1
+    return (lower + upper) // 2
+
+
+class TimingSummary(NamedTuple):
+    count: int
+    mean: int
+    p50: int
+    p95: int
+    p99: int
+    max: int
+
+
+class TimingHistogram:
+    """
+    TimingHistogram records nanosecond durations into a fixed size, log-bucketed histogram.
+
+    Recording a duration is constant time and memory use doesn't grow with the number of
+    durations recorded, at the cost of percentiles being approximate.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, duration: int):
+        i = bucket_index(duration)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.total += duration
+            if duration > self.max:
+                self.max = duration
+
+    def merge(self, other: "TimingHistogram"):
+        with self.lock:
+            for i, n in enumerate(other.counts):
+                if n:
+                    self.counts[i] += n
+            self.count += other.count
+            self.total += other.total
+            self.max = max(self.max, other.max)
+
+    def percentile(self, q: float) -> int:
+        with self.lock:
+            if self.count == 0:
+                return 0
+            rank = max(1, round(q / 100 * self.count))
+            seen = 0
+            for i, n in enumerate(self.counts):
+                seen += n
+                if seen >= rank:
+                    # bucket midpoints can overshoot the largest recorded duration
+                    return min(bucket_value(i), self.max)
+            return self.max
+
+    def summary(self) -> TimingSummary:
+        return TimingSummary(
+            count=self.count,
+            mean=self.total // self.count if self.count > 0 else 0,
+            p50=self.percentile(50),
+            p95=self.percentile(95),
+            p99=self.percentile(99),
+            max=self.max,
+        )
+
+
+class Timings:
+    """
+    Timings tracks aggregated timeit histograms by name.
+
+    Each name has a histogram for the current reporting window and one for the lifetime of
+    the plugin. Recording only touches the window histogram; it is merged into the lifetime
+    histogram when the window is flushed.
+    """
+
+    def __init__(self, interval=60.0):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.window = {}
+        self.total = {}
+        self.next_flush = monotonic() + interval
+
+    def record(self, name: str, duration: int) -> bool:
+        """
+        record adds a duration to name's histogram and returns whether the current window
+        is due to be flushed.
+        """
+        try:
+            hist = self.window[name]
+        except KeyError:
+            with self.lock:
+                hist = self.window.setdefault(name, TimingHistogram())
+        hist.record(duration)
+        return monotonic() >= self.next_flush
+
+    def flush(self):
+        """
+        flush ends the current window and returns its summaries by name. Names without any
+        durations in the window are omitted.
+        """
+        with self.lock:
+            window = self.window
+            self.window = {}
+            self.next_flush = monotonic() + self.interval
+            for name, hist in window.items():
+                self.total.setdefault(name, TimingHistogram()).merge(hist)
+        return {name: hist.summary() for name, hist in window.items() if hist.count > 0}
+
+    def summaries(self):
+        """
+        summaries returns the lifetime summaries by name, including the current window.
+        """
+        with self.lock:
+            names = set(self.window) | set(self.total)
+            hists = {}
+            for name in names:
+                hist = TimingHistogram()
+                if name in self.total:
+                    hist.merge(self.total[name])
+                if name in self.window:
+                    hist.merge(self.window[name])
+                hists[name] = hist
+        return {name: hist.summary() for name, hist in hists.items()}
@@ -0,0 +1,699 @@
+import json
+import logging
+import os
+import re
+import socket
+import struct
+from collections import deque
+from queue import Empty, Queue
+from threading import Condition, Event, Lock, Thread
+
+import wagglemsg
+
+from .. import tracing
+from .config import PluginConfig
+from .stats import ConnectionStats
+
+logger = logging.getLogger(__name__)
+
+# NOTE transports hand out publisher and consumer tasks which follow the same contract as
+# RabbitMQPublisher and RabbitMQConsumer: they run in a background thread until the provided
+# stop Event is set, set their done Event once finished and provide a stats() method.
+
+
+class Transport:
+    """
+    Transport creates the publisher and consumer tasks used by a Plugin to move messages.
+    """
+
+    def publisher(self, config: PluginConfig, messages: Queue, stop: Event):
+        raise NotImplementedError()
+
+    def consumer(self, topics, config: PluginConfig, messages: Queue, stop: Event):
+        raise NotImplementedError()
+
+
+class RabbitMQTransport(Transport):
+    """
+    RabbitMQTransport publishes to the Waggle RabbitMQ broker. This is the default transport.
+    """
+
+    def publisher(self, config, messages, stop):
+        # NOTE pika is imported on first use, so other transports don't pay for it
+        from .rabbitmq import RabbitMQPublisher
+
+        return RabbitMQPublisher(config, messages, stop)
+
+    def consumer(self, topics, config, messages, stop):
+        from .rabbitmq import RabbitMQConsumer
+
+        return RabbitMQConsumer(topics, config, messages, stop)
+
+
+class NullPublisher:
+    def __init__(self, messages: Queue, stop: Event):
+        self.messages = messages
+        self.stop = stop
+        self.done = Event()
+        self.discarded = 0
+        Thread(target=self.__main, daemon=True).start()
+
+    def stats(self) -> dict:
+        return {
+            "none.discarded": self.discarded,
+        }
+
+    def __main(self):
+        try:
+            while not self.stop.is_set():
+                self.__discard_messages(timeout=0.1)
+            self.__discard_messages(timeout=0)
+        finally:
+            self.done.set()
+
+    def __discard_messages(self, timeout):
+        while True:
+            try:
+                self.messages.get(timeout=timeout) if timeout else self.messages.get_nowait()
+            except Empty:
+                return
+            self.discarded += 1
+
+
+class NullConsumer:
+    def __init__(self, stop: Event):
+        self.stop = stop
+        self.done = Event()
+        Thread(target=self.__main, daemon=True).start()
+
+    def stats(self) -> dict:
+        return {}
+
+    def __main(self):
+        try:
+            self.stop.wait()
+        finally:
+            self.done.set()
+
+
+class NullTransport(Transport):
+    """
+    NullTransport discards published messages and never delivers any to subscribers. This is
+    intended for runs which only write to a PYWAGGLE_LOG_DIR run log and shouldn't connect to
+    a broker.
+    """
+
+    def publisher(self, config, messages, stop):
+        return NullPublisher(messages, stop)
+
+    def consumer(self, topics, config, messages, stop):
+        return NullConsumer(stop)
+
+
+def compile_topic(topic: str):
+    """
+    compile_topic compiles an AMQP style topic into a regex for use with topics_match. As in
+    RabbitMQ, * matches exactly one word and # matches zero or more words.
+    """
+    # NOTE the pattern is matched against the name with a leading ".", so every word,
+    # including the first, is preceded by a separator and # can simply match zero words.
+    pattern = ""
+    for word in topic.split("."):
+        if word == "#":
+            pattern += r"(?:\.[^.]+)*"
+        elif word == "*":
+            pattern += r"\.[^.]+"
+        else:
+            pattern += r"\." + re.escape(word)
+    return re.compile(pattern + "$")
+
+
+def topics_match(patterns, name: str) -> bool:
+    name = "." + name
+    return any(p.match(name) for p in patterns)
+
+
+class MemoryBroker:
+    """
+    MemoryBroker routes messages between plugins in the same process.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.subscribers = []
+
+    def subscribe(self, topics, messages: Queue):
+        subscriber = ([compile_topic(t) for t in topics], messages)
+        with self.lock:
+            self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.remove(subscriber)
+
+    def route(self, msg: wagglemsg.Message) -> int:
+        with self.lock:
+            subscribers = list(self.subscribers)
+        delivered = 0
+        for patterns, messages in subscribers:
+            if topics_match(patterns, msg.name):
+                messages.put(msg)
+                delivered += 1
+        return delivered
+
+
+default_memory_broker = MemoryBroker()
+
+
+class MemoryPublisher:
+    def __init__(self, broker: MemoryBroker, messages: Queue, stop: Event):
+        self.broker = broker
+        self.messages = messages
+        self.stop = stop
+        self.done = Event()
+        self.published = 0
+        self.delivered = 0
+        Thread(target=self.__main, daemon=True).start()
+
+    def stats(self) -> dict:
+        return {
+            "memory.published": self.published,
+            "memory.delivered": self.delivered,
+        }
+
+    def __main(self):
+        try:
+            while not self.stop.is_set():
+                self.__flush_messages(timeout=0.1)
+            self.__flush_messages(timeout=0)
+        finally:
+            self.done.set()
+
+    def __flush_messages(self, timeout):
+        while True:
+            try:
+                item = self.messages.get(timeout=timeout) if timeout else self.messages.get_nowait()
+            except Empty:
+                return
+            if item.enqueued:
+                tracing.record("PublishData.queued", item.enqueued, tracing.now(), "queue")
+            msg = item.message if item.body is None else wagglemsg.load(item.body)
+            self.delivered += self.broker.route(msg)
+            self.published += 1
+
+
+class MemoryConsumer:
+    def __init__(self, broker: MemoryBroker, topics, messages: Queue, stop: Event):
+        self.broker = broker
+        self.subscriber = broker.subscribe(topics, messages)
+        self.stop = stop
+        self.done = Event()
+        Thread(target=self.__main, daemon=True).start()
+
+    def stats(self) -> dict:
+        return {}
+
+    def __main(self):
+        try:
+            self.stop.wait()
+        finally:
+            self.broker.unsubscribe(self.subscriber)
+            self.done.set()
+
+
+class MemoryTransport(Transport):
+    """
+    MemoryTransport delivers messages to other plugins in the same process. This is intended
+    for tests, benchmarks and plugins made up of several components in one process.
+    """
+
+    def __init__(self, broker: MemoryBroker = None):
+        self.broker = broker or default_memory_broker
+
+    def publisher(self, config, messages, stop):
+        return MemoryPublisher(self.broker, messages, stop)
+
+    def consumer(self, topics, config, messages, stop):
+        return MemoryConsumer(self.broker, topics, messages, stop)
+
+
+# NOTE the Unix socket protocol uses length prefixed frames whose first byte is the frame
+# type:
+#
+# P name_len:u16 name body - publish body under name. sent by publishers.
+# S topics_json            - subscribe to topics. sent once by consumers after connecting.
+# M body                   - message delivered to a consumer by the broker.
+FRAME_HEADER = struct.Struct(">I")
+NAME_LENGTH = struct.Struct(">H")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# default max bytes of messages the broker holds for a subscriber which isn't keeping up.
+# once exceeded, further messages to that subscriber are dropped.
+DEFAULT_SUBSCRIBER_MAX_PENDING = 16 * 1024 * 1024
+
+
+def encode_frame(kind: bytes, *parts: bytes) -> bytes:
+    payload = kind + b"".join(parts)
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def encode_publish_frame(name: str, body: bytes) -> bytes:
+    name = name.encode()
+    return encode_frame(b"P", NAME_LENGTH.pack(len(name)), name, body)
+
+
+def decode_publish_frame(payload: bytes):
+    (n,) = NAME_LENGTH.unpack_from(payload, 1)
+    start = 1 + NAME_LENGTH.size
+    return payload[start : start + n].decode(), payload[start + n :]
+
+
+class FrameReader:
+    """
+    FrameReader reads length prefixed frames from a socket, tolerating socket timeouts
+    between reads.
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.buffer = bytearray()
+
+    def read(self):
+        """
+        read returns the next available frames. It raises socket.timeout if no data is
+        received within the socket's timeout and ConnectionError when the peer disconnects.
+        """
+        chunk = self.sock.recv(1024 * 1024)
+        if not chunk:
+            raise ConnectionError("connection closed by peer")
+        self.buffer += chunk
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= FRAME_HEADER.size:
+            (size,) = FRAME_HEADER.unpack_from(self.buffer, offset)
+            if size > MAX_FRAME_SIZE:
+                raise ConnectionError(f"frame of {size} bytes exceeds max frame size")
+            end = offset + FRAME_HEADER.size + size
+            if end > len(self.buffer):
+                break
+            frames.append(bytes(self.buffer[offset + FRAME_HEADER.size : end]))
+            offset = end
+        del self.buffer[:offset]
+        return frames
+
+
+class BrokerSubscriber:
+    """
+    BrokerSubscriber sends messages routed to a subscribed connection from its own thread, so a
+    slow subscriber never blocks publishers or other subscribers. Up to max_pending bytes of
+    messages are held while the subscriber catches up.
+    """
+
+    def __init__(self, conn, topics, max_pending: int):
+        self.conn = conn
+        self.patterns = [compile_topic(t) for t in topics]
+        self.max_pending = max_pending
+        self.cond = Condition()
+        self.frames = deque()
+        self.pending = 0
+        self.closed = False
+        Thread(target=self.__main, daemon=True).start()
+
+    def send(self, frame: bytes) -> bool:
+        """
+        send queues frame to be sent and returns False if it was dropped because the subscriber
+        has fallen too far behind.
+        """
+        with self.cond:
+            if self.closed:
+                return False
+            # NOTE we always accept one frame, so frames over max_pending still get through
+            if self.pending > 0 and self.pending + len(frame) > self.max_pending:
+                return False
+            self.frames.append(frame)
+            self.pending += len(frame)
+            self.cond.notify()
+        return True
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def __main(self):
+        try:
+            while True:
+                with self.cond:
+                    while not self.frames and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        return
+                    frames = list(self.frames)
+                    self.frames.clear()
+                data = b"".join(frames)
+                self.conn.sendall(data)
+                with self.cond:
+                    self.pending -= len(data)
+        except OSError as exc:
+            logger.debug("failed to deliver messages to subscriber: %s", exc)
+            # NOTE shutting down the connection wakes up its reader so it's cleaned up
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class UnixSocketBroker:
+    """
+    UnixSocketBroker routes messages between plugins on the same host over a Unix domain
+    socket. Each connection is served by its own thread and each subscriber is sent messages
+    from its own thread. Messages to a subscriber with more than max_pending bytes of messages
+    waiting are dropped and counted.
+
+    Examples
+    --------
+
+    ```python
+    with UnixSocketBroker("/run/waggle/plugin.sock"):
+        ...
+    ```
+
+    Plugins then connect using WAGGLE_PLUGIN_TRANSPORT=unix:///run/waggle/plugin.sock.
+    """
+
+    def __init__(self, path, max_pending=DEFAULT_SUBSCRIBER_MAX_PENDING):
+        self.path = str(path)
+        self.max_pending = max_pending
+        self.lock = Lock()
+        self.subscribers = {}
+        self.connections = set()
+        self.routed = 0
+        self.dropped = 0
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen()
+        self.closed = Event()
+        Thread(target=self.__accept, daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.closed.set()
+        self.listener.close()
+        with self.lock:
+            connections = list(self.connections)
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "connections": len(self.connections),
+                "subscribers": len(self.subscribers),
+                "routed": self.routed,
+                "dropped": self.dropped,
+            }
+
+    def __accept(self):
+        while not self.closed.is_set():
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.connections.add(conn)
+            Thread(target=self.__serve, args=(conn,), daemon=True).start()
+
+    def __serve(self, conn):
+        reader = FrameReader(conn)
+        try:
+            while True:
+                for payload in reader.read():
+                    kind = payload[:1]
+                    if kind == b"P":
+                        name, body = decode_publish_frame(payload)
+                        self.__route(name, body)
+                    elif kind == b"S":
+                        topics = json.loads(payload[1:])
+                        subscriber = BrokerSubscriber(conn, topics, self.max_pending)
+                        with self.lock:
+                            previous = self.subscribers.pop(conn, None)
+                            self.subscribers[conn] = subscriber
+                        if previous is not None:
+                            previous.close()
+                    else:
+                        raise ConnectionError(f"unknown frame type {kind!r}")
+        except (ConnectionError, OSError) as exc:
+            logger.debug("broker connection closed: %s", exc)
+        finally:
+            with self.lock:
+                self.connections.discard(conn)
+                subscriber = self.subscribers.pop(conn, None)
+            if subscriber is not None:
+                subscriber.close()
+            conn.close()
+
+    def __route(self, name, body):
+        with self.lock:
+            subscribers = list(self.subscribers.values())
+        frame = None
+        dropped = 0
+        for subscriber in subscribers:
+            if not topics_match(subscriber.patterns, name):
+                continue
+            if frame is None:
+                frame = encode_frame(b"M", body)
+            if not subscriber.send(frame):
+                dropped += 1
+        with self.lock:
+            self.routed += 1
+            self.dropped += dropped
+        if dropped:
+            logger.debug("dropped message for %d subscribers which are falling behind", dropped)
+
+
+def connect_unix_socket(path, timeout=1.0) -> socket.socket:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(str(path))
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+class UnixSocketPublisher:
+    """
+    UnixSocketPublisher manages a connection to a UnixSocketBroker and publishes messages
+    from the provided queue. Messages already waiting in the queue are sent together.
+    """
+
+    def __init__(self, path, messages: Queue, stop: Event):
+        self.path = path
+        self.messages = messages
+        self.stop = stop
+        self.done = Event()
+        self.connection_stats = ConnectionStats()
+        self.published = 0
+        self.requeued = 0
+        # messages which failed to send and are sent first once reconnected
+        self.pending = []
+        Thread(target=self.__main).start()
+
+    def stats(self) -> dict:
+        stats = self.connection_stats.stats("unix")
+        stats["unix.published"] = self.published
+        stats["unix.requeued"] = self.requeued
+        return stats
+
+    def __main(self):
+        try:
+            while not self.stop.is_set():
+                try:
+                    self.__connect_and_flush_messages()
+                except Exception:
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.exception("__connect_and_flush_messages exception")
+                    self.connection_stats.disconnected()
+                    self.stop.wait(1)
+        finally:
+            self.done.set()
+
+    def __connect_and_flush_messages(self):
+        with connect_unix_socket(self.path) as sock:
+            self.connection_stats.connected()
+            while not self.stop.is_set():
+                self.__flush_messages(sock, timeout=0.1)
+            self.__flush_messages(sock, timeout=0)
+
+    def __flush_messages(self, sock, timeout):
+        while True:
+            # NOTE messages from a failed write are sent before anything newer, so they
+            # aren't reordered
+            items = self.pending
+            if not items:
+                items = self.__get_items(timeout)
+                if not items:
+                    return
+            frames = [encode_item_frame(item) for item in items]
+            try:
+                sock.sendall(b"".join(frames))
+            except Exception:
+                # hold on to messages so we can send them again after reconnecting
+                self.pending = items
+                self.requeued += len(items)
+                raise
+            self.pending = []
+            self.published += len(items)
+
+    def __get_items(self, timeout):
+        try:
+            item = self.messages.get(timeout=timeout) if timeout else self.messages.get_nowait()
+        except Empty:
+            return []
+        items = [item]
+        while len(items) < 1024:
+            try:
+                items.append(self.messages.get_nowait())
+            except Empty:
+                break
+        if tracing.enabled:
+            dequeued = tracing.now()
+            for item in items:
+                if item.enqueued:
+                    tracing.record("PublishData.queued", item.enqueued, dequeued, "queue")
+        return items
+
+
+class UnixSocketConsumer:
+    """
+    UnixSocketConsumer manages a connection to a UnixSocketBroker and puts received messages
+    into the provided queue.
+    """
+
+    def __init__(self, path, topics, messages: Queue, stop: Event):
+        self.path = path
+        self.topics = list(topics)
+        self.messages = messages
+        self.stop = stop
+        self.done = Event()
+        self.connection_stats = ConnectionStats()
+        self.received = 0
+        Thread(target=self.__main).start()
+
+    def stats(self) -> dict:
+        stats = self.connection_stats.stats("unix.consumer")
+        stats["unix.consumer.received"] = self.received
+        return stats
+
+    def __main(self):
+        try:
+            while not self.stop.is_set():
+                try:
+                    self.__connect_and_consume_messages()
+                except Exception:
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.exception("__connect_and_consume_messages exception")
+                    self.connection_stats.disconnected()
+                    self.stop.wait(1)
+        finally:
+            self.done.set()
+
+    def __connect_and_consume_messages(self):
+        with connect_unix_socket(self.path, timeout=0.1) as sock:
+            sock.sendall(encode_frame(b"S", json.dumps(self.topics).encode()))
+            self.connection_stats.connected()
+            reader = FrameReader(sock)
+            while not self.stop.is_set():
+                try:
+                    frames = reader.read()
+                except socket.timeout:
+                    continue
+                for payload in frames:
+                    try:
+                        msg = wagglemsg.load(payload[1:])
+                    except (TypeError, ValueError):
+                        logger.debug("unsupported message: %s", payload)
+                        continue
+                    self.received += 1
+                    self.messages.put(msg)
+
+
+def encode_item_frame(item) -> bytes:
+    # NOTE messages from plugins using batch encoding are queued without a body. the unix
+    # socket transport already sends everything queued in one write, so we send them as json.
+    if item.body is None:
+        return encode_publish_frame(item.message.name, wagglemsg.dump(item.message).encode())
+    body = item.body.encode() if isinstance(item.body, str) else item.body
+    # NOTE the name is only decoded from the body for items queued without one
+    name = item.name or json.loads(body)["name"]
+    return encode_publish_frame(name, body)
+
+
+class UnixSocketTransport(Transport):
+    """
+    UnixSocketTransport exchanges messages with other plugins on the same host through a
+    UnixSocketBroker listening at path.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def publisher(self, config, messages, stop):
+        return UnixSocketPublisher(self.path, messages, stop)
+
+    def consumer(self, topics, config, messages, stop):
+        return UnixSocketConsumer(self.path, topics, messages, stop)
+
+
+def get_transport(spec: str) -> Transport:
+    """
+    get_transport returns the transport for a spec of the form:
+
+    rabbitmq           - publish to RabbitMQ using the plugin config's host and credentials.
+    memory             - exchange messages with plugins in the same process.
+    none               - discard messages. useful with PYWAGGLE_LOG_DIR for log only runs.
+    unix:///path/to/sock - exchange messages through a UnixSocketBroker at the given path.
+    """
+    if spec in ("", "rabbitmq"):
+        return RabbitMQTransport()
+    if spec == "memory":
+        return MemoryTransport()
+    if spec == "none":
+        return NullTransport()
+    if spec.startswith("unix://"):
+        return UnixSocketTransport(spec[len("unix://") :])
+    raise ValueError(f"unsupported plugin transport: {spec!r}")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a Unix socket broker for co-located plugins.")
+    parser.add_argument("path", help="path of Unix socket to listen on")
+    args = parser.parse_args()
+
+    with UnixSocketBroker(args.path) as broker:
+        try:
+            broker.closed.wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
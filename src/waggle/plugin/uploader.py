@@ -2,12 +2,24 @@ import hashlib
 import json
 from pathlib import Path
 from shutil import copyfile
-from .time import get_timestamp
+from threading import Lock
+from .. import tracing
+from .stats import add_latency_stats
+from .time import get_timestamp, timeit_perf_counter, timeit_perf_counter_duration
+from .timings import TimingHistogram
 
 
 class Uploader:
     def __init__(self, root):
         self.root = Path(root)
+        self.lock = Lock()
+        self.uploaded_bytes = 0
+        self.staging_latency = TimingHistogram()
+
+    def stats(self) -> dict:
+        stats = {"upload.bytes": self.uploaded_bytes}
+        add_latency_stats(stats, "upload", self.staging_latency)
+        return stats
 
     # NOTE uploads are stored in the following directory structure:
     # root/
@@ -17,9 +29,12 @@ class Uploader:
     def upload_file(self, path, meta={}, timestamp=None, keep=False):
         # get timestamp before doing other work
         timestamp = timestamp or get_timestamp()
+        start = timeit_perf_counter()
 
         path = Path(path)
-        checksum = sha1sum_for_file(path)
+        size = path.stat().st_size
+        with tracing.span("Uploader.sha1", "uploader"):
+            checksum = sha1sum_for_file(path)
 
         # create upload dir
         upload_dir = Path(self.root, f"{timestamp}-{checksum}")
@@ -28,9 +43,10 @@ class Uploader:
         # stage data file
         # NOTE we do a copy instead of move, as the upload dir may
         # be mounted from another disk.
-        copyfile(path, Path(upload_dir, "data"))
-        if not keep:
-            path.unlink()
+        with tracing.span("Uploader.copy", "uploader"):
+            copyfile(path, Path(upload_dir, "data"))
+            if not keep:
+                path.unlink()
 
         # stage meta file
         metafile = {
@@ -41,6 +57,11 @@ class Uploader:
         metafile["labels"]["filename"] = path.name
         write_json_file(Path(upload_dir, "meta"), metafile)
 
+        finish = timeit_perf_counter()
+        self.staging_latency.record(timeit_perf_counter_duration(start, finish))
+        with self.lock:
+            self.uploaded_bytes += size
+
         return upload_dir
 
 
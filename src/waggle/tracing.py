@@ -0,0 +1,177 @@
+"""
+tracing records lightweight spans across pywaggle and user code and exports them in the
+Chrome trace event format, which can be viewed with chrome://tracing or https://ui.perfetto.dev.
+
+Tracing is enabled by setting PYWAGGLE_TRACE=1. The trace is written to trace.json under
+PYWAGGLE_LOG_DIR when the plugin exits.
+
+Examples
+--------
+
+```python
+from waggle import tracing
+
+with Plugin() as plugin, Camera() as camera:
+    for sample in camera.stream():
+        with tracing.span("inference"):
+            results = model(sample.data)
+        plugin.publish("detections", len(results))
+```
+"""
+import atexit
+import json
+import threading
+from collections import deque
+from os import getenv
+from pathlib import Path
+
+# NOTE perf_counter_ns and threading.get_native_id were added in python 3.7 and 3.8, so we
+# fall back to equivalents on older versions
+try:
+    from time import perf_counter_ns
+except ImportError:
+    from time import perf_counter
+
+    def perf_counter_ns():
+        return int(perf_counter() * 1e9)
+
+
+get_thread_id = getattr(threading, "get_native_id", threading.get_ident)
+
+# max number of events kept in memory. once reached, the oldest events are dropped.
+MAX_EVENTS = 1_000_000
+
+TRACE_FILENAME = "trace.json"
+
+enabled = getenv("PYWAGGLE_TRACE", "").lower() in ("1", "true", "yes", "on")
+
+_events = deque(maxlen=MAX_EVENTS)
+_thread_names = {}
+
+
+def now() -> int:
+    """
+    now returns the current trace clock time in nanoseconds.
+    """
+    return perf_counter_ns()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def clear():
+    _events.clear()
+    _thread_names.clear()
+
+
+def record(name: str, start: int, finish: int, cat="user", args=None):
+    """
+    record adds a span from start to finish (trace clock nanoseconds) on the current thread.
+    """
+    if not enabled:
+        return
+    tid = get_thread_id()
+    if tid not in _thread_names:
+        _thread_names[tid] = threading.current_thread().name
+    # NOTE deque.append is atomic, so no lock is needed in the hot path
+    _events.append((name, cat, start, finish - start, tid, args))
+
+
+class Span:
+    __slots__ = ("name", "cat", "args", "start")
+
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        record(self.name, self.start, perf_counter_ns(), self.cat, self.args)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_noop_span = _NoopSpan()
+
+
+def span(name: str, cat="user", args=None):
+    """
+    span returns a context manager which records the duration of its block as a span.
+    """
+    if not enabled:
+        return _noop_span
+    return Span(name, cat, args)
+
+
+def get_trace_events() -> list:
+    """
+    get_trace_events returns the recorded spans as Chrome trace events.
+    """
+    # NOTE copying a deque may fail if it's modified concurrently, so we retry
+    while True:
+        try:
+            events = list(_events)
+            break
+        except RuntimeError:
+            continue
+
+    trace = [
+        {"name": "thread_name", "ph": "M", "pid": 0, "tid": tid, "args": {"name": name}}
+        for tid, name in list(_thread_names.items())
+    ]
+    for name, cat, start, duration, tid, args in events:
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            # chrome trace timestamps and durations are in microseconds
+            "ts": start / 1000,
+            "dur": duration / 1000,
+            "pid": 0,
+            "tid": tid,
+        }
+        if args:
+            event["args"] = args
+        trace.append(event)
+    return trace
+
+
+def dump(path=None):
+    """
+    dump writes the trace as Chrome trace event JSON to path. By default, the trace is
+    written to trace.json under PYWAGGLE_LOG_DIR. Nothing is written if neither is set.
+    """
+    if path is None:
+        if getenv("PYWAGGLE_LOG_DIR") is None:
+            return None
+        path = Path(getenv("PYWAGGLE_LOG_DIR"), TRACE_FILENAME)
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("w") as f:
+        json.dump({"traceEvents": get_trace_events(), "displayTimeUnit": "ns"}, f)
+    return path
+
+
+@atexit.register
+def _dump_at_exit():
+    if enabled and _events:
+        dump()
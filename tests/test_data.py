@@ -1,12 +1,41 @@
 import unittest
-from waggle.data.audio import AudioFolder, AudioSample
-from waggle.data.vision import RGB, BGR, ImageFolder, ImageSample, resolve_device
+from waggle.data.audio import (
+    AudioFolder,
+    AudioRecorder,
+    AudioRingBuffer,
+    AudioSample,
+)
+from waggle.data.vision import (
+    RGB,
+    BGR,
+    CameraGroup,
+    ImageFolder,
+    ImageSample,
+    ImageWriter,
+    resolve_device,
+)
 from waggle.data.timestamp import get_timestamp
+from waggle.plugin import Plugin, PluginConfig, Uploader
+from waggle.data.config import DataConfig
+from waggle.data.capture import capture_stats, subscribe
+from waggle.data.data_shim import FrameBuffer, ImageHandler, VideoHandler
+from waggle.data.measurements import (
+    MeasurementsFile,
+    MeasurementsReader,
+    SparseTimeIndex,
+    parse_timestamp_ns,
+    read_columns,
+)
 import numpy as np
 from tempfile import TemporaryDirectory
 from pathlib import Path
 import os.path
+import json
+import threading
+import time
+import unittest.mock
 from itertools import product
+from datetime import datetime, timezone
 
 
 def generate_audio_data(samplerate, channels, dtype):
@@ -29,6 +58,111 @@ def generate_audio_sample(samplerate, channels, dtype):
     return AudioSample(generate_audio_data(samplerate, channels, dtype), samplerate, 0)
 
 
+def generate_video_file(path, frames, width=64, height=48, fps=10):
+    import cv2
+
+    writer = cv2.VideoWriter(
+        str(path), cv2.VideoWriter_fourcc(*"MJPG"), fps, (width, height)
+    )
+    for _ in range(frames):
+        writer.write(np.random.randint(0, 255, (height, width, 3), dtype=np.uint8))
+    writer.release()
+
+
+def generate_measurements_file(path, records):
+    with open(path, "w") as f:
+        for name, value, meta, ts in records:
+            # use the full nanosecond precision SDR timestamp format
+            seconds, nanos = divmod(ts, 10**9)
+            timestamp = datetime.fromtimestamp(seconds, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+            timestamp = f"{timestamp}.{nanos:09d}Z"
+            print(
+                json.dumps({"name": name, "value": value, "meta": meta, "timestamp": timestamp}),
+                file=f,
+            )
+
+
+class ImageServer:
+    """
+    ImageServer is a local stand-in for an HTTP snapshot camera which supports keep-alive
+    connections and ETag conditional requests.
+    """
+
+    def __init__(self):
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        import threading
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                server.connections += 1
+
+            def do_GET(self):
+                server.requests += 1
+                etag = f'"{server.version}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(server.body)))
+                self.end_headers()
+                self.wfile.write(server.body)
+
+            def log_message(self, *args):
+                pass
+
+        self.connections = 0
+        self.requests = 0
+        self.set_image(np.zeros((48, 64, 3), dtype=np.uint8))
+        self.httpd = HTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/snapshot.png"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def set_image(self, bgr):
+        import cv2
+
+        self.version = getattr(self, "version", 0) + 1
+        self.body = cv2.imencode(".png", bgr)[1].tobytes()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class RecordingPlugin:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, name, value, meta={}, timestamp=None):
+        self.published.append((name, value, meta, timestamp))
+
+
+class FakeAudioSource:
+    def __init__(self, data, samplerate):
+        self.data = data
+        self.samplerate = samplerate
+        self.closed = False
+
+    def stream(self, chunk_duration):
+        numframes = int(chunk_duration * self.samplerate)
+        try:
+            for start in range(0, len(self.data), numframes):
+                timestamp = 10**18 + start * 10**9 // self.samplerate
+                yield AudioSample(self.data[start : start + numframes], self.samplerate, timestamp)
+        finally:
+            self.closed = True
+
+
 class TestData(unittest.TestCase):
     def test_colors(self):
         for fmt in [RGB, BGR]:
@@ -75,6 +209,44 @@ class TestData(unittest.TestCase):
             samples = ImageFolder(dir, RGB)
             self.assertTrue(np.allclose(sample.data, samples[0].data))
 
+    def test_image_writer(self):
+        with TemporaryDirectory() as dir:
+            sample = ImageSample(
+                np.random.randint(0, 255, (100, 120, 3), dtype=np.uint8), 0, RGB
+            )
+            with ImageWriter(workers=2, max_pending=2, jpeg_quality=80) as writer:
+                futures = [
+                    writer.save(sample, Path(dir, f"sample{i}.{fmt}"))
+                    for i in range(4)
+                    for fmt in ["jpg", "png"]
+                ]
+                encoded = writer.encode(sample, ".png").result()
+            for f in futures:
+                self.assertTrue(f.result().exists())
+            self.assertEqual(encoded, sample.encode(".png"))
+            samples = ImageFolder(dir, RGB)
+            self.assertEqual(len(samples), 8)
+            # png is lossless so the written image must match the original
+            png = [i for i, p in enumerate(samples.files) if p.suffix == ".png"][0]
+            self.assertTrue(np.array_equal(sample.data, samples[png].data))
+
+    def test_camera_group(self):
+        with TemporaryDirectory() as dir:
+            paths = [Path(dir, "left.avi"), Path(dir, "right.avi")]
+            for path in paths:
+                generate_video_file(path, frames=5)
+
+            group = CameraGroup(paths).snapshot()
+            self.assertEqual(len(group.samples), 2)
+            self.assertEqual(group.skew[group.skew.index(0)], 0)
+            self.assertGreaterEqual(group.max_skew, 0)
+            for sample in group.samples:
+                self.assertEqual(sample.data.shape, (48, 64, 3))
+                self.assertGreaterEqual(sample.timestamp, group.timestamp)
+
+            groups = list(CameraGroup(paths).stream())
+            self.assertEqual(len(groups), 5)
+
     def test_audio_save(self):
         test_formats = ["wav", "flac"]
         test_samplerates = [22050, 44100, 48000]
@@ -114,10 +286,500 @@ class TestData(unittest.TestCase):
                     msg=f"failed: format={format} samplerate={samplerate} channels={channels} dtypes={dtype}",
                 )
 
+    def test_audio_features(self):
+        samplerate = 16000
+        t = np.arange(samplerate) / samplerate
+        left = 0.5 * np.sin(2 * np.pi * 2000 * t)
+        right = np.zeros_like(left)
+        sample = AudioSample(np.stack([left, right], axis=1), samplerate, 10**18)
+
+        features = sample.features(frame_size=1600, hop=800)
+        self.assertEqual(features["rms"].shape, (19, 2))
+        self.assertEqual(features["band_energy"].shape, (19, 2, 4))
+        self.assertEqual(features["timestamp"][1] - features["timestamp"][0], 50_000_000)
+
+        # compare against straightforward per frame implementations
+        for i in range(19):
+            frame = sample.data[i * 800 : i * 800 + 1600]
+            self.assertTrue(np.allclose(features["rms"][i], np.sqrt(np.mean(frame**2, axis=0))))
+            self.assertTrue(np.allclose(features["peak"][i], np.max(np.abs(frame), axis=0)))
+
+        self.assertTrue(np.allclose(features["rms"][:, 0], 0.5 / np.sqrt(2), atol=1e-3))
+        self.assertTrue(np.allclose(features["dbfs"][:, 0], -9.03, atol=0.01))
+        self.assertTrue(np.allclose(features["spectral_centroid"][:, 0], 2000, atol=5))
+        # silence has no spectral content and sits at the dBFS floor
+        self.assertTrue(np.all(features["spectral_centroid"][:, 1] == 0))
+        self.assertTrue(np.all(features["dbfs"][:, 1] == -200))
+        # all the energy of the tone is in the 1000-4000 Hz band
+        energy = features["band_energy"][:, 0]
+        self.assertTrue(np.all(energy[:, 2] / energy.sum(axis=1) > 0.99))
+
+        # integer data is scaled to full scale and unrequested features are skipped
+        pcm = AudioSample((sample.data * 2**15).astype(np.int16), samplerate, 0)
+        features = pcm.features(frame_size=1600, kinds=["rms"])
+        self.assertEqual(set(features), {"rms", "timestamp"})
+        self.assertTrue(np.allclose(features["rms"][:, 0], 0.5 / np.sqrt(2), atol=1e-3))
+
+        with self.assertRaises(ValueError):
+            sample.features(frame_size=1600, kinds=["loudness"])
+
+    def test_audio_recorder(self):
+        import soundfile
+
+        samplerate = 8000
+        data = generate_audio_data(samplerate * 4, 2, np.float32) * 0.5
+        source = FakeAudioSource(data, samplerate)
+        finished = []
+
+        with TemporaryDirectory() as dir:
+            recorder = AudioRecorder(
+                source,
+                dir,
+                format="flac",
+                segment_duration=1.0,
+                chunk_duration=0.3,
+                on_segment=lambda path, timestamp: finished.append((path, timestamp)),
+            )
+            segments = recorder.record(2.5)
+            self.assertTrue(source.closed)
+            self.assertEqual(len(segments), 3)
+            self.assertEqual(
+                [timestamp for _, timestamp in finished],
+                [10**18, 10**18 + 10**9, 10**18 + 2 * 10**9],
+            )
+            recorded = np.concatenate([soundfile.read(str(path), always_2d=True)[0] for path in segments])
+            self.assertEqual(len(recorded), int(samplerate * 2.5))
+            self.assertTrue(np.allclose(recorded, data[: len(recorded)], atol=1e-4))
+
+    def test_audio_recorder_upload(self):
+        samplerate = 8000
+        data = generate_audio_data(samplerate * 2, 1, np.float32) * 0.5
+        source = FakeAudioSource(data, samplerate)
+        config = PluginConfig("plugin", "plugin", "localhost", 5672, "", transport="memory")
+
+        with TemporaryDirectory() as dir:
+            plugin = Plugin(config, uploader=Uploader(Path(dir, "uploads")))
+            recorder = AudioRecorder(source, Path(dir, "recordings"), segment_duration=1.0, plugin=plugin)
+            segments = recorder.record()
+            self.assertEqual(len(segments), 2)
+            # uploaded segments are kept, so the returned paths are still valid
+            for path in segments:
+                self.assertTrue(path.exists())
+            self.assertEqual(len(list(Path(dir, "uploads").glob("*/data"))), 2)
+            self.assertEqual(plugin.send.qsize(), 2)
+
+    def test_audio_folder_partial_reads(self):
+        with TemporaryDirectory() as dir:
+            sample = generate_audio_sample(8000, channels=2, dtype=np.float32)
+            sample.save(Path(dir, "sample.flac"))
+            folder = AudioFolder(dir)
+            full = folder[0]
+
+            part = folder[0, 1000:3000]
+            self.assertTrue(np.array_equal(part.data, full.data[1000:3000]))
+            self.assertEqual(part.timestamp, full.timestamp + 125_000_000)
+            self.assertTrue(np.array_equal(folder[0, -100:].data, full.data[-100:]))
+            with self.assertRaises(TypeError):
+                folder[0, 1000]
+            with self.assertRaises(ValueError):
+                folder[0, 1000:3000:2]
+
+            blocks = list(folder.blocks(0, blocksize=3000, overlap=1000, dtype="float32"))
+            self.assertEqual(len(blocks), 4)
+            self.assertEqual(blocks[0].data.dtype, np.float32)
+            self.assertEqual(blocks[1].timestamp, full.timestamp + 250_000_000)
+            self.assertTrue(np.allclose(blocks[1].data, full.data[2000:5000]))
+            self.assertTrue(np.allclose(blocks[-1].data, full.data[6000:]))
+
+    def test_audio_folder_memmap(self):
+        import soundfile
+
+        for subtype, dtype in [("PCM_16", "int16"), ("PCM_32", "int32"), ("FLOAT", "float32")]:
+            with TemporaryDirectory() as dir:
+                sample = generate_audio_sample(8000, channels=2, dtype=np.float32)
+                soundfile.write(str(Path(dir, "sample.wav")), sample.data, 8000, subtype=subtype)
+                folder = AudioFolder(dir)
+                mapped = folder.memmap(0)
+                expected, _ = soundfile.read(str(folder.files[0]), dtype=dtype, always_2d=True)
+                self.assertEqual(mapped.samplerate, 8000)
+                self.assertTrue(np.array_equal(mapped.data, expected), msg=subtype)
+
+        with TemporaryDirectory() as dir:
+            generate_audio_sample(8000, channels=1, dtype=np.float32).save(Path(dir, "sample.flac"))
+            with self.assertRaises(ValueError):
+                AudioFolder(dir).memmap(0)
+
+    def test_audio_ring_buffer(self):
+        buffer = AudioRingBuffer(capacity=100, channels=2, samplerate=1000)
+        stream = np.arange(1000, dtype=np.float32).reshape(500, 2)
+
+        buffer.write(stream[:60], timestamp=1_000_000_000)
+        self.assertEqual(buffer.start_timestamp, 940_000_000)
+        sample = buffer.sample(10, 20)
+        self.assertTrue(np.array_equal(sample.data, stream[10:30]))
+        self.assertEqual(sample.timestamp, 950_000_000)
+
+        # contiguous reads of the newest frames are views into the buffer
+        last = buffer.last(30)
+        self.assertTrue(np.array_equal(last.data, stream[30:60]))
+        self.assertTrue(np.shares_memory(last.data, buffer.data))
+
+        # wrapped reads are copied and still ordered correctly
+        buffer.write(stream[60:130])
+        last = buffer.last(50)
+        self.assertTrue(np.array_equal(last.data, stream[80:130]))
+        self.assertFalse(np.shares_memory(last.data, buffer.data))
+
+        # overwritten and future frames can't be read
+        with self.assertRaises(ValueError):
+            buffer.read(0, 10)
+        with self.assertRaises(ValueError):
+            buffer.read(120, 20)
+
+        # oversized writes only keep the newest frames
+        buffer.write(stream[130:500])
+        self.assertEqual(buffer.written, 500)
+        self.assertTrue(np.array_equal(buffer.last(100).data, stream[400:500]))
+
+        with self.assertRaises(TimeoutError):
+            buffer.wait_for(501, timeout=0.01)
+        buffer.close()
+        with self.assertRaises(RuntimeError):
+            buffer.wait_for(501)
+
+    def test_parse_timestamp_ns(self):
+        self.assertEqual(parse_timestamp_ns("2021-06-25T18:52:15.404690128Z"), 1624647135404690128)
+        self.assertEqual(parse_timestamp_ns("2021-06-25T18:52:15Z"), 1624647135000000000)
+        self.assertEqual(parse_timestamp_ns("2021-06-25T18:52:15.4Z"), 1624647135400000000)
+        self.assertEqual(parse_timestamp_ns("2021-06-25T19:52:15.4+01:00"), 1624647135400000000)
+        self.assertEqual(parse_timestamp_ns("1970-01-01T00:00:00.000000001Z"), 1)
+        with self.assertRaises(ValueError):
+            parse_timestamp_ns("June 25th 2021")
+
+    def test_measurements_reader(self):
+        base = 1624647135000000000
+        with TemporaryDirectory() as dir:
+            path1 = Path(dir, "node1.ndjson")
+            path2 = Path(dir, "node2.ndjson")
+            generate_measurements_file(
+                path1,
+                [("env.temperature", i, {"node": "1"}, base + 2 * i * 10**6 + 1) for i in range(1000)],
+            )
+            generate_measurements_file(
+                path2,
+                [("env.humidity", i, {"node": "2"}, base + (2 * i + 1) * 10**6) for i in range(1000)],
+            )
+
+            # MeasurementsFile keeps datetime records but also exposes full precision timestamps
+            mf = MeasurementsFile(path1)
+            self.assertEqual(mf.timestamps[1], base + 2 * 10**6 + 1)
+            self.assertEqual(mf.records[1]["timestamp"], datetime(2021, 6, 25, 18, 52, 15, 2000))
+
+            records = list(MeasurementsReader(path1))
+            self.assertEqual(len(records), 1000)
+            self.assertEqual(records[1]["timestamp"], base + 2 * 10**6 + 1)
+
+            # merging sorted files produces a single sorted stream
+            merged = list(MeasurementsReader(path1, path2))
+            self.assertEqual(len(merged), 2000)
+            self.assertEqual([r["timestamp"] for r in merged], sorted(r["timestamp"] for r in merged))
+            self.assertEqual(merged[1]["name"], "env.humidity")
+
+            # filtering by name, meta and time range
+            filtered = list(MeasurementsReader(path1, path2, names=["env.humidity"]))
+            self.assertEqual({r["name"] for r in filtered}, {"env.humidity"})
+            self.assertEqual(len(filtered), 1000)
+            self.assertEqual(len(list(MeasurementsReader(path1, path2, meta={"node": "1"}))), 1000)
+
+            # non-ascii names are found whether they're written raw or escaped
+            path3 = Path(dir, "unicode.ndjson")
+            with open(path3, "w", encoding="utf-8") as f:
+                for i, ensure_ascii in enumerate([False, True]):
+                    record = {"name": "env.température", "value": i, "meta": {}, "timestamp": "2022-01-01T00:00:00Z"}
+                    print(json.dumps(record, ensure_ascii=ensure_ascii), file=f)
+            filtered = list(MeasurementsReader(path3, names=["env.température"]))
+            self.assertEqual([r["value"] for r in filtered], [0, 1])
+            ranged = list(
+                MeasurementsReader(path1, start=base + 100 * 10**6, end=base + 200 * 10**6, index_stride=1024)
+            )
+            self.assertEqual([r["value"] for r in ranged], list(range(50, 100)))
+
+            # the sparse index seeks close to the start without reading the prefix
+            index = SparseTimeIndex(path1, stride=1024)
+            self.assertGreater(len(index.offsets), 10)
+            offset = index.offset_for(base + 1000 * 10**6)
+            self.assertGreater(offset, 0)
+            with open(path1, "rb") as f:
+                f.seek(offset)
+                self.assertLess(parse_timestamp_ns(json.loads(f.readline())["timestamp"]), base + 1000 * 10**6)
+
+    def test_measurements_replay(self):
+        base = 1624647135000000000
+        with TemporaryDirectory() as dir:
+            path = Path(dir, "data.ndjson")
+            # 2s of records, with pairs of records 1us apart
+            records = [
+                ("env.count", i, {}, base + (i // 2) * 200 * 10**6 + (i % 2) * 1000)
+                for i in range(20)
+            ]
+            records.insert(10, ("upload", "file.jpg", {}, base + 10**9))
+            generate_measurements_file(path, records)
+            mf = MeasurementsFile(path)
+
+            start = time.monotonic()
+            self.assertEqual(len(list(mf.play(speed=10.0))), 21)
+            elapsed = time.monotonic() - start
+            self.assertGreaterEqual(elapsed, 0.18)
+            self.assertLess(elapsed, 0.5)
+
+            plugin = RecordingPlugin()
+            start = time.monotonic()
+            published = MeasurementsReader(path).replay_into(plugin, speed=10.0)
+            elapsed = time.monotonic() - start
+            self.assertEqual(published, 20)
+            self.assertGreaterEqual(elapsed, 0.18)
+            self.assertEqual(
+                [(name, ts) for name, _, _, ts in plugin.published],
+                [(name, ts) for name, _, _, ts in records if name != "upload"],
+            )
+
+            # replay timing must not drift when handling each record takes a while
+            start = time.monotonic()
+            for r in mf.play(speed=10.0):
+                time.sleep(0.005)
+            self.assertLess(time.monotonic() - start, 0.25)
+
+    def test_measurements_columns(self):
+        base = 1624647135000000000
+        with TemporaryDirectory() as dir:
+            path = Path(dir, "data.ndjson")
+            records = [
+                ("env.temperature", 20 + i * 0.5, {"sensor": ["bme280", "bme680"][i % 2]}, base + i)
+                for i in range(10)
+            ]
+            records += [("env.count", i, {"camera": "left"} if i % 2 else {}, base + 100 - i) for i in range(5)]
+            records += [("env.label", "cat", {}, base + 200)]
+            generate_measurements_file(path, records)
+
+            columns = MeasurementsFile(path).to_columns()
+            self.assertEqual(set(columns), {"env.temperature", "env.count", "env.label"})
+
+            temperature = columns["env.temperature"]
+            self.assertEqual(temperature.timestamp.dtype, np.int64)
+            self.assertEqual(temperature.value.dtype, np.float64)
+            self.assertTrue(np.array_equal(temperature.timestamp, base + np.arange(10)))
+            self.assertEqual(temperature.meta["sensor"].categories, ["bme280", "bme680"])
+            self.assertEqual(temperature.meta["sensor"].codes.tolist(), [0, 1] * 5)
+
+            # columns are timestamp ordered and missing meta is encoded as -1
+            count = columns["env.count"]
+            self.assertEqual(count.value.dtype, np.int64)
+            self.assertEqual(count.value.tolist(), [4, 3, 2, 1, 0])
+            self.assertEqual(count.meta["camera"].decode(), [None, "left", None, "left", None])
+            self.assertEqual(columns["env.label"].value.tolist(), ["cat"])
+
+            # columns are only cached when asked to
+            read_columns(path)
+            self.assertFalse(Path(dir, "data.ndjson.columns.npz").exists())
+
+            # cached columns are reused until the source file changes
+            cached = read_columns(path, names=["env.count"], cache=True)
+            self.assertTrue(Path(dir, "data.ndjson.columns.npz").exists())
+            self.assertEqual(list(cached), ["env.count"])
+            cached = read_columns(path, cache=True)
+            self.assertTrue(np.array_equal(cached["env.temperature"].value, temperature.value))
+            self.assertEqual(cached["env.count"].meta["camera"].decode(), count.meta["camera"].decode())
+
+            generate_measurements_file(path, records[:3])
+            self.assertEqual(len(read_columns(path, cache=True)["env.temperature"].value), 3)
+
+            # failing to write the cache isn't fatal
+            generate_measurements_file(path, records[:5])
+            Path(dir, "data.ndjson.columns.npz.tmp").mkdir()
+            with self.assertLogs("waggle.data.measurements", "WARNING"):
+                columns = read_columns(path, cache=True)
+            self.assertEqual(len(columns["env.temperature"].value), 5)
+
     def test_get_timestamp(self):
         ts = get_timestamp()
         self.assertIsInstance(ts, int)
 
+    def test_image_handler(self):
+        server = ImageServer()
+        try:
+            with ImageHandler({}, server.url, pixel_format="bgr") as handler:
+                ts1, img1 = handler.get(timeout=5)
+                self.assertEqual(img1.shape, (48, 64, 3))
+                # unchanged images are not downloaded or decoded again
+                ts2, img2 = handler.get(timeout=5)
+                self.assertEqual(ts1, ts2)
+                self.assertTrue(np.array_equal(img1, img2))
+                # changes made by the caller don't leak into later unchanged images
+                want = img1.copy()
+                img1[:] = 255 - img1
+                ts2, img2 = handler.get(timeout=5)
+                self.assertTrue(np.array_equal(img2, want))
+
+                image = np.full((48, 64, 3), 255, dtype=np.uint8)
+                server.set_image(image)
+                ts3, img3 = handler.get(timeout=5)
+                self.assertGreater(ts3, ts1)
+                self.assertTrue(np.array_equal(img3, image))
+
+            self.assertEqual(server.requests, 4)
+            # all requests reused a single keep-alive connection
+            self.assertEqual(server.connections, 1)
+
+            with ImageHandler({}, server.url, pixel_format="rgb", prefetch=True) as handler:
+                for _ in range(3):
+                    ts, img = handler.get(timeout=5)
+                    self.assertTrue(np.array_equal(img, image))
+            self.assertEqual(server.connections, 2)
+        finally:
+            server.close()
+
+    def test_frame_buffer(self):
+        frames = FrameBuffer(2)
+        with self.assertRaises(TimeoutError):
+            frames.get(timeout=0.01)
+        for i in range(5):
+            frames.put(i)
+        self.assertEqual(frames.dropped, 3)
+        self.assertEqual(frames.get(), 3)
+        self.assertEqual(frames.get(), 4)
+        frames.put(5)
+        frames.close()
+        # remaining frames are still delivered after the stream ends
+        self.assertEqual(frames.get(), 5)
+        with self.assertRaises(RuntimeError):
+            frames.get()
+
+    def test_video_handler(self):
+        with TemporaryDirectory() as dir:
+            path = Path(dir, "video.avi")
+            generate_video_file(path, frames=20)
+
+            with VideoHandler({}, str(path), pixel_format="rgb") as handler:
+                # wait for the capture to read through the whole file
+                handler.subscriber.shared.done.wait(5)
+                ts, img = handler.get(timeout=1)
+                self.assertEqual(img.shape, (48, 64, 3))
+                with self.assertRaises(RuntimeError):
+                    handler.get(timeout=1)
+                # only the newest frame was kept and converted
+                self.assertEqual(
+                    handler.stats(),
+                    {"frames_read": 20, "frames_dropped": 19, "frames_converted": 1},
+                )
+
+    def test_shared_capture(self):
+        with TemporaryDirectory() as dir:
+            path = Path(dir, "video.avi")
+            generate_video_file(path, frames=200)
+            device = str(path)
+
+            first = subscribe(device, continuous=False)
+            second = subscribe(device, buffer=4)
+            try:
+                # both subscribers share a single upstream capture
+                self.assertIs(first.shared, second.shared)
+                self.assertEqual(capture_stats()[device]["subscribers"], 2)
+
+                ts1, frame1 = first.get(timeout=5)
+                ts2, frame2 = second.get(timeout=5)
+                self.assertEqual(frame1.shape, (48, 64, 3))
+                self.assertEqual(frame2.shape, (48, 64, 3))
+                # subscribers never share the same frame array
+                self.assertFalse(np.shares_memory(frame1, frame2))
+            finally:
+                first.close()
+                second.close()
+
+            # the capture is closed once its last subscriber is released
+            self.assertTrue(first.shared.done.is_set())
+            self.assertNotIn(device, capture_stats())
+
+            with VideoHandler({}, device) as h1, VideoHandler({}, device, pixel_format="bgr") as h2:
+                self.assertIs(h1.subscriber.shared, h2.subscriber.shared)
+                self.assertEqual(h1.get(timeout=5)[1].shape, (48, 64, 3))
+                self.assertEqual(h2.get(timeout=5)[1].shape, (48, 64, 3))
+
+    def test_shared_capture_slow_open(self):
+        from waggle.data.capture import SharedCapture
+
+        opening = threading.Event()
+        unblock = threading.Event()
+        open_device = SharedCapture.open
+
+        def slow_open(self):
+            if self.device == "rtsp://slow":
+                opening.set()
+                unblock.wait(5)
+                raise RuntimeError("unable to open")
+            open_device(self)
+
+        with TemporaryDirectory() as dir:
+            path = Path(dir, "video.avi")
+            generate_video_file(path, frames=20)
+            errors = []
+
+            def subscribe_slow():
+                try:
+                    subscribe("rtsp://slow")
+                except RuntimeError as exc:
+                    errors.append(exc)
+
+            with unittest.mock.patch.object(SharedCapture, "open", slow_open):
+                thread = threading.Thread(target=subscribe_slow)
+                thread.start()
+                self.assertTrue(opening.wait(5))
+                # a slow device doesn't hold up opening other devices
+                subscriber = subscribe(str(path))
+                try:
+                    ts, frame = subscriber.get(timeout=5)
+                    self.assertEqual(frame.shape, (48, 64, 3))
+                finally:
+                    subscriber.close()
+                unblock.set()
+                thread.join()
+            self.assertEqual(len(errors), 1)
+            self.assertNotIn("rtsp://slow", capture_stats())
+
+    def test_data_config(self):
+        with TemporaryDirectory() as dir:
+            path = Path(dir, "data-config.json")
+            config = DataConfig(path)
+
+            # missing config file acts as an empty config
+            self.assertEqual(config.sections(), [])
+            self.assertIsNone(config.get("bottom_camera"))
+
+            path.write_text(
+                json.dumps(
+                    [
+                        {
+                            "match": {"id": "bottom_camera", "type": "video"},
+                            "handler": {"type": "video", "args": {"url": "rtsp://bottom"}},
+                        },
+                        {
+                            "match": {"id": "top_camera", "type": "video"},
+                            "handler": {"type": "video", "args": {"url": "rtsp://top"}},
+                        },
+                    ]
+                )
+            )
+            self.assertEqual(config.get("bottom_camera")["handler"]["args"]["url"], "rtsp://bottom")
+            self.assertEqual(len(config.find_all_matches({"type": "video"})), 2)
+            self.assertEqual(len(config.find_all_matches({"id": "top_camera"})), 1)
+            self.assertEqual(config.find_all_matches({"id": "missing"}), [])
+            self.assertEqual(config.find_all_matches({"color": "red"}), [])
+
+            # updating the file must invalidate the cached config
+            path.write_text(json.dumps([]))
+            os.utime(path, ns=(0, 0))
+            self.assertIsNone(config.get("bottom_camera"))
+            self.assertEqual(config.find_all_matches({"type": "video"}), [])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+import json
+import subprocess
+import sys
+
+# heavy optional dependencies which must only be imported on first use
+DEFERRED_MODULES = ["cv2", "ffmpeg", "numpy", "pika", "soundcard", "soundfile"]
+
+# import time budget in seconds for the core pywaggle modules. this is intentionally
+# generous to avoid flaky CI runs, but still catches any heavy dependency sneaking back
+# into the import path.
+IMPORT_TIME_BUDGET = 0.5
+
+IMPORT_SCRIPT = """
+import json
+import sys
+import time
+
+start = time.perf_counter()
+import waggle.plugin
+import waggle.data
+import waggle.data.audio
+import waggle.data.vision
+elapsed = time.perf_counter() - start
+
+print(json.dumps({
+    "elapsed": elapsed,
+    "modules": [m for m in %r if m in sys.modules],
+}))
+"""
+
+
+LOG_DIR_SCRIPT = """
+import json
+import os
+import sys
+import tempfile
+
+from waggle.plugin import Plugin
+
+with tempfile.TemporaryDirectory() as dir:
+    os.environ["PYWAGGLE_LOG_DIR"] = dir
+    os.environ["WAGGLE_PLUGIN_TRANSPORT"] = "none"
+    with Plugin() as plugin:
+        plugin.publish("test", 1)
+
+print(json.dumps({"pika": "pika" in sys.modules}))
+"""
+
+
+def run_import_script():
+    output = subprocess.check_output(
+        [sys.executable, "-c", IMPORT_SCRIPT % (DEFERRED_MODULES,)]
+    )
+    return json.loads(output)
+
+
+class TestImports(unittest.TestCase):
+    def test_deferred_imports(self):
+        result = run_import_script()
+        self.assertEqual(result["modules"], [])
+
+    def test_log_only_skips_broker(self):
+        # log only runs never need the broker client
+        output = subprocess.check_output([sys.executable, "-c", LOG_DIR_SCRIPT])
+        self.assertEqual(json.loads(output), {"pika": False})
+
+    def test_import_time_budget(self):
+        # take the best of a few runs to reduce noise from a cold disk cache
+        elapsed = min(run_import_script()["elapsed"] for _ in range(3))
+        self.assertLess(elapsed, IMPORT_TIME_BUDGET)
+
+
+if __name__ == "__main__":
+    unittest.main()
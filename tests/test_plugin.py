@@ -1,4 +1,5 @@
 import unittest
+import unittest.mock
 from pathlib import Path
 import json
 from tempfile import TemporaryDirectory
@@ -7,8 +8,51 @@ from datetime import datetime
 import os
 import pika
 import subprocess
+import sys
+from queue import Queue
+from threading import Event
+from types import SimpleNamespace
 
 from waggle.plugin import Plugin, PluginConfig, Uploader, get_timestamp
+from waggle import tracing
+from waggle.plugin import open_shared
+from waggle.plugin.encoding import (
+    BATCH_CONTENT_TYPE,
+    Compressor,
+    can_batch,
+    decode_batch,
+    decompress_body,
+    encode_batch,
+    packb,
+    unpackb,
+)
+from waggle.plugin import governor as governor_module
+from waggle.plugin.governor import (
+    Governor,
+    read_process_cpu_seconds,
+    read_system_cpu_times,
+    read_temperature,
+)
+from waggle.plugin.scheduler import seconds_until_aligned
+from waggle.plugin.shared import SharedMemoryPool
+from waggle.plugin.stats import StatsReporter
+from waggle.plugin.timings import TimingHistogram
+from waggle.plugin import transport as transport_module
+from waggle.plugin.plugin import PublishData
+from waggle.plugin.transport import (
+    FRAME_HEADER,
+    MemoryBroker,
+    MemoryTransport,
+    NullTransport,
+    UnixSocketBroker,
+    UnixSocketPublisher,
+    compile_topic,
+    connect_unix_socket,
+    decode_publish_frame,
+    encode_frame,
+    get_transport,
+    topics_match,
+)
 import wagglemsg
 
 # TODO(sean) add integration testing against rabbitmq
@@ -166,6 +210,445 @@ class TestPlugin(unittest.TestCase):
             msg = wagglemsg.load(item.body)
             self.assertEqual(msg.name, "dur")
 
+    def test_timeit_aggregate(self):
+        with Plugin(timings_interval=3600.0) as plugin:
+            for _ in range(100):
+                with plugin.timeit("dur", aggregate=True):
+                    pass
+            with plugin.timeit("dur", aggregate=True):
+                time.sleep(0.01)
+
+            # nothing is published until the window is flushed
+            self.assertTrue(plugin.send.empty())
+
+            summary = plugin.timings()["dur"]
+            self.assertEqual(summary.count, 101)
+            self.assertGreaterEqual(summary.max, 10_000_000)
+            self.assertLessEqual(summary.p50, summary.p95)
+            self.assertLessEqual(summary.p99, summary.max)
+
+            plugin.publish_timings()
+            msgs = {}
+            while not plugin.send.empty():
+                msg = wagglemsg.load(plugin.send.get().body)
+                msgs[msg.name] = msg.value
+            self.assertEqual(
+                set(msgs),
+                {"dur.count", "dur.mean", "dur.p50", "dur.p95", "dur.p99", "dur.max"},
+            )
+            self.assertEqual(msgs["dur.count"], 101)
+            self.assertEqual(msgs["dur.max"], summary.max)
+
+            # lifetime timings are kept after publishing
+            self.assertEqual(plugin.timings()["dur"].count, 101)
+
+            with self.assertRaises(ValueError):
+                with plugin.timeit("bad name", aggregate=True):
+                    pass
+            # names which are only too long once a summary suffix is added
+            with self.assertRaises(ValueError):
+                with plugin.timeit("x" * 125, aggregate=True):
+                    pass
+            self.assertNotIn("x" * 125, plugin.timings())
+
+    def test_stats(self):
+        with TemporaryDirectory() as tempdir:
+            uploader = Uploader(Path(tempdir, "uploads"))
+            upload_path = Path(tempdir, "myfile.txt")
+            upload_path.write_bytes(b"0123456789")
+
+            with Plugin(uploader=uploader) as plugin:
+                plugin.publish("test", 1)
+                plugin.publish("test", "two")
+                plugin.upload_file(upload_path)
+
+                stats = plugin.stats()
+                self.assertEqual(stats["publish.count"], 3)
+                self.assertGreater(stats["publish.bytes"], 0)
+                self.assertEqual(stats["send.queue_depth"], 3)
+                self.assertEqual(stats["recv.queue_depth"], 0)
+                self.assertEqual(stats["upload.count"], 1)
+                self.assertEqual(stats["upload.bytes"], 10)
+                self.assertGreater(stats["upload.latency.max"], 0)
+                self.assertIn("rabbitmq.reconnects", stats)
+                self.assertIn("rabbitmq.publish.latency.p99", stats)
+                self.assertIsInstance(stats["captures"], dict)
+
+    def test_stats_report(self):
+        with Plugin(stats_interval=0.05) as plugin:
+            plugin.publish("test", 1)
+            time.sleep(0.2)
+
+            names = set()
+            while not plugin.send.empty():
+                names.add(wagglemsg.load(plugin.send.get().body).name)
+            self.assertIn("sys.plugin.publish.count", names)
+            self.assertIn("sys.plugin.publish.rate", names)
+            self.assertIn("sys.plugin.send.queue_depth", names)
+
+            # the sys.plugin namespace is reserved for the plugin itself
+            with self.assertRaises(ValueError):
+                plugin.publish("sys.plugin.publish.count", 0)
+
+    def test_stats_custom_uploader(self):
+        class CustomUploader:
+            def upload_file(self, path, meta, timestamp, keep=False):
+                return Path(path)
+
+        with Plugin(uploader=CustomUploader()) as plugin:
+            self.assertEqual(plugin.stats()["publish.count"], 0)
+
+    def test_stats_reporter_errors(self):
+        calls = []
+        published = []
+        stop = Event()
+
+        def get_stats():
+            calls.append(None)
+            if len(calls) <= 2:
+                raise AttributeError("stats")
+            return {"publish.count": 0, "captures": {}}
+
+        def publish(name, value, meta, timestamp):
+            published.append(name)
+
+        with self.assertLogs("waggle.plugin.stats", "ERROR"):
+            reporter = StatsReporter(get_stats, publish, 0.01, stop)
+            # failing to get stats doesn't stop the reporter
+            while "sys.plugin.publish.rate" not in published:
+                time.sleep(0.01)
+        stop.set()
+        reporter.done.wait()
+
+    def test_timing_histogram(self):
+        hist = TimingHistogram()
+        for duration in range(1, 10001):
+            hist.record(duration * 1000)
+        summary = hist.summary()
+        self.assertEqual(summary.count, 10000)
+        self.assertEqual(summary.max, 10_000_000)
+        # percentiles are within the bucket relative error
+        self.assertAlmostEqual(summary.p50, 5_000_000, delta=5_000_000 / 16)
+        self.assertAlmostEqual(summary.p99, 9_900_000, delta=9_900_000 / 16)
+
+
+class Sample:
+    def __init__(self, value, timestamp):
+        self.value = value
+        self.timestamp = timestamp
+
+
+def square(sample):
+    # sleep longest for the first samples so they finish out of order
+    time.sleep(0.001 * (10 - sample.value % 10))
+    return "square", sample.value**2, {"input": str(sample.value)}
+
+
+def drain_messages(plugin):
+    msgs = []
+    while not plugin.send.empty():
+        msgs.append(wagglemsg.load(plugin.send.get().body))
+    return msgs
+
+
+class TestPluginMap(unittest.TestCase):
+    def test_map_ordered(self):
+        base = get_timestamp()
+        samples = [Sample(i, base + i) for i in range(30)]
+        for mode in ["thread", "process"]:
+            plugin = Plugin(get_transport_config("memory"))
+            n = plugin.map(square, samples, workers=4, mode=mode)
+            self.assertEqual(n, 30)
+            msgs = drain_messages(plugin)
+            self.assertEqual([msg.value for msg in msgs], [i**2 for i in range(30)])
+            self.assertEqual([msg.timestamp for msg in msgs], [base + i for i in range(30)])
+            self.assertEqual(msgs[3].meta, {"input": "3"})
+
+    def test_map_unordered(self):
+        plugin = Plugin(get_transport_config("memory"))
+        samples = [Sample(i, None) for i in range(30)]
+        plugin.map(square, samples, workers=4, ordered=False)
+        values = [msg.value for msg in drain_messages(plugin)]
+        self.assertEqual(sorted(values), [i**2 for i in range(30)])
+
+    def test_map_results(self):
+        plugin = Plugin(get_transport_config("memory"))
+
+        def fn(x):
+            if x == 0:
+                return None
+            return [("count", x), ("label", str(x), {"kind": "test"})]
+
+        self.assertEqual(plugin.map(fn, range(3), workers=2), 4)
+        msgs = drain_messages(plugin)
+        self.assertEqual(
+            [(msg.name, msg.value) for msg in msgs],
+            [("count", 1), ("label", "1"), ("count", 2), ("label", "2")],
+        )
+
+        with self.assertRaises(TypeError):
+            plugin.map(lambda x: x, range(3))
+        with self.assertRaises(ValueError):
+            plugin.map(fn, range(3), mode="gpu")
+
+    def test_map_bounded(self):
+        plugin = Plugin(get_transport_config("memory"))
+        in_flight = []
+
+        def source():
+            for i in range(20):
+                # samples pulled so far minus results published
+                in_flight.append(i - plugin.send.qsize())
+                yield i
+
+        def fn(x):
+            time.sleep(0.001)
+            return "value", x
+
+        plugin.map(fn, source(), workers=2, max_in_flight=3)
+        self.assertEqual(plugin.send.qsize(), 20)
+        # a new sample is only pulled once fewer than max_in_flight are pending
+        self.assertEqual(max(in_flight), 2)
+
+    def test_map_error(self):
+        plugin = Plugin(get_transport_config("memory"))
+
+        def fn(x):
+            if x == 5:
+                raise RuntimeError("bad sample")
+            return "value", x
+
+        with self.assertRaises(RuntimeError):
+            plugin.map(fn, range(100), workers=2)
+
+
+class TestPluginScheduler(unittest.TestCase):
+    def test_seconds_until_aligned(self):
+        self.assertAlmostEqual(seconds_until_aligned(60, 120.0), 0)
+        self.assertAlmostEqual(seconds_until_aligned(60, 130.0), 50)
+        self.assertAlmostEqual(seconds_until_aligned(0.5, 10.25), 0.25)
+
+    def test_every(self):
+        plugin = Plugin(get_transport_config("memory"))
+        calls = []
+
+        def fn():
+            calls.append(time.monotonic())
+            # slow calls must not make later calls drift
+            time.sleep(0.01)
+
+        task = plugin.every(0.05, fn, align=False)
+        plugin.run(duration=0.33)
+        self.assertEqual(task.runs, len(calls))
+        self.assertIn(len(calls), [6, 7])
+        for i, t in enumerate(calls):
+            self.assertAlmostEqual(t - calls[0], i * 0.05, delta=0.01)
+        self.assertEqual(task.overruns, 0)
+
+    def test_every_aligned(self):
+        plugin = Plugin(get_transport_config("memory"))
+        calls = []
+        task = plugin.every(0.1, lambda: calls.append(time.time()))
+        plugin.run(duration=0.35)
+        self.assertIn(len(calls), [3, 4])
+        for t in calls:
+            # calls land just after a wall clock multiple of the interval
+            self.assertLess((t + 0.05) % 0.1 - 0.05, 0.03)
+
+    def test_every_registered_before_run(self):
+        plugin = Plugin(get_transport_config("memory"))
+        calls = []
+        aligned = plugin.every(0.05, lambda: calls.append(time.time()))
+        unaligned = plugin.every(0.05, lambda: None, align=False)
+        # deadlines passing before run starts must not count as overruns
+        time.sleep(0.18)
+        plugin.run(duration=0.12)
+        self.assertEqual(aligned.overruns, 0)
+        self.assertEqual(unaligned.overruns, 0)
+        self.assertEqual(plugin.stats()["scheduler.overruns"], 0)
+        self.assertIn(len(calls), [2, 3])
+
+    def test_every_overrun(self):
+        plugin = Plugin(get_transport_config("memory"))
+
+        def slow():
+            if task.runs == 0:
+                time.sleep(0.13)
+
+        task = plugin.every(0.05, slow, align=False)
+        plugin.run(duration=0.28)
+        # deadlines at 0.05 and 0.10 were missed while the first call ran
+        self.assertEqual(task.overruns, 2)
+        self.assertEqual(plugin.stats()["scheduler.overruns"], 2)
+
+    def test_every_grouped_publish(self):
+        plugin = Plugin(get_transport_config("memory"))
+        queued = []
+
+        def first():
+            plugin.publish("first", 1)
+
+        def second():
+            # messages from the same tick are queued together once all tasks finish
+            queued.append(plugin.send.qsize())
+            plugin.publish("second", 2)
+
+        plugin.every(0.05, first, align=False)
+        plugin.every(0.05, second, align=False)
+        plugin.run(duration=0.12)
+        self.assertEqual(queued, [0, 2, 4])
+        names = [msg.name for msg in drain_messages(plugin)]
+        self.assertEqual(names, ["first", "second"] * 3)
+
+    def test_every_cancel(self):
+        plugin = Plugin(get_transport_config("memory"))
+
+        def fn():
+            if task.runs == 2:
+                task.cancel()
+
+        task = plugin.every(0.01, fn, align=False)
+        # run returns once all tasks are cancelled
+        plugin.run()
+        self.assertEqual(task.runs, 3)
+
+        with self.assertRaises(ValueError):
+            plugin.every(0, fn)
+
+
+class FakeNode:
+    """
+    FakeNode stands in for the clock, /proc and /sys readings used by Governor.
+    """
+
+    def __init__(self):
+        self.clock = 0.0
+        self.cpu_seconds = 0.0
+        self.temperature = None
+
+    def patch(self):
+        from contextlib import ExitStack
+
+        stack = ExitStack()
+        for name, value in [
+            ("monotonic", lambda: self.clock),
+            ("read_process_cpu_seconds", lambda pid="self": self.cpu_seconds),
+            ("read_system_cpu_times", lambda: None),
+            ("read_temperature", lambda: self.temperature),
+        ]:
+            stack.enter_context(unittest.mock.patch.object(governor_module, name, value))
+        return stack
+
+    def advance(self, seconds, cpu_seconds):
+        self.clock += seconds
+        self.cpu_seconds += cpu_seconds
+
+
+class TestGovernor(unittest.TestCase):
+    def test_readers(self):
+        with TemporaryDirectory() as dir:
+            root = Path(dir)
+            Path(root, "stat").write_text(
+                "cpu  100 0 50 800 50 0 0 0 0 0\ncpu0 100 0 50 800 50 0 0 0 0 0\n"
+            )
+            self.assertEqual(read_system_cpu_times(Path(root, "stat")), (150, 1000))
+            self.assertIsNone(read_system_cpu_times(Path(root, "missing")))
+
+            Path(root, "42").mkdir()
+            ticks = os.sysconf("SC_CLK_TCK")
+            fields = ["S"] + ["0"] * 10 + [str(3 * ticks), str(ticks)] + ["0"] * 10
+            Path(root, "42", "stat").write_text("42 (my (plugin)) " + " ".join(fields))
+            self.assertEqual(read_process_cpu_seconds(42, root), 4.0)
+            self.assertIsNone(read_process_cpu_seconds(43, root))
+
+            self.assertIsNone(read_temperature(root))
+            for i, temp in enumerate(["45000", "61500", "bad"]):
+                Path(root, f"thermal_zone{i}").mkdir()
+                Path(root, f"thermal_zone{i}", "temp").write_text(temp)
+            self.assertEqual(read_temperature(root), 61.5)
+
+    def test_update(self):
+        node = FakeNode()
+        with node.patch():
+            plugin = Plugin(get_transport_config("memory"))
+            governor = plugin.govern(cpu_budget=0.25, max_temperature=75)
+            governor.cpu_count = 1
+
+            # using a whole core backs off by at most half per update
+            node.advance(1, 1.0)
+            self.assertEqual(governor.poll(), 0.5)
+            # usage falls with the rate, so the governor settles on the budget
+            node.advance(1, 0.5)
+            self.assertEqual(governor.poll(), 0.25)
+            node.advance(1, 0.26)
+            self.assertEqual(governor.poll(), 0.25)
+            # getting too hot backs off regardless of budget
+            node.temperature = 80
+            node.advance(1, 0.125)
+            self.assertEqual(governor.poll(), 0.125)
+            # with headroom, the governor ramps up gently
+            node.temperature = 50
+            node.advance(1, 0.05)
+            self.assertEqual(governor.poll(), 0.15625)
+
+            stats = plugin.stats()
+            self.assertEqual(stats["governor.scale"], 0.15625)
+            self.assertEqual(stats["governor.adjustments"], 4)
+            self.assertEqual(stats["governor.temperature"], 50)
+
+        decisions = [(msg.name, msg.value, msg.meta["reason"]) for msg in drain_messages(plugin)]
+        self.assertEqual(
+            decisions,
+            [
+                ("sys.plugin.governor.scale", 0.5, "cpu"),
+                ("sys.plugin.governor.scale", 0.25, "cpu"),
+                ("sys.plugin.governor.scale", 0.125, "thermal"),
+                ("sys.plugin.governor.scale", 0.15625, "headroom"),
+            ],
+        )
+
+        with self.assertRaises(RuntimeError):
+            plugin.govern(cpu_budget=0.5)
+        with self.assertRaises(ValueError):
+            Governor(cpu_budget=0)
+
+    def test_throttle(self):
+        governor = Governor(cpu_budget=0.5, interval=60)
+        governor.scale = 0.5
+        start = time.monotonic()
+        for _ in range(5):
+            time.sleep(0.02)
+            governor.throttle()
+        # every iteration after the first sleeps as long as it worked
+        self.assertAlmostEqual(governor.stats()["governor.throttled_seconds"], 0.08, delta=0.02)
+        self.assertGreaterEqual(time.monotonic() - start, 0.18)
+
+    def test_admit(self):
+        governor = Governor(cpu_budget=0.5, interval=60)
+        governor.scale = 0.25
+        admitted = [governor.admit("a") for _ in range(8)]
+        self.assertEqual(admitted, [True, False, False, False] * 2)
+        # calls with different keys are admitted independently
+        self.assertTrue(governor.admit("b"))
+        self.assertEqual(governor.stats()["governor.skipped"], 6)
+        self.assertEqual(governor.interval(10), 40)
+
+    def test_governed_loops(self):
+        plugin = Plugin(get_transport_config("memory"))
+        governor = plugin.govern(cpu_budget=0.5, interval=60)
+        governor.scale = 0.5
+
+        calls = []
+        task = plugin.every(0.02, lambda: calls.append(1), align=False, governor=governor)
+        plugin.run(duration=0.19)
+        self.assertEqual(task.runs, len(calls))
+        self.assertEqual(len(calls), 5)
+
+        samples = [Sample(i, get_timestamp()) for i in range(4)]
+        self.assertEqual(plugin.map(square, samples, workers=2, governor=governor), 4)
+        values = [msg.value for msg in drain_messages(plugin)]
+        self.assertEqual(values, [0, 1, 4, 9])
+
 
 class TestUploader(unittest.TestCase):
     def test_upload_file(self):
@@ -187,6 +670,542 @@ class TestUploader(unittest.TestCase):
             self.assertEqual(meta["labels"]["filename"], upload_path.name)
 
 
+def get_transport_config(transport):
+    return PluginConfig(
+        username="plugin",
+        password="plugin",
+        host="fake-rabbitmq-host",
+        port=5672,
+        app_id="",
+        transport=transport,
+    )
+
+
+class TestTransports(unittest.TestCase):
+    def test_topics_match(self):
+        testcases = [
+            ("test", "test", True),
+            ("test", "test.value", False),
+            ("env.*", "env.temperature", True),
+            ("env.*", "env.temperature.raw", False),
+            ("env.#", "env", True),
+            ("env.#", "env.temperature.raw", True),
+            ("#.raw", "env.temperature.raw", True),
+            ("#", "anything.at.all", True),
+        ]
+        for topic, name, want in testcases:
+            self.assertEqual(topics_match([compile_topic(topic)], name), want, (topic, name))
+
+    def test_get_transport(self):
+        self.assertEqual(type(get_transport("rabbitmq")).__name__, "RabbitMQTransport")
+        self.assertIsInstance(get_transport("memory"), MemoryTransport)
+        self.assertIsInstance(get_transport("none"), NullTransport)
+        self.assertEqual(get_transport("unix:///tmp/plugin.sock").path, "/tmp/plugin.sock")
+        with self.assertRaises(ValueError):
+            get_transport("carrier-pigeon")
+
+    def test_memory_transport(self):
+        config = get_transport_config("memory")
+        with Plugin(config) as subscriber, Plugin(config) as publisher:
+            subscriber.subscribe("env.#")
+            publisher.publish("env.temperature", 23.1, meta={"sensor": "bme680"})
+            publisher.publish("sys.uptime", 100)
+            msg = subscriber.get(timeout=1)
+            self.assertEqual(msg.name, "env.temperature")
+            self.assertEqual(msg.value, 23.1)
+            self.assertEqual(msg.meta, {"sensor": "bme680"})
+            with self.assertRaises(TimeoutError):
+                subscriber.get(timeout=0.2)
+
+    def test_null_transport(self):
+        with Plugin(get_transport_config("none")) as plugin:
+            plugin.subscribe("#")
+            plugin.publish("test", 1)
+            with self.assertRaises(TimeoutError):
+                plugin.get(timeout=0.2)
+        self.assertEqual(plugin.stats()["none.discarded"], 1)
+
+    def test_log_dir_still_publishes(self):
+        with TemporaryDirectory() as dir:
+            try:
+                os.environ["PYWAGGLE_LOG_DIR"] = dir
+                plugin = Plugin(get_transport_config("rabbitmq"))
+                plugin.publish("test", 1)
+                plugin.file_publisher.close()
+            finally:
+                del os.environ["PYWAGGLE_LOG_DIR"]
+            self.assertIn('"test"', Path(dir, "data.ndjson").read_text())
+        # messages are written to the run log and still queued for the broker
+        msg = wagglemsg.load(plugin.send.get_nowait().body)
+        self.assertEqual(msg.name, "test")
+
+    def test_memory_transport_private_broker(self):
+        broker = MemoryBroker()
+        with Plugin(get_transport_config("memory")) as plugin:
+            plugin.transport = MemoryTransport(broker)
+            plugin.subscribe("test")
+            self.assertEqual(len(broker.subscribers), 1)
+        self.assertEqual(len(broker.subscribers), 0)
+
+    def test_unix_socket_transport(self):
+        with TemporaryDirectory() as dir:
+            path = Path(dir, "plugin.sock")
+            config = get_transport_config(f"unix://{path}")
+            with UnixSocketBroker(path) as broker:
+                with Plugin(config) as subscriber, Plugin(config) as publisher:
+                    subscriber.subscribe("env.temperature")
+                    # wait for subscription to reach the broker
+                    for _ in range(100):
+                        if broker.stats()["subscribers"] == 1:
+                            break
+                        time.sleep(0.01)
+                    for i in range(10):
+                        publisher.publish("env.temperature", i)
+                    publisher.publish("env.humidity", 50)
+                    values = [subscriber.get(timeout=1).value for _ in range(10)]
+                    self.assertEqual(values, list(range(10)))
+                    with self.assertRaises(TimeoutError):
+                        subscriber.get(timeout=0.2)
+                    self.assertEqual(publisher.stats()["unix.connected"], 1)
+            self.assertFalse(path.exists())
+
+    def test_unix_socket_slow_subscriber(self):
+        with TemporaryDirectory() as dir:
+            path = Path(dir, "plugin.sock")
+            config = get_transport_config(f"unix://{path}")
+            with UnixSocketBroker(path, max_pending=1024 * 1024) as broker:
+                # stalled subscriber which never reads its messages
+                stalled = connect_unix_socket(path)
+                stalled.sendall(encode_frame(b"S", json.dumps(["env.#"]).encode()))
+                with Plugin(config) as subscriber, Plugin(config) as publisher:
+                    subscriber.subscribe("env.#")
+                    for _ in range(100):
+                        if broker.stats()["subscribers"] == 2:
+                            break
+                        time.sleep(0.01)
+                    # the stalled subscriber falls behind, but doesn't hold up the others
+                    value = "x" * 64 * 1024
+                    received = []
+                    for i in range(0, 200, 10):
+                        for j in range(i, i + 10):
+                            publisher.publish("env.image", value, meta={"i": str(j)})
+                        for _ in range(10):
+                            received.append(subscriber.get(timeout=5).meta["i"])
+                    self.assertEqual(received, [str(i) for i in range(200)])
+                    self.assertGreater(broker.stats()["dropped"], 0)
+                stalled.close()
+
+    def test_unix_socket_publisher_resends_in_order(self):
+        sent = []
+        failures = [1]
+
+        class FlakySocket:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def sendall(self, data):
+                if failures[0] > 0:
+                    failures[0] -= 1
+                    raise ConnectionError("broken pipe")
+                sent.append(data)
+
+        messages = Queue()
+        for i in range(5):
+            messages.put(make_publish_data(i))
+        stop = Event()
+        with unittest.mock.patch.object(
+            transport_module, "connect_unix_socket", lambda path: FlakySocket()
+        ):
+            publisher = UnixSocketPublisher("unused", messages, stop)
+            for _ in range(100):
+                if publisher.requeued == 5:
+                    break
+                time.sleep(0.01)
+            messages.put(make_publish_data(5))
+            for _ in range(300):
+                if publisher.published == 6:
+                    break
+                time.sleep(0.01)
+            stop.set()
+            publisher.done.wait()
+
+        data = b"".join(sent)
+        names = []
+        while data:
+            (size,) = FRAME_HEADER.unpack_from(data)
+            name, body = decode_publish_frame(data[FRAME_HEADER.size : FRAME_HEADER.size + size])
+            self.assertEqual(name, "test.value")
+            names.append(wagglemsg.load(body).value)
+            data = data[FRAME_HEADER.size + size :]
+        self.assertEqual(names, list(range(6)))
+
+
+def make_publish_data(value):
+    msg = wagglemsg.Message("test.value", value, get_timestamp(), {})
+    return PublishData("all", wagglemsg.dump(msg), name=msg.name)
+
+
+class FakeBlockingConnection:
+    """
+    FakeBlockingConnection records messages published through it in place of a RabbitMQ
+    connection.
+    """
+
+    published = []
+
+    def __init__(self, params):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def channel(self):
+        return self
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.published.append((routing_key, body, properties))
+
+
+class FakeConsumingConnection(FakeBlockingConnection):
+    """
+    FakeConsumingConnection delivers the (properties, body) pairs in deliveries to a consumer
+    in place of a RabbitMQ connection.
+    """
+
+    deliveries = []
+
+    def __init__(self, params):
+        self.callbacks = []
+        self.consuming = False
+
+    def queue_declare(self, queue, exclusive=False):
+        return SimpleNamespace(method=SimpleNamespace(queue="test"))
+
+    def queue_bind(self, queue, exchange, routing_key):
+        pass
+
+    def basic_consume(self, queue, callback, auto_ack=False):
+        self.callback = callback
+
+    def call_later(self, delay, callback):
+        self.callbacks.append(callback)
+
+    def start_consuming(self):
+        for properties, body in self.deliveries:
+            self.callback(self, None, properties, body)
+        self.consuming = True
+        while self.consuming:
+            time.sleep(0.01)
+            callbacks, self.callbacks = self.callbacks, []
+            for callback in callbacks:
+                callback()
+
+    def stop_consuming(self):
+        self.consuming = False
+
+
+class TestEncoding(unittest.TestCase):
+    def test_packb(self):
+        testcases = [
+            None,
+            True,
+            False,
+            0,
+            127,
+            128,
+            -1,
+            -33,
+            65536,
+            2**40,
+            -(2**40),
+            2**64 - 1,
+            1.5,
+            "",
+            "hello",
+            "x" * 300,
+            "x" * 70000,
+            b"\x00\x01",
+            [1, "two", 3.0, [4]],
+            list(range(100)),
+            {"a": 1, "b": [True, None]},
+            {str(i): i for i in range(20)},
+        ]
+        for obj in testcases:
+            self.assertEqual(unpackb(packb(obj)), obj)
+        # check a few encodings against the msgpack spec
+        self.assertEqual(packb(1), b"\x01")
+        self.assertEqual(packb(-1), b"\xff")
+        self.assertEqual(packb("a"), b"\xa1a")
+        self.assertEqual(packb([1, 2]), b"\x92\x01\x02")
+        with self.assertRaises(ValueError):
+            unpackb(b"\x92\x01")
+        with self.assertRaises(ValueError):
+            unpackb(b"\x01\x02")
+
+    def test_batch(self):
+        ts = get_timestamp()
+        msgs = [
+            wagglemsg.Message(
+                name="env.temperature",
+                value=20.0 + i,
+                timestamp=ts + i * 1000,
+                meta={"node": "000048b02d15bc7c", "sensor": "bme680"},
+            )
+            for i in range(100)
+        ] + [
+            wagglemsg.Message("env.count", 3, ts, {}),
+            wagglemsg.Message("env.label", "x", ts, {}),
+            wagglemsg.Message("env.flag", True, ts, {}),
+        ]
+        body = encode_batch(msgs)
+        self.assertEqual(decode_batch(body), msgs)
+        # interning and delta timestamps should be much smaller than json
+        json_size = sum(len(wagglemsg.dump(msg)) for msg in msgs)
+        self.assertLess(len(body), json_size / 3)
+
+        for bad in [packb([1, 2]), packb([2, [], 0, []]), packb([1, ["a"], ts, [[5, 0, 1, []]]])]:
+            with self.assertRaises(ValueError):
+                decode_batch(bad)
+
+        self.assertTrue(can_batch(wagglemsg.Message("env.count", 2**64 - 1, ts, {})))
+        self.assertFalse(can_batch(wagglemsg.Message("env.count", 2**64, ts, {})))
+        self.assertFalse(can_batch(wagglemsg.Message("env.count", -(2**63) - 1, ts, {})))
+
+    def test_batch_publish(self):
+        config = get_transport_config("rabbitmq")._replace(encoding="batch")
+        FakeBlockingConnection.published = []
+        with unittest.mock.patch.object(pika, "BlockingConnection", FakeBlockingConnection):
+            with Plugin(config) as plugin:
+                for i in range(10):
+                    plugin.publish("test", i)
+                plugin.publish("test.node", 1, scope="node")
+
+        bodies = {scope: (body, props) for scope, body, props in FakeBlockingConnection.published}
+        self.assertEqual(set(bodies), {"all", "node"})
+        body, props = bodies["all"]
+        self.assertEqual(props.content_type, BATCH_CONTENT_TYPE)
+        self.assertEqual([msg.value for msg in decode_batch(body)], list(range(10)))
+
+    def test_batch_publish_unbatchable_values(self):
+        config = get_transport_config("rabbitmq")._replace(encoding="batch")
+        FakeBlockingConnection.published = []
+        with unittest.mock.patch.object(pika, "BlockingConnection", FakeBlockingConnection):
+            with Plugin(config) as plugin:
+                plugin.publish("test.flag", True)
+                plugin.publish("test.big", 2**70)
+                plugin.publish("test.value", 1)
+
+        values = {}
+        for _, body, props in FakeBlockingConnection.published:
+            if props.content_type == BATCH_CONTENT_TYPE:
+                msgs = decode_batch(body)
+            else:
+                msgs = [wagglemsg.load(body)]
+            values.update({msg.name: msg.value for msg in msgs})
+        # bools are kept in the batch and ints too large for msgpack are sent as json
+        self.assertEqual(values, {"test.flag": True, "test.big": 2**70, "test.value": 1})
+
+    def test_batch_publish_failure_requeues(self):
+        config = get_transport_config("rabbitmq")._replace(encoding="batch")
+
+        class FlakyConnection(FakeBlockingConnection):
+            failures = 1
+
+            def basic_publish(self, exchange, routing_key, body, properties=None):
+                if FlakyConnection.failures > 0:
+                    FlakyConnection.failures -= 1
+                    raise pika.exceptions.AMQPConnectionError()
+                super().basic_publish(exchange, routing_key, body, properties)
+
+        FakeBlockingConnection.published = []
+        with unittest.mock.patch.object(pika, "BlockingConnection", FlakyConnection):
+            with Plugin(config) as plugin:
+                plugin.publish("test.node", 1, scope="node")
+                plugin.publish("test.all", 2)
+                plugin.publish("test.beehive", 3, scope="beehive")
+                # wait for the publisher to reconnect and resend
+                for _ in range(500):
+                    published = FakeBlockingConnection.published
+                    if sum(len(decode_batch(body)) for _, body, _ in published) == 3:
+                        break
+                    time.sleep(0.01)
+
+        # messages for scopes after the failed one are requeued instead of dropped
+        self.assertEqual(plugin.publisher.stats()["rabbitmq.requeued"], 3)
+        names = sorted(
+            msg.name
+            for _, body, _ in FakeBlockingConnection.published
+            for msg in decode_batch(body)
+        )
+        self.assertEqual(names, ["test.all", "test.beehive", "test.node"])
+
+    def test_invalid_encoding(self):
+        with self.assertRaises(ValueError):
+            Plugin(get_transport_config("memory")._replace(encoding="xml"))
+        with self.assertRaises(ValueError):
+            Plugin(get_transport_config("memory")._replace(compression="rar"))
+
+    def test_compression(self):
+        body = json.dumps([{"label": "car", "box": [10, 20, 30, 40]}] * 200).encode()
+        for algorithm in ["zlib", "lzma"]:
+            compressor = Compressor(algorithm, threshold=1024)
+            compressed, content_encoding = compressor(body)
+            self.assertEqual(content_encoding, algorithm)
+            self.assertLess(len(compressed), len(body) / 5)
+            self.assertEqual(decompress_body(compressed, content_encoding), body)
+            # small bodies are sent as is
+            self.assertEqual(compressor(b"small"), (b"small", None))
+            # incompressible bodies are sent as is
+            noise = os.urandom(4096)
+            self.assertEqual(compressor(noise), (noise, None))
+        with self.assertRaises(ValueError):
+            decompress_body(b"not compressed", "zlib")
+        # other content encodings are passed through
+        for content_encoding in ["utf-8", "identity", "br"]:
+            self.assertEqual(decompress_body(body, content_encoding), body)
+
+    def test_compressed_publish(self):
+        config = get_transport_config("rabbitmq")._replace(
+            compression="zlib", compression_threshold=1024
+        )
+        value = json.dumps([{"label": "car", "box": [10, 20, 30, 40]}] * 100)
+        FakeBlockingConnection.published = []
+        with unittest.mock.patch.object(pika, "BlockingConnection", FakeBlockingConnection):
+            with Plugin(config) as plugin:
+                plugin.publish("detections", value)
+                plugin.publish("count", 100)
+                # wait for both messages to reach the broker
+                while len(FakeBlockingConnection.published) < 2:
+                    time.sleep(0.01)
+                stats = plugin.stats()
+
+        (_, body, props), (_, small, small_props) = FakeBlockingConnection.published
+        self.assertEqual(props.content_encoding, "zlib")
+        self.assertEqual(wagglemsg.load(decompress_body(body, "zlib")).value, value)
+        self.assertIsNone(small_props.content_encoding)
+        self.assertEqual(wagglemsg.load(small).value, 100)
+        self.assertEqual(stats["rabbitmq.publish.compressed"], 1)
+
+
+    def test_consume_content_encodings(self):
+        value = json.dumps([{"label": "car", "box": [10, 20, 30, 40]}] * 100)
+        body = wagglemsg.dump(wagglemsg.Message("test", value, get_timestamp(), {}))
+        compressed, _ = Compressor("zlib", threshold=0)(body)
+        FakeConsumingConnection.deliveries = [
+            (pika.BasicProperties(content_encoding=None), body),
+            (pika.BasicProperties(content_encoding="utf-8"), body),
+            (pika.BasicProperties(content_encoding="identity"), body),
+            (pika.BasicProperties(content_encoding="zlib"), compressed),
+        ]
+        with unittest.mock.patch.object(pika, "BlockingConnection", FakeConsumingConnection):
+            with Plugin(get_transport_config("rabbitmq")) as plugin:
+                plugin.subscribe("test")
+                msgs = [plugin.get(timeout=1) for _ in range(4)]
+        self.assertEqual([msg.value for msg in msgs], [value] * 4)
+
+
+@unittest.skipIf(sys.version_info < (3, 8), "shared payloads require python 3.8 or later")
+class TestSharedPayloads(unittest.TestCase):
+    def test_publish_shared(self):
+        import numpy as np
+
+        config = get_transport_config("memory")
+        frame = np.random.randint(0, 255, (48, 64, 3), dtype=np.uint8)
+
+        with Plugin(config) as subscriber, Plugin(config) as publisher:
+            subscriber.subscribe("camera.frame", "audio.block")
+            publisher.publish_shared("camera.frame", frame, meta={"camera": "left"})
+            publisher.publish_shared("audio.block", b"\x00\x01\x02")
+
+            msg = subscriber.get(timeout=1)
+            self.assertEqual(msg.meta, {"camera": "left"})
+            with open_shared(msg) as payload:
+                self.assertEqual(payload.shape, [48, 64, 3])
+                np.testing.assert_array_equal(payload.array(), frame)
+
+            with open_shared(subscriber.get(timeout=1)) as payload:
+                self.assertEqual(payload.tobytes(), b"\x00\x01\x02")
+
+            self.assertEqual(publisher.stats()["shared.segments"], 2)
+
+        # payloads are released when the publishing plugin exits
+        with self.assertRaises(RuntimeError):
+            open_shared(msg)
+
+        # descriptors are only useful on the node, so they aren't sent to beehive by default
+        plugin = Plugin(config)
+        plugin.publish_shared("camera.frame", b"\x00")
+        self.assertEqual(plugin.send.get_nowait().scope, "node")
+        plugin.shared_pool.close()
+
+    def test_open_shared_past_ttl(self):
+        pool = SharedMemoryPool()
+        try:
+            descriptor = pool.create(b"a" * 4096, ttl=0.1)
+            msg = wagglemsg.Message("test", json.dumps(descriptor), 0, {})
+            with open_shared(msg) as payload:
+                time.sleep(0.15)
+                pool.reap()
+                self.assertEqual(pool.stats()["shared.expired"], 1)
+                # new payloads of the same size never reuse the released memory
+                for _ in range(10):
+                    pool.create(b"b" * 4096)
+                self.assertEqual(payload.tobytes(), b"a" * 4096)
+            # once expired, the payload can't be opened again
+            with self.assertRaises(RuntimeError):
+                open_shared(msg)
+        finally:
+            pool.close()
+
+    def test_open_shared_invalid(self):
+        with self.assertRaises(ValueError):
+            open_shared(wagglemsg.Message("test", "not a descriptor", 0, {}))
+        with self.assertRaises(ValueError):
+            open_shared(wagglemsg.Message("test", 123, 0, {}))
+
+    def test_shared_memory_pool(self):
+        pool = SharedMemoryPool(max_bytes=100)
+        try:
+            expired = pool.create(b"x" * 10, ttl=0)
+            first = pool.create(b"x" * 60)
+            # exceeding max_bytes evicts the payloads closest to expiring
+            second = pool.create(b"y" * 60)
+            stats = pool.stats()
+            self.assertEqual(stats["shared.segments"], 1)
+            self.assertEqual(stats["shared.bytes"], 60)
+            self.assertEqual(stats["shared.expired"], 1)
+            self.assertEqual(stats["shared.evicted"], 1)
+
+            for descriptor in [expired, first]:
+                msg = wagglemsg.Message("test", json.dumps(descriptor), 0, {})
+                with self.assertRaises(RuntimeError):
+                    open_shared(msg)
+
+            msg = wagglemsg.Message("test", json.dumps(second), 0, {})
+            with open_shared(msg) as payload:
+                self.assertEqual(payload.tobytes(), b"y" * 60)
+
+            with self.assertRaises(ValueError):
+                pool.create(b"z" * 101)
+
+            # evicting small payloads must make room for the whole new payload
+            pool.create(b"a" * 20)
+            pool.create(b"b" * 20)
+            pool.create(b"c" * 90)
+            stats = pool.stats()
+            self.assertEqual(stats["shared.segments"], 1)
+            self.assertEqual(stats["shared.bytes"], 90)
+        finally:
+            pool.close()
+        self.assertEqual(pool.stats()["shared.segments"], 0)
+
+
 def rabbitmq_available():
     try:
         subprocess.check_output(["docker-compose", "exec", "rabbitmq", "true"])
@@ -252,6 +1271,73 @@ class TestPluginWithRabbitMQ(unittest.TestCase):
             self.assertEqual(msg, msg2)
 
 
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        tracing.clear()
+        tracing.enable()
+
+    def tearDown(self):
+        tracing.disable()
+        tracing.clear()
+
+    def test_trace(self):
+        with TemporaryDirectory() as dir:
+            try:
+                os.environ["PYWAGGLE_LOG_DIR"] = dir
+                with Plugin(get_transport_config("memory")) as plugin:
+                    with tracing.span("inference", args={"model": "test"}):
+                        time.sleep(0.001)
+                    plugin.publish("test", 1)
+                    # wait for the publisher to take the message off the queue
+                    while not plugin.send.empty():
+                        time.sleep(0.001)
+            finally:
+                del os.environ["PYWAGGLE_LOG_DIR"]
+
+            trace = json.loads(Path(dir, "trace.json").read_text())
+
+        events = {e["name"]: e for e in trace["traceEvents"] if e["ph"] == "X"}
+        self.assertIn("Plugin.publish", events)
+        self.assertIn("PublishData.queued", events)
+        self.assertEqual(events["inference"]["args"], {"model": "test"})
+        self.assertGreaterEqual(events["inference"]["dur"], 1000)
+
+        # the queue residency span is recorded on the publisher thread
+        self.assertNotEqual(events["Plugin.publish"]["tid"], events["PublishData.queued"]["tid"])
+        threads = {e["tid"] for e in trace["traceEvents"] if e["ph"] == "M"}
+        self.assertIn(events["PublishData.queued"]["tid"], threads)
+
+    def test_rabbitmq_publish_span(self):
+        from waggle.plugin import rabbitmq
+
+        def duration(start, finish):
+            return int((finish - start) * 1e9)
+
+        FakeBlockingConnection.published = []
+        # use the float timing counter of older pythons, which differs from the trace clock
+        with unittest.mock.patch.object(
+            pika, "BlockingConnection", FakeBlockingConnection
+        ), unittest.mock.patch.object(
+            rabbitmq, "timeit_perf_counter", time.perf_counter
+        ), unittest.mock.patch.object(
+            rabbitmq, "timeit_perf_counter_duration", duration
+        ):
+            with Plugin(get_transport_config("rabbitmq")) as plugin:
+                plugin.publish("test", 1)
+                while not FakeBlockingConnection.published:
+                    time.sleep(0.001)
+
+        events = {e["name"]: e for e in tracing.get_trace_events() if e["ph"] == "X"}
+        self.assertGreaterEqual(events["basic_publish"]["ts"], events["Plugin.publish"]["ts"])
+        self.assertLess(events["basic_publish"]["dur"], 1e6)
+
+    def test_disabled(self):
+        tracing.disable()
+        with tracing.span("ignored"):
+            pass
+        self.assertEqual(tracing.get_trace_events(), [])
+
+
 class TestPluginLogDir(unittest.TestCase):
     def test_log_dir(self):
         import sage_data_client